@@ -1,19 +1,123 @@
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from http.client import responses
+from urllib.parse import urljoin
+import argparse
+import contextlib
+import json
+import select
 import socket
+import struct
 import sys
 import ssl
+import threading
+import time
 
-# Create the socket and connect to the server
-def create_socket(domain, encrypt):
+CONNECT_TIMEOUT = 10 # Seconds to wait for the TCP connection and TLS handshake
+READ_TIMEOUT = 10 # Seconds of silence after which a response is taken as finished
+RECV_SIZE = 65536 # Bytes asked for per recv()
+MAX_REDIRECTS = 3 # Maximum number of redirects followed per site
+POOL_MAX_IDLE = 4 # Idle keep-alive connections kept per (host, port, tls)
+POOL_MAX_IDLE_TOTAL = 256 # Idle connections kept across all origins, oldest closed first
+POOL_MAX_SESSIONS = 1024 # TLS sessions kept for resumption, least recently used dropped first
+REDIRECT_STATUSES = ("HTTP/1.0 302", "HTTP/1.1 302", "HTTP/1.1 301", "HTTP/2 301", "HTTP/2 302")
+
+# HTTP/2 framing (RFC 9113): just enough to send GETs one at a time and read their responses
+HTTP2_PREFACE = b"PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n"
+HTTP2_FRAME_HEADER = struct.Struct("!IBI") # 24-bit length and 8-bit type packed in one int, flags, stream id
+HTTP2_DATA, HTTP2_HEADERS, HTTP2_RST_STREAM, HTTP2_SETTINGS = 0x0, 0x1, 0x3, 0x4
+HTTP2_PING, HTTP2_GOAWAY, HTTP2_WINDOW_UPDATE, HTTP2_CONTINUATION = 0x6, 0x7, 0x8, 0x9
+HTTP2_CANCEL = 0x8 # RST_STREAM error code
+HTTP2_END_STREAM, HTTP2_ACK, HTTP2_END_HEADERS, HTTP2_PADDED, HTTP2_PRIORITY = 0x1, 0x1, 0x4, 0x8, 0x20
+HTTP2_DEFAULT_WINDOW = 65535
+HTTP2_MAX_WINDOW = 2 ** 31 - 1
+HPACK_DEFAULT_TABLE_SIZE = 4096
+
+# HPACK (RFC 7541) static table, entries 1 to 61
+HPACK_STATIC_TABLE = (
+    (":authority", ""), (":method", "GET"), (":method", "POST"), (":path", "/"),
+    (":path", "/index.html"), (":scheme", "http"), (":scheme", "https"), (":status", "200"),
+    (":status", "204"), (":status", "206"), (":status", "304"), (":status", "400"),
+    (":status", "404"), (":status", "500"), ("accept-charset", ""),
+    ("accept-encoding", "gzip, deflate"), ("accept-language", ""), ("accept-ranges", ""),
+    ("accept", ""), ("access-control-allow-origin", ""), ("age", ""), ("allow", ""),
+    ("authorization", ""), ("cache-control", ""), ("content-disposition", ""),
+    ("content-encoding", ""), ("content-language", ""), ("content-length", ""),
+    ("content-location", ""), ("content-range", ""), ("content-type", ""), ("cookie", ""),
+    ("date", ""), ("etag", ""), ("expect", ""), ("expires", ""), ("from", ""), ("host", ""),
+    ("if-match", ""), ("if-modified-since", ""), ("if-none-match", ""), ("if-range", ""),
+    ("if-unmodified-since", ""), ("last-modified", ""), ("link", ""), ("location", ""),
+    ("max-forwards", ""), ("proxy-authenticate", ""), ("proxy-authorization", ""), ("range", ""),
+    ("referer", ""), ("refresh", ""), ("retry-after", ""), ("server", ""), ("set-cookie", ""),
+    ("strict-transport-security", ""), ("transfer-encoding", ""), ("user-agent", ""), ("vary", ""),
+    ("via", ""), ("www-authenticate", ""),
+)
+
+# Bit length of the HPACK Huffman code of each byte value. The code is canonical, so the
+# codes themselves follow from the lengths (see huffman_symbols below).
+HUFFMAN_CODE_LENGTHS = (
+    13, 23, 28, 28, 28, 28, 28, 28, 28, 24, 30, 28, 28, 30, 28, 28,
+    28, 28, 28, 28, 28, 28, 30, 28, 28, 28, 28, 28, 28, 28, 28, 28,
+    6, 10, 10, 12, 13, 6, 8, 11, 10, 10, 8, 11, 8, 6, 6, 6,
+    5, 5, 5, 6, 6, 6, 6, 6, 6, 6, 7, 8, 15, 6, 12, 10,
+    13, 6, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7,
+    7, 7, 7, 7, 7, 7, 7, 7, 8, 7, 8, 13, 19, 13, 14, 6,
+    15, 5, 6, 5, 6, 5, 6, 6, 6, 5, 7, 7, 6, 6, 6, 5,
+    6, 7, 6, 5, 5, 6, 7, 7, 7, 7, 7, 15, 11, 14, 13, 28,
+    20, 22, 20, 20, 22, 22, 22, 23, 22, 23, 23, 23, 23, 23, 24, 23,
+    24, 24, 22, 23, 24, 23, 23, 23, 23, 21, 22, 23, 22, 23, 23, 24,
+    22, 21, 20, 22, 22, 23, 23, 21, 23, 22, 22, 24, 21, 22, 23, 23,
+    21, 21, 22, 21, 23, 22, 23, 23, 20, 22, 22, 22, 23, 22, 22, 23,
+    26, 26, 20, 19, 22, 23, 22, 25, 26, 26, 26, 27, 27, 26, 24, 25,
+    19, 21, 26, 27, 27, 26, 27, 24, 21, 21, 26, 26, 28, 27, 27, 27,
+    20, 24, 20, 21, 22, 21, 21, 23, 22, 22, 25, 25, 24, 24, 26, 23,
+    26, 27, 26, 26, 27, 27, 27, 27, 27, 28, 27, 27, 27, 27, 27, 26,
+)
+
+# Map each Huffman code, prefixed with a 1 marker bit so different lengths can't collide, to its byte
+def build_huffman_symbols(lengths):
+    symbols = {}
+    code, previous_length = -1, 0
+    for symbol in sorted(range(256), key=lambda symbol: (lengths[symbol], symbol)):
+        code = (code + 1) << (lengths[symbol] - previous_length)
+        previous_length = lengths[symbol]
+        symbols[code | 1 << previous_length] = symbol
+    return symbols
+
+huffman_symbols = build_huffman_symbols(HUFFMAN_CODE_LENGTHS)
+
+# Split "host[:port]" into the host and the port to connect to
+def split_host(domain, encrypt):
+    host, _, port = domain.partition(":")
+    if port.isdigit():
+        return host, int(port)
+    return domain, 443 if encrypt else 80
+
+# Create the secure SSL context for HTTPS connections. Offering h2 via ALPN is how HTTP/2 support
+# is detected, on the request's own connection without a separate probe handshake.
+def create_tls_context():
+    context = ssl.create_default_context()
+    context.set_alpn_protocols(['h2', 'http/1.1'])
+    return context
+
+# Create the socket and connect to the server, resuming session (from an earlier connection made
+# with the same context) when one is given
+def create_socket(domain, encrypt, context, session=None):
+    host, port = split_host(domain, encrypt)
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM) # Create a TCP socket
+    s.settimeout(CONNECT_TIMEOUT) # Don't hang forever on an unresponsive server
+    # Send small writes (a request, an HTTP/2 frame) at once instead of holding them back until
+    # the previous one is acknowledged, which stalls requests on a reused connection
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     try:
         if encrypt:
-            # If HTTPS, create a secure SSL context and wrap the socket with it
-            context = ssl.create_default_context()
-            s = context.wrap_socket(s, server_hostname=domain)
-            s.connect((domain, 443)) # Connect to port 443 for HTTPS
+            # If HTTPS, wrap the socket with the secure SSL context
+            s = context.wrap_socket(s, server_hostname=host, session=session)
+            s.connect((host, port)) # Connect to port 443 (or the given port) for HTTPS
         else:
-            s.connect((domain, 80)) # Connect to port 80 for HTTP
+            s.connect((host, port)) # Connect to port 80 (or the given port) for HTTP
     except socket.error as e:
+        s.close()
         sys.exit(f"Connection to server FAILED: {e}")
     return s
 
@@ -25,22 +129,134 @@ def send_request(sock, path, domain):
     except socket.error as e:
         sys.exit(f"Could not send HTTP request: {e}")
 
-# Simplified receive_response function
-def receive_response(sock):
+# Receive more data into buffer; False once the server has closed the connection
+def read_more(sock, buffer):
+    part = sock.recv(RECV_SIZE)
+    buffer += part
+    return bool(part)
+
+# Read until buffer contains delimiter and return its index, or -1 if the connection closed first
+def read_until(sock, buffer, delimiter):
+    scanned = 0
+    while True:
+        index = buffer.find(delimiter, scanned)
+        if index >= 0:
+            return index
+        scanned = max(0, len(buffer) - len(delimiter) + 1) # Only rescan what could hold a split delimiter
+        if not read_more(sock, buffer):
+            return -1
+
+# Take the status line and header fields off the front of buffer (everything left if the
+# connection closed before the blank line that ends them)
+def read_head(sock, buffer):
+    end = read_until(sock, buffer, b"\r\n\r\n")
+    if end < 0:
+        end = len(buffer)
+    head = bytes(buffer[:end])
+    del buffer[:end + 4]
+    return head
+
+# The status code in a response head, b"" if there is none
+def head_status(head):
+    parts = head.split(None, 2)
+    return parts[1] if len(parts) > 1 else b""
+
+# The header fields in a response head as (lowercase name, value) pairs
+def head_fields(head):
+    for line in head.split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        yield name.strip().lower(), value.strip()
+
+# Work out how the body after head is framed: (content length or None, chunked?)
+def body_framing(head):
+    status = head_status(head)
+    if status in (b"204", b"304") or status.startswith(b"1"):
+        return 0, False # These responses never have a body
+    length = None
+    for name, value in head_fields(head):
+        if name == b"transfer-encoding" and b"chunked" in value.lower():
+            return None, True # Chunked wins over any Content-Length
+        if name == b"content-length" and value.isdigit():
+            length = int(value)
+    return length, False
+
+# Whether the server keeps the connection open for another request after this response
+def connection_persists(head):
+    connection = b""
+    for name, value in head_fields(head):
+        if name == b"connection":
+            connection = value.lower()
+    if head.startswith(b"HTTP/1.1"):
+        return b"close" not in connection
+    return b"keep-alive" in connection # HTTP/1.0 closes unless asked not to
+
+# Decode a chunked body from buffer (reading more as needed) into body, up to and including
+# the last chunk and any trailer fields. False if the connection closed before the end.
+def read_chunked(sock, buffer, body):
+    while True:
+        end = read_until(sock, buffer, b"\r\n")
+        if end < 0:
+            return False
+        size = int(bytes(buffer[:end]).split(b";", 1)[0].strip(), 16) # Ignore chunk extensions
+        del buffer[:end + 2]
+        if size == 0:
+            # Skip the trailer fields up to the blank line that ends the message
+            end = -1
+            while end != 0:
+                end = read_until(sock, buffer, b"\r\n")
+                if end < 0:
+                    return False
+                del buffer[:end + 2]
+            return True
+        while len(buffer) < size + 2 and read_more(sock, buffer):
+            pass
+        body += buffer[:size]
+        del buffer[:size + 2] # The chunk and the CRLF after it
+
+# Receive one HTTP/1.1 response. The body is framed by Content-Length or chunked transfer-encoding
+# (or the connection closing), so this returns as soon as the response is complete rather than
+# when the server goes quiet. With headers_only the body isn't returned. Also returns whether
+# the connection can carry another request: the response was read exactly to its end and the
+# server keeps the connection open.
+def receive_response(sock, headers_only=False):
+    sock.settimeout(READ_TIMEOUT) # Set a timeout to prevent blocking indefinitely
+    buffer = bytearray() # Data received but not consumed yet
+    head = b""
+    body = bytearray()
+    complete = False
     try:
-        sock.settimeout(2) # Set a timeout to prevent blocking indefinitely
-        response = b"" # Initialize an empty byte string to store the response
-        while True:
-            try:
-                part = sock.recv(4096) # Receive up to 4096 bytes at a time
-                if not part:
-                    break # If no more data is received, exit the loop
-                response += part # Append each chunk of the response
-            except socket.timeout:
-                break # If no data is received within timeout, assume end of response
-        return response.decode(errors='replace') # Return the full response as a decoded string
+        head = read_head(sock, buffer)
+        while head_status(head).startswith(b"1") and head_status(head) != b"101":
+            head = read_head(sock, buffer) # Skip interim responses (100 Continue, 103 Early Hints)
+        if head:
+            length, chunked = body_framing(head)
+            if headers_only:
+                # Read and drop a small body anyway: it is at most a round trip behind the headers,
+                # and reading it keeps the connection in step for the next request. A large or
+                # chunked one costs more than a new connection, so the connection is given up.
+                if length is not None and length <= RECV_SIZE:
+                    while len(buffer) < length and read_more(sock, buffer):
+                        pass
+                    complete = len(buffer) == length
+            elif chunked:
+                complete = read_chunked(sock, buffer, body) and not buffer
+            else:
+                body = buffer
+                while (length is None or len(body) < length) and read_more(sock, body):
+                    pass
+                complete = length is not None and len(body) == length
+                if length is not None:
+                    del body[length:]
+    except socket.timeout:
+        pass # Use whatever arrived before the timeout
+    except ValueError as e:
+        sys.exit(f"Malformed chunked response body: {e}")
     except socket.error as e:
         sys.exit(f"Error receiving response: {e}")
+    if not head:
+        return "", False
+    response = head.decode(errors='replace') + "\r\n\r\n" + body.decode(errors='replace')
+    return response, complete and connection_persists(head)
 
 # Parse the response into headers and body
 def parse_response(response):
@@ -57,26 +273,236 @@ def parse_response(response):
 
 # Handle redirection by extracting the new location
 def handle_redirect(headers):
-    print("--- Redirecting ---\n")
     for line in headers.splitlines():
         if line.lower().startswith("location:"):
             return line.split(":", 1)[1].strip() # Return the redirect location
     return None  # No redirect location found
 
-# Detect if HTTP/2 is supported
-def detect_http2_support(domain):
+# Build one HTTP/2 frame
+def http2_frame(frame_type, flags, stream, payload=b""):
+    return HTTP2_FRAME_HEADER.pack(len(payload) << 8 | frame_type, flags, stream) + payload
+
+# Encode an HPACK integer whose first byte holds prefix bits (the caller ORs in any flag bits)
+def hpack_integer(value, prefix):
+    limit = (1 << prefix) - 1
+    if value < limit:
+        return bytes([value])
+    encoded = bytearray([limit])
+    value -= limit
+    while value >= 0x80:
+        encoded.append(value & 0x7f | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+# Decode the HPACK integer at pos, returning it and the position after it
+def hpack_read_integer(block, pos, prefix):
+    limit = (1 << prefix) - 1
+    value = block[pos] & limit
+    pos += 1
+    if value == limit:
+        shift = 0
+        while True:
+            byte = block[pos]
+            pos += 1
+            value += (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+    return value, pos
+
+# Decode a Huffman-coded HPACK string
+def huffman_decode(data):
+    decoded = bytearray()
+    code = 1 # Marker bit followed by the bits read so far
+    for byte in data:
+        for shift in range(7, -1, -1):
+            code = code << 1 | byte >> shift & 1
+            symbol = huffman_symbols.get(code)
+            if symbol is not None:
+                decoded.append(symbol)
+                code = 1
+    # Whatever is left must be padding: fewer than 8 bits, all ones
+    if code.bit_length() > 8 or code & (code + 1):
+        raise ValueError("invalid Huffman padding")
+    return bytes(decoded)
+
+# Decode the HPACK string at pos, returning it and the position after it
+def hpack_read_string(block, pos):
+    huffman = block[pos] & 0x80
+    length, pos = hpack_read_integer(block, pos, 7)
+    data = block[pos:pos + length]
+    if len(data) < length:
+        raise ValueError("truncated header block")
+    if huffman:
+        data = huffman_decode(data)
+    return data.decode('latin-1'), pos + length # One char per octet keeps table sizes exact
+
+# Look up a static or dynamic table entry by its HPACK index
+def hpack_entry(index, table):
+    if 0 < index <= len(HPACK_STATIC_TABLE):
+        return HPACK_STATIC_TABLE[index - 1]
+    index -= len(HPACK_STATIC_TABLE) + 1
+    if not 0 <= index < len(table["entries"]):
+        raise ValueError("invalid header table index")
+    return table["entries"][index]
+
+# Add an entry to the dynamic table, evicting the oldest ones to stay within its size
+def hpack_insert(table, entry):
+    table["entries"].insert(0, entry)
+    table["size"] += len(entry[0]) + len(entry[1]) + 32
+    hpack_evict(table)
+
+# Evict the oldest dynamic table entries until it fits its maximum size
+def hpack_evict(table):
+    while table["size"] > table["max_size"]:
+        name, value = table["entries"].pop()
+        table["size"] -= len(name) + len(value) + 32
+
+# Decode an HPACK header block into (name, value) pairs. table is the connection's dynamic
+# table; every block the server sends must pass through here, in order, to keep it in sync.
+def hpack_decode(block, table):
+    fields = []
+    pos = 0
+    while pos < len(block):
+        byte = block[pos]
+        if byte & 0x80: # Indexed header field
+            index, pos = hpack_read_integer(block, pos, 7)
+            fields.append(hpack_entry(index, table))
+        elif byte & 0xe0 == 0x20: # Dynamic table size update
+            table["max_size"], pos = hpack_read_integer(block, pos, 5)
+            hpack_evict(table)
+        else: # Literal header field, with incremental indexing (01) or without (0000 or 0001)
+            index, pos = hpack_read_integer(block, pos, 6 if byte & 0x40 else 4)
+            if index:
+                name = hpack_entry(index, table)[0]
+            else:
+                name, pos = hpack_read_string(block, pos)
+            value, pos = hpack_read_string(block, pos)
+            fields.append((name, value))
+            if byte & 0x40:
+                hpack_insert(table, (name, value))
+    return fields
+
+# Send a minimal HTTP/2 GET on a connection where ALPN selected h2: one HEADERS frame that opens
+# and ends the stream, with plain HPACK literal header fields. The first request on a connection
+# (stream 1) is preceded by the connection preface and our SETTINGS: no server push, and the
+# largest windows, which receive_http2_response tops up on the connection.
+def send_http2_request(sock, path, domain, stream=1):
+    settings = struct.pack("!HIHI", 0x2, 0, 0x4, HTTP2_MAX_WINDOW) # ENABLE_PUSH, INITIAL_WINDOW_SIZE
+    window = struct.pack("!I", HTTP2_MAX_WINDOW - HTTP2_DEFAULT_WINDOW)
+    header_block = b"\x82\x87" # :method GET and :scheme https from the static table
+    for index, value in ((4, path), (1, domain)): # :path and :authority, literal without indexing
+        value = value.encode()
+        header_block += hpack_integer(index, 4) + hpack_integer(len(value), 7) + value
+    frames = http2_frame(HTTP2_HEADERS, HTTP2_END_STREAM | HTTP2_END_HEADERS, stream, header_block)
+    if stream == 1:
+        frames = (HTTP2_PREFACE + http2_frame(HTTP2_SETTINGS, 0, 0, settings)
+                  + http2_frame(HTTP2_WINDOW_UPDATE, 0, 0, window) + frames)
     try:
-        # Create a temporary socket with ALPN protocols 'h2' and 'http/1.1'
-        temp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        context = ssl.create_default_context()
-        context.set_alpn_protocols(['h2', 'http/1.1'])
-        wrapped_sock = context.wrap_socket(temp_sock, server_hostname=domain)
-        wrapped_sock.connect((domain, 443)) # Connect to the server on port 443 (HTTPS)
-        selected_protocol = wrapped_sock.selected_alpn_protocol() # Get the negotiated protocol
-        wrapped_sock.close()
-        return selected_protocol == 'h2'
-    except Exception:
-        return False
+        sock.sendall(frames)
+    except socket.error as e:
+        sys.exit(f"Could not send HTTP request: {e}")
+
+# Read exactly size bytes from the socket
+def recv_exact(sock, size):
+    data = b""
+    while len(data) < size:
+        part = sock.recv(size - len(data))
+        if not part:
+            raise ConnectionError("connection closed by the server")
+        data += part
+    return data
+
+# Strip the padding of a padded HEADERS or DATA frame
+def http2_unpad(payload, flags):
+    if flags & HTTP2_PADDED:
+        return payload[1:len(payload) - payload[0]]
+    return payload
+
+# Receive the response on stream and return it as HTTP/1.1-style text ("HTTP/2 200 OK", one
+# "name: value" line per header, a blank line, the body) so parse_response() handles both protocols.
+# table is the connection's HPACK dynamic table and flow its receive window. Also returns whether
+# the connection can carry another request: the stream ended (or was cancelled after its headers)
+# and no GOAWAY arrived.
+def receive_http2_response(sock, headers_only=False, stream=1, table=None, flow=None):
+    sock.settimeout(READ_TIMEOUT) # Set a timeout to prevent blocking indefinitely
+    if table is None:
+        table = {"entries": [], "size": 0, "max_size": HPACK_DEFAULT_TABLE_SIZE}
+    if flow is None:
+        flow = {"window": HTTP2_MAX_WINDOW}
+    fields = None
+    header_block = b""
+    end_stream = False
+    body = bytearray()
+    complete = False
+    going_away = False
+    try:
+        while not complete:
+            length_type, flags, frame_stream = HTTP2_FRAME_HEADER.unpack(recv_exact(sock, HTTP2_FRAME_HEADER.size))
+            payload = recv_exact(sock, length_type >> 8)
+            frame_type = length_type & 0xff
+            frame_stream &= 0x7fffffff
+            if frame_type == HTTP2_DATA:
+                # DATA on every stream, padding and cancelled streams' tails included, counts against
+                # the connection's window: open it back up once half is used, or the server stalls
+                flow["window"] -= length_type >> 8
+                if flow["window"] < HTTP2_MAX_WINDOW // 2:
+                    increment = struct.pack("!I", HTTP2_MAX_WINDOW - flow["window"])
+                    sock.sendall(http2_frame(HTTP2_WINDOW_UPDATE, 0, 0, increment))
+                    flow["window"] = HTTP2_MAX_WINDOW
+            if frame_type == HTTP2_SETTINGS and not flags & HTTP2_ACK:
+                sock.sendall(http2_frame(HTTP2_SETTINGS, HTTP2_ACK, 0))
+            elif frame_type == HTTP2_PING and not flags & HTTP2_ACK:
+                sock.sendall(http2_frame(HTTP2_PING, HTTP2_ACK, 0, payload))
+            elif frame_type == HTTP2_GOAWAY:
+                last_stream, error_code = struct.unpack("!II", payload[:8])
+                if last_stream & 0x7fffffff < stream:
+                    sys.exit(f"Server refused the HTTP/2 request (GOAWAY, error code {error_code})")
+                going_away = True # Our stream still completes, but it is the connection's last
+            elif frame_type in (HTTP2_HEADERS, HTTP2_CONTINUATION):
+                # Every header block goes through the decoder, even one for an earlier stream we
+                # cancelled, to keep the dynamic table in step with the server's
+                if frame_type == HTTP2_HEADERS:
+                    payload = http2_unpad(payload, flags)
+                    if flags & HTTP2_PRIORITY:
+                        payload = payload[5:]
+                    end_stream = flags & HTTP2_END_STREAM
+                header_block += payload
+                if flags & HTTP2_END_HEADERS:
+                    block_fields = hpack_decode(header_block, table)
+                    header_block = b""
+                    if frame_stream != stream:
+                        continue
+                    # Keep the final response headers: skip 1xx interim responses and trailers
+                    if fields is None and not dict(block_fields).get(":status", "").startswith("1"):
+                        fields = block_fields
+                    if end_stream:
+                        complete = True
+                    elif headers_only and fields is not None:
+                        # Tell the server to stop sending the body we don't need
+                        sock.sendall(http2_frame(HTTP2_RST_STREAM, 0, stream, struct.pack("!I", HTTP2_CANCEL)))
+                        complete = True
+            elif frame_stream != stream:
+                continue # Connection-level WINDOW_UPDATE, the tail of a cancelled stream and the like
+            elif frame_type == HTTP2_RST_STREAM:
+                sys.exit(f"Server reset the HTTP/2 request (error code {struct.unpack('!I', payload[:4])[0]})")
+            elif frame_type == HTTP2_DATA:
+                body += http2_unpad(payload, flags)
+                complete = bool(flags & HTTP2_END_STREAM)
+    except socket.timeout:
+        pass # Use whatever arrived before the timeout
+    except (IndexError, ValueError) as e:
+        sys.exit(f"Malformed HTTP/2 response: {e}")
+    except socket.error as e:
+        sys.exit(f"Error receiving response: {e}")
+    if fields is None:
+        return "", False
+    status = dict(fields).get(":status", "")
+    lines = [f"HTTP/2 {status} {responses.get(int(status) if status.isdigit() else 0, '')}".rstrip()]
+    lines += [f"{name}: {value}" for name, value in fields if not name.startswith(":")]
+    response = "\r\n".join(lines) + "\r\n\r\n" + body.decode(errors='replace')
+    return response, complete and not going_away
 
 # Extract cookie details
 def extract_cookie_details(cookies):
@@ -121,77 +547,333 @@ def parse_url(url):
         path = "/" # Default to root path if no path is specified
     return domain, path, encrypt # Return the parsed components
 
-# Handle a single HTTP request/response cycle
-def handle_request(domain, path, encrypt):
-    sock = create_socket(domain, encrypt) # Create a socket based on HTTP/HTTPS
-    send_request(sock, path, domain) # Send the GET request
-    response = receive_response(sock) # Receive the server's response
-    sock.close() # Close the socket if not reusing it
-    status_line, cookies, body, headers = parse_response(response) # Parse the response
-    return status_line, cookies, body, headers # Return parsed data
+# Connection pool shared by the requests of a check (or of a whole bulk run): idle keep-alive
+# connections by (host, port, tls), and the last TLS session per origin so that even a new
+# connection resumes it instead of doing a full handshake. Counters say how much was saved.
+# max_idle=0 and resume_sessions=False give back one fresh connection per request.
+def new_pool(max_idle=POOL_MAX_IDLE, resume_sessions=True):
+    return {
+        "tls_context": create_tls_context(), # Sessions only resume on the context that made them
+        "max_idle": max_idle,
+        "resume_sessions": resume_sessions,
+        "idle": OrderedDict(), # (host, port, tls) -> idle connections, least recently used first
+        "idle_count": 0,
+        "sessions": OrderedDict(), # (host, port, tls) -> ssl.SSLSession, least recently used first
+        "lock": threading.Lock(),
+        "connections": 0, # New TCP connections
+        "resumed": 0, # ...of which resumed a TLS session
+        "reused": 0, # Requests sent on a kept-alive connection instead of a new one
+    }
 
-# Main function to manage the flow
-def main():
-    if len(sys.argv) < 2:
-        sys.exit("Usage: python3 WebTester.py <domain>") # Ensure a URL argument is passed
+# An idle HTTP/1.1 connection is only reusable if the server hasn't closed it (or sent anything
+# else) while it sat in the pool. HTTP/2 servers may legitimately send frames at any time, so
+# those are tried and retried on failure instead.
+def connection_alive(conn):
+    if conn["http2"]:
+        return True
+    sock = conn["sock"]
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (OSError, ValueError):
+        return False
+    return not readable and not (conn["key"][2] and sock.pending())
 
-    url = sys.argv[1]
-    domain, path, encrypt = parse_url(url) # Parse the URL into its components
+# Get a connection to domain: a kept-alive one from the pool if there is one still open, else
+# a new one. A connection is a dict of its socket, its pool key and its HTTP/2 stream state.
+def pool_connect(pool, domain, encrypt, reuse=True):
+    host, port = split_host(domain, encrypt)
+    key = (host, port, encrypt)
+    with pool["lock"]:
+        idle = pool["idle"].get(key, [])
+        while reuse and idle:
+            conn = idle.pop()
+            pool["idle_count"] -= 1
+            if connection_alive(conn):
+                pool["reused"] += 1
+                conn["reused"] = True
+                return conn
+            conn["sock"].close()
+        session = pool["sessions"].get(key)
+    sock = create_socket(domain, encrypt, pool["tls_context"], session) # Create a socket based on HTTP/HTTPS
+    with pool["lock"]:
+        pool["connections"] += 1
+        pool["resumed"] += encrypt and sock.session_reused
+    return {
+        "sock": sock,
+        "key": key,
+        "http2": encrypt and sock.selected_alpn_protocol() == 'h2', # Did the server pick HTTP/2?
+        "stream": 1, # Next HTTP/2 stream id: client streams are odd and never reused
+        "table": {"entries": [], "size": 0, "max_size": HPACK_DEFAULT_TABLE_SIZE},
+        "flow": {"window": HTTP2_MAX_WINDOW}, # Connection receive window, as opened on the first stream
+        "reused": False,
+    }
 
-    # Detect HTTP/2 support
-    supports_http2 = False
-    if encrypt:
-        supports_http2 = detect_http2_support(domain)
+# Hand a connection back after a request: keep it for the next request to its origin if it can
+# carry one, else close it. Either way remember its TLS session, which is only complete once the
+# server's session tickets have been read along with the response.
+def pool_release(pool, conn, keep_alive):
+    sock = conn["sock"]
+    key = conn["key"]
+    with pool["lock"]:
+        if key[2] and pool["resume_sessions"] and sock.session is not None:
+            pool["sessions"][key] = sock.session
+            pool["sessions"].move_to_end(key)
+            if len(pool["sessions"]) > POOL_MAX_SESSIONS:
+                pool["sessions"].popitem(last=False)
+        idle = pool["idle"].setdefault(key, [])
+        pool["idle"].move_to_end(key)
+        if keep_alive and len(idle) < pool["max_idle"]:
+            idle.append(conn)
+            pool["idle_count"] += 1
+            sock = None
+        # Close the least recently used origin's idle connections when too many are open
+        while pool["idle_count"] > POOL_MAX_IDLE_TOTAL:
+            _, oldest = pool["idle"].popitem(last=False)
+            pool["idle_count"] -= len(oldest)
+            for idle_conn in oldest:
+                idle_conn["sock"].close()
+        if not pool["idle"].get(key, True):
+            del pool["idle"][key] # Don't keep an entry for every origin ever seen
+    if sock is not None:
+        sock.close()
 
-    redirects = 0
-    max_redirects = 3 # Maximum number of redirects allowed
+# Close every idle connection in the pool
+def pool_close(pool):
+    with pool["lock"]:
+        for idle in pool["idle"].values():
+            for conn in idle:
+                conn["sock"].close()
+        pool["idle"].clear()
+        pool["idle_count"] = 0
 
-    while True:
-        print("---Request begin---")
+# Send one GET on a connection and receive the response, as HTTP/2 if ALPN picked it
+def exchange(conn, domain, path, headers_only):
+    sock = conn["sock"]
+    try:
+        if conn["http2"]:
+            send_http2_request(sock, path, domain, conn["stream"]) # Send the GET request as HTTP/2
+            response = receive_http2_response(sock, headers_only, conn["stream"], conn["table"], conn["flow"])
+            conn["stream"] += 2
+            return response
+        send_request(sock, path, domain) # Send the GET request
+        return receive_response(sock, headers_only) # Receive the server's response
+    except SystemExit:
+        sock.close()
+        raise
+
+# Print the request about to go out, in the protocol ALPN picked for its connection
+def print_request(domain, path, http2):
+    print("---Request begin---")
+    if http2:
+        print(f"GET {path} HTTP/2\r\nHost: {domain}\r\n")
+    else:
         print(f"GET {path} HTTP/1.1\r\nHost: {domain}\r\nConnection: Keep-Alive\r\n")
-        print("---Request end---")
-        print("HTTP request sent, awaiting response...\n")
+    print("---Request end---")
+    print(f"{'HTTP/2' if http2 else 'HTTP/1.1'} request sent, awaiting response...\n")
+
+# Handle a single HTTP request/response cycle on a pooled connection
+def handle_request(pool, domain, path, encrypt, headers_only=False, verbose=False):
+    conn = pool_connect(pool, domain, encrypt)
+    if verbose:
+        print_request(domain, path, conn["http2"])
+    try:
+        response, keep_alive = exchange(conn, domain, path, headers_only)
+    except SystemExit:
+        if not conn["reused"]:
+            raise
+        response = ""
+    if not response and conn["reused"]:
+        # The server dropped the kept-alive connection just as we reused it: retry on a new one
+        conn["sock"].close()
+        with pool["lock"]:
+            pool["reused"] -= 1
+        conn = pool_connect(pool, domain, encrypt, reuse=False)
+        response, keep_alive = exchange(conn, domain, path, headers_only)
+    pool_release(pool, conn, keep_alive)
+    status_line, cookies, body, headers = parse_response(response) # Parse the response
+    return status_line, cookies, body, headers, conn["http2"] # Return parsed data
+
+# Check one site: GET the URL following up to MAX_REDIRECTS redirects. HTTP/2 support is what ALPN
+# negotiated on the first request's connection.
+# throttle(domain) wraps every request; verbose prints the progress main() always printed.
+# Connections come from pool, or from one of the check's own for its redirect chain.
+def check_site(url, throttle=contextlib.nullcontext, verbose=True, pool=None):
+    if pool is None:
+        pool = new_pool()
+        try:
+            return check_site(url, throttle, verbose, pool)
+        finally:
+            pool_close(pool)
+
+    domain, path, encrypt = parse_url(url) # Parse the URL into its components
 
+    supports_http2 = None
+    redirects = 0
+    while True:
         # Handle the HTTP request and response
-        status_line, cookies, body, headers = handle_request(domain, path, encrypt)
+        with throttle(domain):
+            # Only the verbose report prints the body; status, cookies and auth are all in the headers
+            status_line, cookies, body, headers, http2 = handle_request(pool, domain, path, encrypt, not verbose, verbose)
+        if supports_http2 is None:
+            supports_http2 = http2
 
-        # Handle redirection if necessary (limit to max_redirects)
-        if "HTTP/1.0 302" in status_line or "HTTP/1.1 302" in status_line or "HTTP/1.1 301" in status_line:
+        # Handle redirection if necessary (limit to MAX_REDIRECTS)
+        if any(status in status_line for status in REDIRECT_STATUSES):
             redirects += 1
-            if redirects > max_redirects:
-                print("--- Max Number of Redirects Reached ---")
+            if redirects > MAX_REDIRECTS:
+                if verbose:
+                    print("--- Max Number of Redirects Reached ---")
                 break
+            if verbose:
+                print("--- Redirecting ---\n")
             location = handle_redirect(headers) # Get the redirect location
             if location:
-                domain, path, encrypt = parse_url(location) # Parse the new URL from the redirect
+                # Resolve the location against the current URL: absolute, protocol-relative or a path
+                current = f"{'https' if encrypt else 'http'}://{domain}{path}"
+                domain, path, encrypt = parse_url(urljoin(current, location))
                 continue
             else:
                 break # No Location header found; cannot redirect
         else:
             break # No redirection; proceed
 
+    return {
+        "website": domain,
+        "status": status_line,
+        "http2": supports_http2,
+        "cookies": extract_cookie_details(cookies),
+        "password_protected": check_password_protection(status_line),
+        "headers": headers,
+        "body": body,
+    }
+
+# Build the throttle shared by the bulk workers: at most per_host requests in flight to any
+# one host, and requests started at no more than rate per second overall (0: no limit)
+def make_throttle(per_host, rate):
+    lock = threading.Lock()
+    host_slots = {}
+    next_start = [time.monotonic()]
+
+    @contextlib.contextmanager
+    def throttle(domain):
+        # Each host's slot counts its users and is dropped when the last one leaves, so a long
+        # URL list does not keep a semaphore for every host it ever visited
+        with lock:
+            slot = host_slots.get(domain)
+            if slot is None:
+                slot = host_slots[domain] = {"semaphore": threading.BoundedSemaphore(per_host), "users": 0}
+            slot["users"] += 1
+        try:
+            with slot["semaphore"]:
+                if rate:
+                    # Reserve the next start time under the lock, then wait for it outside
+                    with lock:
+                        now = time.monotonic()
+                        start = max(now, next_start[0])
+                        next_start[0] = start + 1 / rate
+                    if start > now:
+                        time.sleep(start - now)
+                yield
+        finally:
+            with lock:
+                slot["users"] -= 1
+                if not slot["users"]:
+                    del host_slots[domain]
+    return throttle
+
+# Check one site for bulk mode: never prints and never exits, failures become an "error" field
+def audit_site(url, throttle, pool):
+    try:
+        result = check_site(url, throttle, verbose=False, pool=pool)
+    except SystemExit as e:
+        # The request helpers report failures with sys.exit(); in bulk mode that only ends this URL
+        return {"url": url, "error": str(e.code)}
+    except Exception as e:
+        return {"url": url, "error": f"{type(e).__name__}: {e}"}
+    del result["headers"], result["body"]
+    return {"url": url, **result}
+
+# Check every URL in lines (one per line, blank lines and # comments ignored) on a pool of
+# workers threads, writing one JSON object per site to out as soon as its check finishes.
+# All checks share one connection pool, so URLs on the same origin reuse warm connections.
+def run_bulk(lines, out, workers, per_host, rate, pool=None):
+    throttle = make_throttle(per_host, rate)
+    if pool is None:
+        pool = new_pool()
+    pending = set()
+
+    def flush(done):
+        for future in done:
+            out.write(json.dumps(future.result()) + "\n")
+        out.flush()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for line in lines:
+            url = line.strip()
+            if not url or url.startswith("#"):
+                continue
+            # Read ahead only a little so huge URL lists aren't held in memory as futures
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                flush(done)
+            pending.add(executor.submit(audit_site, url, throttle, pool))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            flush(done)
+    pool_close(pool)
+    return pool
+
+# Main function to manage the flow
+def main():
+    parser = argparse.ArgumentParser(description="Check a website for HTTP/2 support, cookies and password protection.")
+    parser.add_argument("url", nargs="?", help="website to check, e.g. www.uvic.ca or https://host:8443/path")
+    parser.add_argument("--bulk", metavar="FILE",
+                        help="check every URL listed in FILE ('-' for stdin) and print one JSON line per site")
+    parser.add_argument("--workers", type=int, default=64, help="sites checked concurrently in bulk mode (default 64)")
+    parser.add_argument("--per-host", type=int, default=2,
+                        help="requests in flight to one host at a time in bulk mode (default 2)")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="requests per second across all workers in bulk mode (default: unlimited)")
+    args = parser.parse_args()
+    if (args.url is None) == (args.bulk is None):
+        parser.error("give either a URL or --bulk FILE")
+    if args.workers < 1 or args.per_host < 1 or args.rate < 0:
+        parser.error("--workers and --per-host must be at least 1 and --rate must not be negative")
+
+    if args.bulk is not None:
+        if args.bulk == "-":
+            run_bulk(sys.stdin, sys.stdout, args.workers, args.per_host, args.rate)
+        else:
+            try:
+                with open(args.bulk) as f:
+                    run_bulk(f, sys.stdout, args.workers, args.per_host, args.rate)
+            except OSError as e:
+                sys.exit(f"Could not read URL list: {e}")
+        return
+
+    result = check_site(args.url)
+    domain = result["website"]
+    headers = result["headers"]
+    body = result["body"]
+
     # Print header and body *OPTIONAL*
     print("--- Response header ---")
     print(headers)
     print("\n--- Response body ---")
     print(f"{body[:500]}\n") # Print the first 500 characters of the body
 
-    # Extract cookie details
-    cookie_details = extract_cookie_details(cookies)
-    password_protected = check_password_protection(status_line)
-
     # Print the final results (website, HTTP/2 support, cookies, password protection) *MANDATORY*
     print(f"website: {domain}")
-    print(f"1. Supports http2: {'yes' if supports_http2 else 'no'}")
+    print(f"1. Supports http2: {'yes' if result['http2'] else 'no'}")
     print(f"2. List of Cookies:")
-    for cookie in cookie_details:
+    for cookie in result["cookies"]:
         name = cookie["name"]
         domain_name = f"domain name: {cookie['domain']}" if cookie["domain"] else ""
         expires_time = f"expires time: {cookie['expires']}" if cookie["expires"] else ""
         # Clean up formatting by removing unnecessary commas and spaces
         details = ', '.join(filter(None, [f"cookie name: {name}", expires_time, domain_name]))
         print(details)
-    print(f"3. Password-protected: {'yes' if password_protected else 'no'}")
+    print(f"3. Password-protected: {'yes' if result['password_protected'] else 'no'}")
 
 if __name__ == '__main__':
     main()
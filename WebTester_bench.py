@@ -0,0 +1,250 @@
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import io
+import json
+import os
+import platform
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import WebTester
+
+# Connection handling compared: the old one new connection (and full TLS handshake) per
+# request, and the keep-alive pool with TLS session resumption
+BASELINE = 'new connection per request'
+MODES = {
+    BASELINE: {'max_idle': 0, 'resume_sessions': False},
+    'pooled': {},
+}
+
+class BenchHandler(BaseHTTPRequestHandler):
+    # Stand-in site: /redirect/N redirects N more times on the same origin, anything else is a
+    # page with a cookie. ?close makes the server close the connection after the response.
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True # As real servers do; else responses wait on delayed ACKs
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.stats['requests'] += 1
+        time.sleep(server.rtt) # Request and response
+        path, _, query = self.path.partition('?')
+        hops = path[len('/redirect/'):] if path.startswith('/redirect/') else ''
+        if hops.isdigit() and int(hops) > 0:
+            body = b''
+            self.send_response(302)
+            self.send_header('Location', f'/redirect/{int(hops) - 1}' + (f'?{query}' if query else ''))
+        else:
+            body = b'<html>' + b'x' * 2000 + b'</html>'
+            self.send_response(200)
+            self.send_header('Set-Cookie', 'session=1; Domain=localhost')
+        self.send_header('Content-Length', str(len(body)))
+        if query == 'close':
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class BenchServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, tls_context, rtt):
+        super().__init__(('127.0.0.1', 0), BenchHandler)
+        self.tls_context = tls_context
+        self.rtt = rtt
+        self.lock = threading.Lock()
+        self.stats = new_stats()
+
+    def finish_request(self, request, client_address):
+        # Runs on the connection's own thread, so TLS handshakes don't queue up in the accept
+        # loop. The sleeps stand in for the handshakes' round trips.
+        time.sleep(self.rtt) # TCP handshake
+        if self.tls_context is not None:
+            request = self.tls_context.wrap_socket(request, server_side=True)
+            time.sleep(self.rtt) # TLS 1.3 handshake, full or resumed
+        with self.lock:
+            self.stats['connections'] += 1
+            if self.tls_context is not None:
+                self.stats['resumed_handshakes' if request.session_reused else 'full_handshakes'] += 1
+        try:
+            super().finish_request(request, client_address)
+        finally:
+            if self.tls_context is not None:
+                request.close()
+
+    def take_stats(self):
+        # The counters since the last call
+        with self.lock:
+            stats, self.stats = self.stats, new_stats()
+        return stats
+
+def new_stats():
+    return {'requests': 0, 'connections': 0, 'full_handshakes': 0, 'resumed_handshakes': 0}
+
+def make_certificate(tmpdir):
+    # A self-signed certificate for localhost, or None without an openssl binary
+    cert, key = os.path.join(tmpdir, 'cert.pem'), os.path.join(tmpdir, 'key.pem')
+    try:
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                        '-subj', '/CN=localhost', '-addext', 'subjectAltName=DNS:localhost',
+                        '-keyout', key, '-out', cert], check=True, capture_output=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return cert, key
+
+def start_server(certificate, rtt):
+    tls_context = None
+    if certificate is not None:
+        tls_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        tls_context.load_cert_chain(*certificate)
+    server = BenchServer(tls_context, rtt)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    scheme = 'https' if certificate is not None else 'http'
+    return server, f'{scheme}://localhost:{server.server_address[1]}'
+
+def bench_pool(mode, cafile):
+    pool = WebTester.new_pool(**MODES[mode])
+    if cafile is not None:
+        pool['tls_context'].load_verify_locations(cafile)
+    return pool
+
+def run_redirects(server, origin, cafile, checks, hops):
+    # Single-site checks that follow a same-origin redirect chain, each with a pool of its own
+    # as in WebTester.py <url>
+    results = {}
+    for mode in MODES:
+        server.take_stats()
+        latencies = []
+        for _ in range(checks):
+            pool = bench_pool(mode, cafile)
+            start = time.perf_counter()
+            WebTester.check_site(f'{origin}/redirect/{hops}', verbose=False, pool=pool)
+            latencies.append(time.perf_counter() - start)
+            WebTester.pool_close(pool)
+        results[mode] = dict(server.take_stats(), seconds=sum(latencies),
+                             mean_ms=statistics.mean(latencies) * 1000,
+                             p95_ms=statistics.quantiles(latencies, n=20)[18] * 1000)
+    return results
+
+def run_batch(server, origin, cafile, urls, workers, close):
+    # A --bulk run over urls pages of one origin sharing one pool. With close the server drops
+    # every connection, leaving TLS session resumption as the only saving.
+    suffix = '?close' if close else ''
+    results = {}
+    for mode in MODES:
+        server.take_stats()
+        pool = bench_pool(mode, cafile)
+        out = io.StringIO()
+        start = time.perf_counter()
+        WebTester.run_bulk((f'{origin}/page{i}{suffix}' for i in range(urls)), out, workers, workers, 0, pool)
+        elapsed = time.perf_counter() - start
+        errors = sum('"error"' in line for line in out.getvalue().splitlines())
+        results[mode] = dict(server.take_stats(), seconds=elapsed, checks_per_sec=urls / elapsed, errors=errors)
+    return results
+
+def print_results(label, results):
+    print(label)
+    baseline = results[BASELINE]
+    for mode, result in results.items():
+        latency = (f'mean {result["mean_ms"]:7.2f} ms  p95 {result["p95_ms"]:7.2f} ms' if 'mean_ms' in result
+                   else f'{result["seconds"]:6.2f} s  {result["checks_per_sec"]:8.0f} checks/s')
+        print(f'  {mode:<27} {result["requests"]:6} requests  {result["connections"]:6} connections  '
+              f'{result["full_handshakes"]:6} full + {result["resumed_handshakes"]:6} resumed TLS  {latency}')
+        if mode != BASELINE:
+            result['tcp_handshakes_saved'] = baseline['connections'] - result['connections']
+            result['full_tls_handshakes_saved'] = baseline['full_handshakes'] - result['full_handshakes']
+            result['speedup'] = baseline['seconds'] / result['seconds']
+            print(f'  {"":<27} saved {result["tcp_handshakes_saved"]} TCP and '
+                  f'{result["full_tls_handshakes_saved"]} full TLS handshakes, {result["speedup"]:.2f}x faster')
+
+def git_commit():
+    # The commit being benchmarked, or None outside a git checkout
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def write_json_results(filename, benchmarks):
+    # Save a run's results together with what they were measured on, so
+    # runs can be compared over time
+    document = {
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': f'{platform.python_implementation()} {platform.python_version()}',
+        'openssl': ssl.OPENSSL_VERSION,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'arguments': sys.argv[1:],
+        'benchmarks': benchmarks
+    }
+    with open(filename, 'w') as f:
+        json.dump(document, f, indent=2)
+        f.write('\n')
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark WebTester.py connection reuse against a local stand-in server.')
+    parser.add_argument('--checks', type=int, default=200,
+                        help='redirect-chain checks per connection mode (default %(default)s)')
+    parser.add_argument('--hops', type=int, default=3,
+                        help='same-origin redirects per check (default %(default)s)')
+    parser.add_argument('--urls', type=int, default=1000,
+                        help='URLs in each --bulk batch (default %(default)s)')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='--bulk workers (default %(default)s)')
+    parser.add_argument('--rtt', type=float, default=0, metavar='MS',
+                        help='simulated network round trip: the server waits MS once per request, once for '
+                             'each new connection and once more for its TLS handshake (default %(default)s)')
+    parser.add_argument('--no-tls', action='store_true', help='only benchmark plain HTTP')
+    parser.add_argument('--json', metavar='FILE',
+                        help='also write the results, with the commit and platform they were measured on, '
+                             'to FILE as JSON')
+    args = parser.parse_args()
+    rtt = args.rtt / 1000
+
+    benchmarks = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        certificates = [None]
+        if not args.no_tls:
+            certificate = make_certificate(tmpdir)
+            if certificate is None:
+                print('openssl not found, skipping HTTPS')
+            else:
+                certificates.append(certificate)
+        for certificate in certificates:
+            server, origin = start_server(certificate, rtt)
+            cafile = certificate[0] if certificate is not None else None
+            scheme = origin.split(':', 1)[0]
+            try:
+                results = run_redirects(server, origin, cafile, args.checks, args.hops)
+                print_results(f'{scheme}: {args.checks} checks following {args.hops} same-origin redirects', results)
+                benchmarks.append({'benchmark': 'redirects', 'scheme': scheme, 'checks': args.checks,
+                                   'hops': args.hops, 'rtt_ms': args.rtt, 'results': results})
+                for close in (False, True):
+                    if close and certificate is None:
+                        continue # Nothing to save when every connection is closed
+                    results = run_batch(server, origin, cafile, args.urls, args.workers, close)
+                    print_results(f'{scheme}: --bulk over {args.urls} URLs of one origin, {args.workers} workers'
+                                  + (', server closes every connection' if close else ''), results)
+                    benchmarks.append({'benchmark': 'bulk-close' if close else 'bulk', 'scheme': scheme,
+                                       'urls': args.urls, 'workers': args.workers, 'rtt_ms': args.rtt,
+                                       'results': results})
+            finally:
+                server.shutdown()
+                server.server_close()
+
+    if args.json:
+        write_json_results(args.json, benchmarks)
+
+if __name__ == '__main__':
+    main()
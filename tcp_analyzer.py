@@ -1,5 +1,34 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from functools import partial
+from heapq import heappop, heappush, heapreplace
+from itertools import chain, islice
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import contextlib
+import csv
+import glob
+import json
+import math
+import mmap
+import os
+import re
+import signal
+import socket
 import struct
 import sys
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 # Constants for header sizes and formats
 GLOBAL_HEADER_FORMAT = '<IHHIIII'
@@ -8,30 +37,216 @@ PACKET_HEADER_SIZE = 16
 ETHERNET_HEADER_SIZE = 14
 IP_HEADER_MIN_SIZE = 20
 TCP_HEADER_MIN_SIZE = 20
+IPV6_HEADER_SIZE = 40
+UDP_HEADER_SIZE = 8
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86DD
+IP_PROTOCOL_TCP = 6
+IP_PROTOCOL_UDP = 17
 
-def read_pcap_file(filename):
-    try:
-        with open(filename, 'rb') as f:
-            global_header = f.read(GLOBAL_HEADER_SIZE)
-            if len(global_header) < GLOBAL_HEADER_SIZE:
-                print('Error: Incomplete global header.')
-                sys.exit(1)
-            # Determine endianness
-            magic_number = struct.unpack('I', global_header[:4])[0]
-            if magic_number == 0xa1b2c3d4:
-                endian = '<'  # Little endian
-            elif magic_number == 0xd4c3b2a1:
-                endian = '>'  # Big endian
-            else:
-                print('Error: Unknown magic number. Not a valid PCAP file.')
-                sys.exit(1)
+# IPv6 extension headers stepped over to reach the transport header. Their
+# length byte counts 8-octet units beyond the first 8, except in fragment
+# headers (always 8 octets) and authentication headers (4-octet units
+# beyond the first 8).
+IPV6_FRAGMENT_HEADER = 44
+IPV6_AUTHENTICATION_HEADER = 51
+IPV6_EXTENSION_HEADERS = frozenset((
+    0,  # Hop-by-hop options
+    43,  # Routing
+    IPV6_FRAGMENT_HEADER,
+    IPV6_AUTHENTICATION_HEADER,
+    60,  # Destination options
+    135,  # Mobility
+    139,  # Host Identity Protocol
+    140  # Shim6
+))
+
+# TCP flag bits
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_PSH = 0x08
+TCP_ACK = 0x10
+TCP_URG = 0x20
+
+# TCP option kinds
+TCP_OPTION_END = 0
+TCP_OPTION_NOP = 1
+TCP_OPTION_MSS = 2
+TCP_OPTION_WSCALE = 3
+TCP_OPTION_SACK_PERMITTED = 4
+TCP_OPTION_SACK = 5
+TCP_OPTION_TIMESTAMPS = 8
+TCP_MAX_WINDOW_SHIFT = 14  # Larger window scale shifts are treated as 14 (RFC 7323)
+
+# UDP datagrams travel as segments with this bit set in place of TCP flags
+# (and no sequence numbers, window or options), so the TCP flag tests all
+# fail on them
+UDP_DATAGRAM = 0x100
+
+# The options of a SYN travel in its segment packed into one integer (0 for
+# other packets): the MSS in the low 16 bits, the window scale shift in the
+# next 8 and then which options were present
+OPTION_HAS_MSS = 1 << 24
+OPTION_HAS_WSCALE = 1 << 25
+OPTION_SACK_PERMITTED = 1 << 26
+OPTION_TIMESTAMPS = 1 << 27
+
+# Precompiled header layouts for the in-place (unpack_from) decode path
+ETHERTYPE_STRUCT = struct.Struct('!H')
+IPV4_HEADER_STRUCT = struct.Struct('!BBHHHBBHII')
+IPV6_HEADER_STRUCT = struct.Struct('!4xH2x16s16s')  # Payload length and addresses
+UDP_PORTS_STRUCT = struct.Struct('!HH')
+TRANSPORT_HEADER_MIN_SIZES = {IP_PROTOCOL_TCP: TCP_HEADER_MIN_SIZE, IP_PROTOCOL_UDP: UDP_HEADER_SIZE}
+TCP_HEADER_STRUCT = struct.Struct('!HHLLBBH')
+
+READ_CHUNK_SIZE = 1 << 20  # Bytes read from disk at a time in streaming mode
+FOLLOW_POLL_INTERVAL = 0.5  # Seconds to wait for more data in --follow mode
+
+# Capture containers: classic pcap with microsecond or nanosecond
+# timestamps, and pcapng
+PCAP_MAGIC_USEC = 0xa1b2c3d4
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+PCAPNG_SECTION_HEADER_BLOCK = 0x0A0D0D0A
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+
+# Link-layer header types (pcap LINKTYPE_* values)
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+VLAN_ETHERTYPES = (0x8100, 0x88a8, 0x9100)  # 802.1Q, 802.1ad and legacy QinQ tags
 
-            return endian, f.read()
+def parse_capture_header(header):
+    # Describe a capture from its first GLOBAL_HEADER_SIZE bytes: container
+    # format, byte order, timestamp divisor (classic pcap counts micro- or
+    # nanoseconds) and link-layer type. None if it is not a capture.
+    magic_number = struct.unpack('<I', header[:4])[0]
+    if magic_number == PCAPNG_SECTION_HEADER_BLOCK:
+        for endian in ('<', '>'):
+            if struct.unpack(endian + 'I', header[8:12])[0] == PCAPNG_BYTE_ORDER_MAGIC:
+                # Timestamp resolution and link type are per interface in pcapng
+                return {'format': 'pcapng', 'endian': endian, 'ts_divisor': None, 'link_type': None}
+        return None
+
+    for endian in ('<', '>'):
+        magic_number = struct.unpack(endian + 'I', header[:4])[0]
+        if magic_number in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC):
+            return {
+                'format': 'pcap',
+                'endian': endian,
+                'ts_divisor': 1e6 if magic_number == PCAP_MAGIC_USEC else 1e9,
+                'link_type': struct.unpack(endian + 'I', header[20:24])[0] & 0xFFFF
+            }
+    return None
+
+def open_capture(filename):
+    try:
+        f = open(filename, 'rb')
     except FileNotFoundError:
         print(f'Error: File {filename} not found.')
         sys.exit(1)
+    global_header = f.read(GLOBAL_HEADER_SIZE)
+    if len(global_header) < GLOBAL_HEADER_SIZE:
+        print('Error: Incomplete global header.')
+        sys.exit(1)
+    capture = parse_capture_header(global_header)
+    if capture is None:
+        print('Error: Unknown magic number. Not a valid PCAP file.')
+        sys.exit(1)
+    return f, capture
+
+def open_pcap_file(filename):
+    # Classic Ethernet pcap only, for the readers that hand out whole packet
+    # records (decode_packets only parses Ethernet)
+    f, capture = open_capture(filename)
+    if capture['format'] != 'pcap':
+        print('Error: pcapng captures are only read by the mmap decoders.')
+        sys.exit(1)
+    if capture['link_type'] != LINKTYPE_ETHERNET:
+        print(f'Error: Link-layer header type {capture["link_type"]} is only read by the mmap decoders.')
+        sys.exit(1)
+    return f, capture
+
+def warn_incomplete_packet(stats=None):
+    # With stats['quiet'] set the truncation is only recorded in stats
+    if stats is None or not stats.get('quiet'):
+        print('Warning: Incomplete packet data, skipping packet.')
+    if stats is not None:
+        stats['truncated'] = True
+
+# Why a decoder skipped a packet: its link layer does not carry IPv4 or
+# IPv6, it is IP but carries neither a TCP nor a UDP header (this includes
+# IPv6 fragments after the first), its headers are cut short or
+# inconsistent, or the packet filter rejected it. Decoders count these in
+# their skip branches only, and add the counts to stats once they are done.
+SKIP_REASONS = ('non_ip', 'non_tcp_udp', 'malformed', 'filtered')
+
+def new_skip_counts():
+    return dict.fromkeys(SKIP_REASONS, 0)
 
-def parse_packets(endian, data):
+def add_skip_counts(stats, skipped):
+    if stats is not None:
+        for reason, count in skipped.items():
+            stats[reason] = stats.get(reason, 0) + count
+
+def read_pcap_file(filename):
+    # The byte order, records and timestamp divisor of a capture, for
+    # parse_packets
+    f, capture = open_pcap_file(filename)
+    with f:
+        return capture['endian'], f.read(), capture['ts_divisor']
+
+def iter_packets(f, endian, chunk_size=READ_CHUNK_SIZE, ts_divisor=1e6):
+    # Yield packets one at a time, reading the file in fixed-size chunks so
+    # memory use does not depend on the size of the capture. ts_divisor is
+    # 1e9 for nanosecond captures.
+    record_header = struct.Struct(endian + 'IIII')
+    buf = b''
+    pos = 0
+    first_timestamp = None
+
+    while True:
+        available = len(buf) - pos
+        if available >= PACKET_HEADER_SIZE:
+            ts_sec, ts_frac, incl_len, orig_len = record_header.unpack_from(buf, pos)
+            end = pos + PACKET_HEADER_SIZE + incl_len
+            if end <= len(buf):
+                packet_data = buf[pos + PACKET_HEADER_SIZE:end]
+                pos = end
+
+                # Calculate relative timestamp
+                timestamp = ts_sec + ts_frac / ts_divisor
+                if first_timestamp is None:
+                    first_timestamp = timestamp
+                yield {
+                    'timestamp': timestamp - first_timestamp,
+                    'data': packet_data
+                }
+                continue
+            needed = end - len(buf)
+        else:
+            needed = PACKET_HEADER_SIZE - available
+
+        # Refill the buffer, keeping only the unconsumed tail
+        chunk = f.read(max(chunk_size, needed))
+        if not chunk:
+            break
+        buf = buf[pos:] + chunk
+        pos = 0
+
+    if len(buf) - pos >= PACKET_HEADER_SIZE:
+        warn_incomplete_packet()
+
+def stream_pcap_file(filename, chunk_size=READ_CHUNK_SIZE):
+    f, capture = open_pcap_file(filename)
+    with f:
+        yield from iter_packets(f, capture['endian'], chunk_size, capture['ts_divisor'])
+
+def parse_packets(endian, data, ts_divisor=1e6):
     packets = []
     offset = 0
     first_timestamp = None
@@ -42,20 +257,20 @@ def parse_packets(endian, data):
 
         # Parse packet header
         packet_header = data[offset:offset + PACKET_HEADER_SIZE]
-        ts_sec, ts_usec, incl_len, orig_len = struct.unpack(endian + 'IIII', packet_header)
+        ts_sec, ts_frac, incl_len, orig_len = struct.unpack(endian + 'IIII', packet_header)
         offset += PACKET_HEADER_SIZE
 
         # Parse packet data
         packet_data = data[offset:offset + incl_len]
         if len(packet_data) < incl_len:
-            print('Warning: Incomplete packet data, skipping packet.')
+            warn_incomplete_packet()
             offset += incl_len
             continue  # Skip this packet
 
         offset += incl_len
 
         # Calculate relative timestamp
-        timestamp = ts_sec + ts_usec / 1e6
+        timestamp = ts_sec + ts_frac / ts_divisor
         if first_timestamp is None:
             first_timestamp = timestamp
         relative_timestamp = timestamp - first_timestamp
@@ -73,7 +288,12 @@ def parse_ethernet_header(packet_data):
     eth_header = packet_data[:ETHERNET_HEADER_SIZE]
     eth_fields = struct.unpack('!6s6sH', eth_header)
     eth_type = eth_fields[2]
-    return eth_type, packet_data[ETHERNET_HEADER_SIZE:]
+    header_size = ETHERNET_HEADER_SIZE
+    # Skip 802.1Q / 802.1ad VLAN tags to the encapsulated ethertype
+    while eth_type in VLAN_ETHERTYPES and len(packet_data) >= header_size + 4:
+        eth_type = ETHERTYPE_STRUCT.unpack_from(packet_data, header_size + 2)[0]
+        header_size += 4
+    return eth_type, packet_data[header_size:]
 
 def parse_ip_header(packet_data):
     if len(packet_data) < IP_HEADER_MIN_SIZE:
@@ -84,22 +304,62 @@ def parse_ip_header(packet_data):
     if len(packet_data) < ip_header_length:
         return None, None, None
     ip_header = packet_data[:ip_header_length]
-    ip_fields = struct.unpack('!BBHHHBBH4s4s', ip_header[:20])
+    ip_fields = IPV4_HEADER_STRUCT.unpack(ip_header[:20])
     protocol = ip_fields[6]
-    src_ip = ip_fields[8]
-    dst_ip = ip_fields[9]
     total_length = ip_fields[2]
     return {
-        'src_ip': '.'.join(map(str, src_ip)),
-        'dst_ip': '.'.join(map(str, dst_ip)),
+        'src_addr': ip_fields[8],
+        'dst_addr': ip_fields[9],
         'header_length': ip_header_length,
         'total_length': total_length,
         'protocol': protocol
     }, packet_data[ip_header_length:], ip_header_length
 
+def ipv6_transport_header(buf, ip_start, end):
+    # (protocol, offset) of the header that follows the IPv6 header at
+    # ip_start and its extension headers. protocol is None for a fragment
+    # after the first, which carries no transport header, and offset is -1
+    # if the extension headers run past end.
+    protocol = buf[ip_start + 6]
+    offset = ip_start + IPV6_HEADER_SIZE
+    while protocol in IPV6_EXTENSION_HEADERS:
+        if end - offset < 8:
+            return protocol, -1
+        if protocol == IPV6_FRAGMENT_HEADER:
+            if (buf[offset + 2] << 8 | buf[offset + 3]) & 0xFFF8:
+                return None, offset
+            length = 8
+        elif protocol == IPV6_AUTHENTICATION_HEADER:
+            length = (buf[offset + 1] + 2) * 4
+        else:
+            length = (buf[offset + 1] + 1) * 8
+        protocol = buf[offset]
+        offset += length
+    if offset > end:
+        return protocol, -1
+    return protocol, offset
+
+def parse_ipv6_header(packet_data):
+    # The IPv6 header and its extension headers, in parse_ip_header's terms:
+    # header_length covers the extension headers and protocol is the
+    # transport protocol after them
+    if len(packet_data) < IPV6_HEADER_SIZE:
+        return None, None, None
+    payload_length, src_addr, dst_addr = IPV6_HEADER_STRUCT.unpack_from(packet_data)
+    protocol, header_length = ipv6_transport_header(packet_data, 0, len(packet_data))
+    if header_length < 0:
+        return None, None, None
+    return {
+        'src_addr': IPV6_ADDRESS_TAG | int.from_bytes(src_addr, 'big'),
+        'dst_addr': IPV6_ADDRESS_TAG | int.from_bytes(dst_addr, 'big'),
+        'header_length': header_length,
+        'total_length': IPV6_HEADER_SIZE + payload_length,
+        'protocol': protocol
+    }, packet_data[header_length:], header_length
+
 def parse_tcp_header(packet_data):
     if len(packet_data) < TCP_HEADER_MIN_SIZE:
-        return None, None
+        return None, None, None
     tcp_header = packet_data[:TCP_HEADER_MIN_SIZE]
     tcp_fields = struct.unpack('!HHLLBBHHH', tcp_header)
     src_port = tcp_fields[0]
@@ -111,7 +371,8 @@ def parse_tcp_header(packet_data):
     window_size = tcp_fields[6]
     data_offset = (offset_reserved >> 4) * 4
     if len(packet_data) < data_offset:
-        return None, None
+        return None, None, None
+    options = parse_tcp_options(packet_data, TCP_HEADER_MIN_SIZE, data_offset) if flags & TCP_SYN else 0
     return {
         'src_port': src_port,
         'dst_port': dst_port,
@@ -126,108 +387,2226 @@ def parse_tcp_header(packet_data):
             'ACK': (flags & 0x10) >> 4,
             'URG': (flags & 0x20) >> 5
         },
-        'window_size': window_size
+        'flag_bits': flags,
+        'window_size': window_size,
+        'options': options,
+        'options_data': packet_data[TCP_HEADER_MIN_SIZE:data_offset]
     }, packet_data[data_offset:], data_offset
 
-def analyze_packets(packets):
-    connections = {}
-    connection_count = 0
+def parse_udp_header(packet_data):
+    if len(packet_data) < UDP_HEADER_SIZE:
+        return None, None, None
+    src_port, dst_port, length, _ = struct.unpack('!HHHH', packet_data[:UDP_HEADER_SIZE])
+    return {
+        'src_port': src_port,
+        'dst_port': dst_port,
+        'length': length
+    }, packet_data[UDP_HEADER_SIZE:], UDP_HEADER_SIZE
 
-    for packet in packets:
-        packet_data = packet['data']
-        timestamp = packet['timestamp']
+def parse_tcp_options(buf, offset, end):
+    # Pack the handshake options found between offset and end (see
+    # OPTION_HAS_MSS). SACK blocks are stepped over; tcp_sack_blocks decodes
+    # them for the callers that need them.
+    options = 0
+    while offset < end:
+        kind = buf[offset]
+        if kind == TCP_OPTION_END:
+            break
+        if kind == TCP_OPTION_NOP:
+            offset += 1
+            continue
+        if offset + 2 > end:
+            break
+        length = buf[offset + 1]
+        if length < 2 or offset + length > end:
+            break  # Malformed option list
+        if kind == TCP_OPTION_MSS and length == 4:
+            options |= OPTION_HAS_MSS | (buf[offset + 2] << 8) | buf[offset + 3]
+        elif kind == TCP_OPTION_WSCALE and length == 3:
+            options |= OPTION_HAS_WSCALE | (min(buf[offset + 2], TCP_MAX_WINDOW_SHIFT) << 16)
+        elif kind == TCP_OPTION_SACK_PERMITTED and length == 2:
+            options |= OPTION_SACK_PERMITTED
+        elif kind == TCP_OPTION_TIMESTAMPS and length == 10:
+            options |= OPTION_TIMESTAMPS
+        offset += length
+    return options
+
+def tcp_options(options):
+    # Unpack a parse_tcp_options value into a dict
+    return {
+        'mss': options & 0xFFFF if options & OPTION_HAS_MSS else None,
+        'window_scale': (options >> 16) & 0xFF if options & OPTION_HAS_WSCALE else None,
+        'sack_permitted': bool(options & OPTION_SACK_PERMITTED),
+        'timestamps': bool(options & OPTION_TIMESTAMPS)
+    }
+
+def tcp_sack_blocks(buf, offset=0, end=None):
+    # (left edge, right edge) sequence number pairs of the SACK option
+    # between offset and end, e.g. a TCP header's 'options_data'
+    if end is None:
+        end = len(buf)
+    while offset < end:
+        kind = buf[offset]
+        if kind == TCP_OPTION_END:
+            break
+        if kind == TCP_OPTION_NOP:
+            offset += 1
+            continue
+        if offset + 2 > end:
+            break
+        length = buf[offset + 1]
+        if length < 2 or offset + length > end:
+            break
+        if kind == TCP_OPTION_SACK:
+            return [struct.unpack_from('!II', buf, block) for block in range(offset + 2, offset + length - 7, 8)]
+        offset += length
+    return []
+
+# Addresses are kept as integers: IPv4 addresses as they are, IPv6 ones
+# with IPV6_ADDRESS_TAG set above their 128 bits so the two never collide
+IPV4_ADDRESS_MAX = 0xFFFFFFFF
+IPV6_ADDRESS_TAG = 1 << 128
+
+# Flow keys pack two endpoints (a tagged address and a port) of
+# FLOW_ENDPOINT_BITS each, with FLOW_KEY_UDP set for UDP flows so that they
+# never share a key with a TCP connection between the same endpoints
+FLOW_ENDPOINT_BITS = 145
+FLOW_KEY_UDP = 1 << (2 * FLOW_ENDPOINT_BITS)
+
+def format_address(addr):
+    # Addresses are only turned into text for output
+    if addr > IPV4_ADDRESS_MAX:
+        return socket.inet_ntop(socket.AF_INET6, (addr ^ IPV6_ADDRESS_TAG).to_bytes(16, 'big'))
+    return socket.inet_ntoa(addr.to_bytes(4, 'big'))
+
+def flow_key(src_addr, src_port, dst_addr, dst_port, udp=False):
+    # Both directions of a flow share one key: the two (address, port)
+    # endpoints, lower endpoint first
+    src_endpoint = (src_addr << 16) | src_port
+    dst_endpoint = (dst_addr << 16) | dst_port
+    if src_endpoint < dst_endpoint:
+        key = (src_endpoint << FLOW_ENDPOINT_BITS) | dst_endpoint
+    else:
+        key = (dst_endpoint << FLOW_ENDPOINT_BITS) | src_endpoint
+    return key | FLOW_KEY_UDP if udp else key
+
+# Packet filters (--filter): a small BPF-like language, compiled once into
+# predicates the decoders run on a packet's header bytes before decoding
+# it. Primitives are [src|dst] host ADDR, [src|dst] net ADDR/BITS (IPv4 or
+# IPv6), [src|dst] port N, [src|dst] portrange N-M, the protocols tcp, udp,
+# ip and ip6 and the TCP flags tcp-fin, tcp-syn, tcp-rst, tcp-push, tcp-ack
+# and tcp-urg (flag set), combined with and / &&, or / ||, not / ! and
+# parentheses.
+FILTER_TOKEN_PATTERN = re.compile(r'\s*(?:(\(|\)|&&|\|\||!)|([^\s()!&|]+))')
+FILTER_FLAGS = {
+    'tcp-fin': TCP_FIN,
+    'tcp-syn': TCP_SYN,
+    'tcp-rst': TCP_RST,
+    'tcp-push': TCP_PSH,
+    'tcp-ack': TCP_ACK,
+    'tcp-urg': TCP_URG
+}
+FILTER_PROTOCOLS = {'tcp': IP_PROTOCOL_TCP, 'udp': IP_PROTOCOL_UDP}
+
+# How a compiled filter reads header fields and combines tests, for each
+# kind of predicate: raw header bytes of IPv4 and IPv6 packets (buf, the
+# offsets of the IP and transport headers and the transport protocol), a
+# NumPy array of FIXED_HEADERS_DTYPE headers (IPv4 TCP only, one result per
+# packet) and a decoded segment tuple. family is the address family a
+# predicate sees, so that tests on addresses of the other family compile
+# to 'false'.
+FILTER_TARGETS = {
+    'bytes': {
+        'args': 'buf, ip, transport, protocol',
+        'family': 4,
+        'src_addr': 'unpack_address(buf, ip + 12)[0]',
+        'dst_addr': 'unpack_address(buf, ip + 16)[0]',
+        'src_port': '(buf[transport] << 8 | buf[transport + 1])',
+        'dst_port': '(buf[transport + 2] << 8 | buf[transport + 3])',
+        'flags': f'(protocol == {IP_PROTOCOL_TCP} and buf[transport + 13] & {{bits}} != 0)',
+        'protocol': '(protocol == {protocol})',
+        'ipv6': 'False',
+        'false': 'False',
+        'range': '({low} <= {field} <= {high})',
+        'and': ' and ',
+        'or': ' or ',
+        'not': 'not '
+    },
+    'bytes6': {
+        'args': 'buf, ip, transport, protocol',
+        'family': 6,
+        'src_addr': 'ipv6_address(buf, ip + 8)',
+        'dst_addr': 'ipv6_address(buf, ip + 24)',
+        'src_port': '(buf[transport] << 8 | buf[transport + 1])',
+        'dst_port': '(buf[transport + 2] << 8 | buf[transport + 3])',
+        'flags': f'(protocol == {IP_PROTOCOL_TCP} and buf[transport + 13] & {{bits}} != 0)',
+        'protocol': '(protocol == {protocol})',
+        'ipv6': 'True',
+        'false': 'False',
+        'range': '({low} <= {field} <= {high})',
+        'and': ' and ',
+        'or': ' or ',
+        'not': 'not '
+    },
+    'numpy': {
+        'args': 'headers',
+        'family': 4,
+        'src_addr': "headers['src_addr']",
+        'dst_addr': "headers['dst_addr']",
+        'src_port': "headers['src_port']",
+        'dst_port': "headers['dst_port']",
+        'flags': "(headers['flags'] & {bits} != 0)",
+        'protocol': "(headers['protocol'] == {protocol})",
+        'ipv6': 'np.zeros(len(headers), dtype=bool)',
+        'false': 'np.zeros(len(headers), dtype=bool)',
+        'range': '(({field} >= {low}) & ({field} <= {high}))',
+        'and': ' & ',
+        'or': ' | ',
+        'not': '~'
+    },
+    'segment': {
+        'args': 'segment',
+        'family': None,
+        'src_addr': 'segment[1]',
+        'dst_addr': 'segment[3]',
+        'src_port': 'segment[2]',
+        'dst_port': 'segment[4]',
+        'flags': '(segment[7] & {bits} != 0)',
+        'protocol': f'(({IP_PROTOCOL_UDP} if segment[7] & {UDP_DATAGRAM} else {IP_PROTOCOL_TCP}) == {{protocol}})',
+        'ipv6': f'(segment[1] > {IPV4_ADDRESS_MAX})',
+        'false': 'False',
+        'range': '({low} <= {field} <= {high})',
+        'and': ' and ',
+        'or': ' or ',
+        'not': 'not '
+    }
+}
+
+def parse_packet_filter(expression):
+    # Parse a filter expression into a tree of ('and', a, b), ('or', a, b),
+    # ('not', a), ('host', direction, address), ('net', direction, network,
+    # mask), ('portrange', direction, low, high), ('flags', bits),
+    # ('protocol', number) and ('family', 4 or 6) nodes; direction is 'src',
+    # 'dst' or None for either. Raises ValueError.
+    tokens = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = FILTER_TOKEN_PATTERN.match(expression, position)
+        if match is None:
+            raise ValueError(f'cannot parse {expression[position:]!r}')
+        tokens.append(match.group(1) or match.group(2).lower())
+        position = match.end()
+    if not tokens:
+        raise ValueError('empty filter')
+    tokens.append(None)
+    position = 0
+
+    def take():
+        nonlocal position
+        token = tokens[position]
+        if token is None:
+            raise ValueError('unexpected end of filter')
+        position += 1
+        return token
+
+    def parse_or():
+        node = parse_and()
+        while tokens[position] in ('or', '||'):
+            take()
+            node = ('or', node, parse_and())
+        return node
+
+    def parse_and():
+        node = parse_not()
+        while tokens[position] in ('and', '&&'):
+            take()
+            node = ('and', node, parse_not())
+        return node
+
+    def parse_not():
+        if tokens[position] in ('not', '!'):
+            take()
+            return ('not', parse_not())
+        if tokens[position] == '(':
+            take()
+            node = parse_or()
+            if take() != ')':
+                raise ValueError("missing ')'")
+            return node
+        return parse_primitive()
+
+    def parse_primitive():
+        token = take()
+        direction = None
+        if token in ('src', 'dst'):
+            direction = token
+            token = take()
+        if token == 'host':
+            return ('host', direction, parse_filter_address(take()))
+        if token == 'net':
+            return ('net', direction) + parse_filter_network(take())
+        if token == 'port':
+            port = parse_filter_port(take())
+            return ('portrange', direction, port, port)
+        if token == 'portrange':
+            low, _, high = take().partition('-')
+            low, high = parse_filter_port(low), parse_filter_port(high)
+            if low > high:
+                raise ValueError(f'empty port range {low}-{high}')
+            return ('portrange', direction, low, high)
+        if direction is None:
+            if token in FILTER_FLAGS:
+                return ('flags', FILTER_FLAGS[token])
+            if token in FILTER_PROTOCOLS:
+                return ('protocol', FILTER_PROTOCOLS[token])
+            if token in ('ip', 'ip6'):
+                return ('family', 6 if token == 'ip6' else 4)
+        raise ValueError(f'unexpected {token!r}')
+
+    node = parse_or()
+    if tokens[position] is not None:
+        raise ValueError(f'unexpected {tokens[position]!r}')
+    return node
+
+def parse_filter_address(text):
+    # Dotted quad or IPv6 address to integer (see IPV6_ADDRESS_TAG)
+    if ':' in text:
+        try:
+            return IPV6_ADDRESS_TAG | int.from_bytes(socket.inet_pton(socket.AF_INET6, text), 'big')
+        except OSError:
+            pass
+    elif text.count('.') == 3:
+        try:
+            return int.from_bytes(socket.inet_aton(text), 'big')
+        except OSError:
+            pass
+    raise ValueError(f'bad address {text!r}')
+
+def parse_filter_network(text):
+    # ADDR/BITS (or a single address) to (network, mask). An IPv6 mask
+    # keeps the tag bit, so IPv4 addresses never match an IPv6 network.
+    address, _, bits = text.partition('/')
+    address = parse_filter_address(address)
+    address_bits = 128 if address > IPV4_ADDRESS_MAX else 32
+    bits = bits or str(address_bits)
+    if not bits.isdigit() or int(bits) > address_bits:
+        raise ValueError(f'bad network {text!r}')
+    all_ones = (1 << address_bits) - 1
+    mask = (all_ones << (address_bits - int(bits))) & all_ones
+    if address_bits == 128:
+        mask |= IPV6_ADDRESS_TAG
+    return address & mask, mask
+
+def parse_filter_port(text):
+    if not text.isdigit() or int(text) > 0xFFFF:
+        raise ValueError(f'bad port {text!r}')
+    return int(text)
 
+def packet_filter_source(node, target):
+    # Python expression for a parsed filter in one of FILTER_TARGETS
+    kind = node[0]
+    if kind in ('and', 'or'):
+        return '(' + packet_filter_source(node[1], target) + target[kind] + packet_filter_source(node[2], target) + ')'
+    if kind == 'not':
+        return '(' + target['not'] + packet_filter_source(node[1], target) + ')'
+    if kind == 'flags':
+        return target['flags'].format(bits=node[1])
+    if kind == 'protocol':
+        return target['protocol'].format(protocol=node[1])
+    if kind == 'family':
+        return target['ipv6'] if node[1] == 6 else '(' + target['not'] + target['ipv6'] + ')'
+    if kind in ('host', 'net') and target['family'] is not None:
+        if (node[2] > IPV4_ADDRESS_MAX) != (target['family'] == 6):
+            return target['false']
+    elif kind == 'net':
+        # Both families: the tag bit in the mask keeps IPv6 addresses out of
+        # IPv4 networks
+        node = node[:3] + (node[3] | IPV6_ADDRESS_TAG,)
+    direction = node[1]
+    tests = []
+    for side in (direction,) if direction else ('src', 'dst'):
+        if kind == 'host':
+            tests.append(f'({target[side + "_addr"]} == {node[2]})')
+        elif kind == 'net':
+            tests.append(f'({target[side + "_addr"]} & {node[3]} == {node[2]})')
+        elif node[2] == node[3]:
+            tests.append(f'({target[side + "_port"]} == {node[2]})')
+        else:
+            tests.append(target['range'].format(field=target[side + '_port'], low=node[2], high=node[3]))
+    return '(' + target['or'].join(tests) + ')'
+
+def compile_packet_filter(expression):
+    # A packet filter: the expression and a predicate per FILTER_TARGETS
+    # entry. Raises ValueError if the expression does not parse.
+    node = parse_packet_filter(expression)
+    packet_filter = {'expression': expression}
+    namespace = {
+        'unpack_address': struct.Struct('!I').unpack_from,
+        'ipv6_address': lambda buf, offset: IPV6_ADDRESS_TAG | int.from_bytes(buf[offset:offset + 16], 'big'),
+        'np': np
+    }
+    for name, target in FILTER_TARGETS.items():
+        source = f'lambda {target["args"]}: {packet_filter_source(node, target)}'
+        packet_filter[name] = eval(compile(source, '<filter>', 'eval'), namespace)
+    return packet_filter
+
+# A decoded segment is a flat tuple:
+# (timestamp, src_addr, src_port, dst_addr, dst_port, seq_num, ack_num,
+#  flag_bits, window_size, payload_size, options)
+# with addresses as integers (see IPV6_ADDRESS_TAG). window_size is the raw
+# header field and options the packed SYN options (see parse_tcp_options),
+# 0 unless the packet is a SYN carrying options. A UDP datagram has
+# flag_bits UDP_DATAGRAM and zero sequence numbers, window and options.
+
+def decode_packets(packets, stats=None):
+    # Decode packet dicts with the parse_*_header functions
+    skipped = new_skip_counts()
+    for packet in packets:
         # Parse Ethernet header
-        eth_type, ip_data = parse_ethernet_header(packet_data)
-        if eth_type != 0x0800:  # Only process IPv4 packets
+        eth_type, ip_data = parse_ethernet_header(packet['data'])
+        if eth_type == ETHERTYPE_IPV4:
+            ip_header, transport_data, ip_header_length = parse_ip_header(ip_data)
+        elif eth_type == ETHERTYPE_IPV6:
+            ip_header, transport_data, ip_header_length = parse_ipv6_header(ip_data)
+        else:  # Only process IP packets
+            skipped['non_ip' if eth_type is not None else 'malformed'] += 1
+            continue
+
+        # Only process TCP and UDP packets
+        if not ip_header or ip_header['protocol'] not in (IP_PROTOCOL_TCP, IP_PROTOCOL_UDP):
+            skipped['non_tcp_udp' if ip_header else 'malformed'] += 1
             continue
+        ip_payload_length = ip_header['total_length'] - ip_header['header_length']
 
-        # Parse IP header
-        ip_header, tcp_data, ip_header_length = parse_ip_header(ip_data)
-        if not ip_header or ip_header['protocol'] != 6:  # Only process TCP packets
+        if ip_header['protocol'] == IP_PROTOCOL_UDP:
+            udp_header, payload, udp_header_length = parse_udp_header(transport_data)
+            if not udp_header:
+                skipped['malformed'] += 1
+                continue
+            yield (
+                packet['timestamp'],
+                ip_header['src_addr'],
+                udp_header['src_port'],
+                ip_header['dst_addr'],
+                udp_header['dst_port'],
+                0, 0, UDP_DATAGRAM, 0,
+                ip_payload_length - udp_header_length,
+                0
+            )
             continue
 
         # Parse TCP header
-        tcp_header, payload, tcp_header_length = parse_tcp_header(tcp_data)
+        tcp_header, payload, tcp_header_length = parse_tcp_header(transport_data)
         if not tcp_header:
+            skipped['malformed'] += 1
             continue
 
-        # Identify connection by tuple (src_ip, src_port, dst_ip, dst_port)
-        conn_tuple = (
-            ip_header['src_ip'],
+        yield (
+            packet['timestamp'],
+            ip_header['src_addr'],
             tcp_header['src_port'],
-            ip_header['dst_ip'],
-            tcp_header['dst_port']
-        )
-        rev_conn_tuple = (
-            ip_header['dst_ip'],
+            ip_header['dst_addr'],
             tcp_header['dst_port'],
-            ip_header['src_ip'],
-            tcp_header['src_port']
+            tcp_header['seq_num'],
+            tcp_header['ack_num'],
+            tcp_header['flag_bits'],
+            tcp_header['window_size'],
+            ip_payload_length - tcp_header['data_offset'],
+            tcp_header['options']
+        )
+    add_skip_counts(stats, skipped)
+
+def decode_buffer(buf, endian, offset=GLOBAL_HEADER_SIZE, end=None, first_timestamp=None, stats=None,
+                  ts_divisor=1e6, packet_filter=None):
+    # Decode Ethernet packet records straight out of a buffer (bytes, mmap
+    # or memoryview) with unpack_from, without slicing out any packet bytes.
+    # Timestamps are relative to first_timestamp, or to the first record;
+    # ts_divisor is 1e9 for nanosecond captures. stats['truncated'] is set
+    # if the buffer ends in an incomplete record, stats['next_offset'] is
+    # where the record walk stopped (end, unless the buffer ends in part of
+    # a record), and skipped packets are counted in stats by reason. Packets
+    # packet_filter (see compile_packet_filter) rejects are skipped before
+    # being decoded.
+    # IPv4 TCP, by far the most common, is decoded inline; UDP and IPv6
+    # packets go through decode_ipv4 and decode_ipv6.
+    if end is None:
+        end = len(buf)
+    unpack_record = struct.Struct(endian + 'IIII').unpack_from
+    unpack_ip = IPV4_HEADER_STRUCT.unpack_from
+    unpack_tcp = TCP_HEADER_STRUCT.unpack_from
+    matches = packet_filter['bytes'] if packet_filter is not None else None
+    skipped = new_skip_counts()
+
+    while offset + PACKET_HEADER_SIZE <= end:
+        ts_sec, ts_usec, incl_len, orig_len = unpack_record(buf, offset)
+        packet_start = offset + PACKET_HEADER_SIZE
+        packet_end = packet_start + incl_len
+        if packet_end > end:
+            warn_incomplete_packet(stats)
+            break
+        offset = packet_end
+
+        # Calculate relative timestamp
+        timestamp = ts_sec + ts_usec / ts_divisor
+        if first_timestamp is None:
+            first_timestamp = timestamp
+
+        # Ethernet: IPv4 (ethertype 0x0800) or IPv6, possibly VLAN-tagged
+        if incl_len < ETHERNET_HEADER_SIZE:
+            skipped['malformed'] += 1
+            continue
+        if buf[packet_start + 12] == 0x08 and buf[packet_start + 13] == 0x00:
+            ip_start = packet_start + ETHERNET_HEADER_SIZE
+        else:
+            ip_start = ethernet_network_offset(buf, packet_start, packet_end)
+            if ip_start < 0:
+                skipped['non_ip'] += 1
+                continue
+            if buf[ip_start - 2] == ETHERTYPE_IPV6 >> 8:
+                fields = decode_ipv6(buf, ip_start, packet_end, packet_filter, skipped)
+                if fields is not None:
+                    yield (timestamp - first_timestamp,) + fields
+                continue
+
+        # IPv4: TCP here, UDP through decode_ipv4. The header must be whole
+        # before the filter reads the ports after it.
+        if packet_end - ip_start < IP_HEADER_MIN_SIZE:
+            skipped['malformed'] += 1
+            continue
+        ip_header_length = (buf[ip_start] & 0x0F) * 4
+        if ip_header_length < IP_HEADER_MIN_SIZE or packet_end - ip_start < ip_header_length:
+            skipped['malformed'] += 1
+            continue
+        tcp_start = ip_start + ip_header_length
+        if matches is not None and buf[ip_start + 9] == IP_PROTOCOL_TCP:
+            if packet_end - tcp_start >= TCP_HEADER_MIN_SIZE and not matches(buf, ip_start, tcp_start,
+                                                                             IP_PROTOCOL_TCP):
+                skipped['filtered'] += 1
+                continue
+        _, _, total_length, _, _, _, protocol, _, src_addr, dst_addr = unpack_ip(buf, ip_start)
+        if protocol != IP_PROTOCOL_TCP:
+            if protocol == IP_PROTOCOL_UDP:
+                fields = decode_ipv4(buf, ip_start, packet_end, packet_filter, skipped)
+                if fields is not None:
+                    yield (timestamp - first_timestamp,) + fields
+            else:
+                skipped['non_tcp_udp'] += 1
+            continue
+
+        # TCP
+        if packet_end - tcp_start < TCP_HEADER_MIN_SIZE:
+            skipped['malformed'] += 1
+            continue
+        src_port, dst_port, seq_num, ack_num, offset_reserved, flags, window_size = unpack_tcp(buf, tcp_start)
+        data_offset = (offset_reserved >> 4) * 4
+        if packet_end - tcp_start < data_offset:
+            skipped['malformed'] += 1
+            continue
+
+        # Options are only read from SYNs, where the handshake settles them
+        yield (
+            timestamp - first_timestamp,
+            src_addr, src_port, dst_addr, dst_port,
+            seq_num, ack_num, flags, window_size,
+            total_length - ip_header_length - data_offset,
+            parse_tcp_options(buf, tcp_start + TCP_HEADER_MIN_SIZE, tcp_start + data_offset)
+            if flags & TCP_SYN and data_offset > TCP_HEADER_MIN_SIZE else 0
+        )
+    if stats is not None:
+        stats['next_offset'] = offset
+    add_skip_counts(stats, skipped)
+
+# Per-packet decoders: each returns the segment fields after the timestamp
+# for the packet ending at packet_end, or None if it is not a well-formed
+# TCP or UDP packet or the packet filter rejects it, counted in skipped
+# (decode_buffer inlines the same steps for IPv4 TCP over Ethernet)
+def decode_ethernet(buf, packet_start, packet_end, packet_filter, skipped):
+    if packet_end - packet_start < ETHERNET_HEADER_SIZE:
+        skipped['malformed'] += 1
+        return None
+    ip_start = ethernet_network_offset(buf, packet_start, packet_end)
+    if ip_start < 0:
+        skipped['non_ip'] += 1
+        return None
+    if buf[ip_start - 2] == ETHERTYPE_IPV6 >> 8:
+        return decode_ipv6(buf, ip_start, packet_end, packet_filter, skipped)
+    return decode_ipv4(buf, ip_start, packet_end, packet_filter, skipped)
+
+def decode_ip(buf, ip_start, packet_end, packet_filter, skipped):
+    # The IP packet at ip_start, by its version
+    if ip_start < packet_end and buf[ip_start] >> 4 == 6:
+        return decode_ipv6(buf, ip_start, packet_end, packet_filter, skipped)
+    return decode_ipv4(buf, ip_start, packet_end, packet_filter, skipped)
+
+def decode_ipv4(buf, ip_start, packet_end, packet_filter, skipped):
+    if packet_end - ip_start < IP_HEADER_MIN_SIZE:
+        skipped['malformed'] += 1
+        return None
+    version_ihl, _, total_length, _, _, _, protocol, _, src_addr, dst_addr = IPV4_HEADER_STRUCT.unpack_from(buf, ip_start)
+    ip_header_length = (version_ihl & 0x0F) * 4
+    if ip_header_length < IP_HEADER_MIN_SIZE or packet_end - ip_start < ip_header_length:
+        skipped['malformed'] += 1
+        return None
+    if protocol != IP_PROTOCOL_TCP and protocol != IP_PROTOCOL_UDP:
+        skipped['non_tcp_udp'] += 1
+        return None
+    transport_start = ip_start + ip_header_length
+    if packet_filter is not None and packet_end - transport_start >= TRANSPORT_HEADER_MIN_SIZES[protocol]:
+        if not packet_filter['bytes'](buf, ip_start, transport_start, protocol):
+            skipped['filtered'] += 1
+            return None
+    return decode_transport(buf, protocol, transport_start, packet_end, src_addr, dst_addr,
+                            total_length - ip_header_length, skipped)
+
+def decode_ipv6(buf, ip_start, packet_end, packet_filter, skipped):
+    if packet_end - ip_start < IPV6_HEADER_SIZE:
+        skipped['malformed'] += 1
+        return None
+    protocol, transport_start = ipv6_transport_header(buf, ip_start, packet_end)
+    if transport_start < 0:
+        skipped['malformed'] += 1
+        return None
+    if protocol != IP_PROTOCOL_TCP and protocol != IP_PROTOCOL_UDP:
+        skipped['non_tcp_udp'] += 1
+        return None
+    if packet_filter is not None and packet_end - transport_start >= TRANSPORT_HEADER_MIN_SIZES[protocol]:
+        if not packet_filter['bytes6'](buf, ip_start, transport_start, protocol):
+            skipped['filtered'] += 1
+            return None
+    payload_length, src_addr, dst_addr = IPV6_HEADER_STRUCT.unpack_from(buf, ip_start)
+    return decode_transport(buf, protocol, transport_start, packet_end,
+                            IPV6_ADDRESS_TAG | int.from_bytes(src_addr, 'big'),
+                            IPV6_ADDRESS_TAG | int.from_bytes(dst_addr, 'big'),
+                            payload_length - (transport_start - ip_start - IPV6_HEADER_SIZE), skipped)
+
+def decode_transport(buf, protocol, transport_start, packet_end, src_addr, dst_addr, ip_payload_length, skipped):
+    # The TCP or UDP header at transport_start; ip_payload_length is the
+    # length the IP header gives for it and the data after it
+    if packet_end - transport_start < TRANSPORT_HEADER_MIN_SIZES[protocol]:
+        skipped['malformed'] += 1
+        return None
+    if protocol == IP_PROTOCOL_UDP:
+        src_port, dst_port = UDP_PORTS_STRUCT.unpack_from(buf, transport_start)
+        return (src_addr, src_port, dst_addr, dst_port, 0, 0, UDP_DATAGRAM, 0, ip_payload_length - UDP_HEADER_SIZE, 0)
+    src_port, dst_port, seq_num, ack_num, offset_reserved, flags, window_size = TCP_HEADER_STRUCT.unpack_from(
+        buf, transport_start)
+    data_offset = (offset_reserved >> 4) * 4
+    if packet_end - transport_start < data_offset:
+        skipped['malformed'] += 1
+        return None
+    return (src_addr, src_port, dst_addr, dst_port, seq_num, ack_num, flags, window_size,
+            ip_payload_length - data_offset,
+            parse_tcp_options(buf, transport_start + TCP_HEADER_MIN_SIZE, transport_start + data_offset)
+            if flags & TCP_SYN and data_offset > TCP_HEADER_MIN_SIZE else 0)
+
+# Link-layer decoders: each returns the offset of the IPv4 or IPv6 header
+# of the packet between start and end, or -1 if the packet carries neither
+def ethernet_network_offset(buf, start, end):
+    # Ethernet II, after any 802.1Q / 802.1ad VLAN tags
+    offset = start + 12
+    while offset + 2 <= end:
+        eth_type = (buf[offset] << 8) | buf[offset + 1]
+        if eth_type == ETHERTYPE_IPV4 or eth_type == ETHERTYPE_IPV6:
+            return offset + 2
+        if eth_type not in VLAN_ETHERTYPES:
+            return -1
+        offset += 4
+    return -1
+
+def linux_sll_network_offset(buf, start, end):
+    # Linux cooked capture (tcpdump -i any): 16-byte header, protocol last
+    if end - start < 16 or (buf[start + 14] << 8 | buf[start + 15]) not in (ETHERTYPE_IPV4, ETHERTYPE_IPV6):
+        return -1
+    return start + 16
+
+def linux_sll2_network_offset(buf, start, end):
+    # Linux cooked capture v2: 20-byte header, protocol first
+    if end - start < 20 or (buf[start] << 8 | buf[start + 1]) not in (ETHERTYPE_IPV4, ETHERTYPE_IPV6):
+        return -1
+    return start + 20
+
+def raw_network_offset(buf, start, end):
+    # No link-layer header: the packet starts with the IP header
+    if end <= start or buf[start] >> 4 not in (4, 6):
+        return -1
+    return start
+
+# BSD loopback address families: AF_INET, and AF_INET6 as Linux, NetBSD /
+# OpenBSD, FreeBSD and macOS number it
+NULL_ADDRESS_FAMILIES = (2, 10, 24, 28, 30)
+
+def null_network_offset(buf, start, end):
+    # BSD loopback: 4-byte address family in the capturing host's byte order
+    if end - start < 4 or (buf[start] not in NULL_ADDRESS_FAMILIES and buf[start + 3] not in NULL_ADDRESS_FAMILIES):
+        return -1
+    return start + 4
+
+LINK_LAYERS = {
+    LINKTYPE_NULL: null_network_offset,
+    LINKTYPE_ETHERNET: ethernet_network_offset,
+    LINKTYPE_RAW: raw_network_offset,
+    LINKTYPE_LINUX_SLL: linux_sll_network_offset,
+    LINKTYPE_IPV4: raw_network_offset,
+    LINKTYPE_IPV6: raw_network_offset,
+    LINKTYPE_LINUX_SLL2: linux_sll2_network_offset
+}
+
+def decode_buffer_link(buf, endian, offset=GLOBAL_HEADER_SIZE, end=None, first_timestamp=None, stats=None,
+                       ts_divisor=1e6, network_offset=ethernet_network_offset, packet_filter=None):
+    # decode_buffer for the other link layers: network_offset (an entry of
+    # LINK_LAYERS) finds the IP header of each packet
+    if end is None:
+        end = len(buf)
+    unpack_record = struct.Struct(endian + 'IIII').unpack_from
+    skipped = new_skip_counts()
+
+    while offset + PACKET_HEADER_SIZE <= end:
+        ts_sec, ts_frac, incl_len, orig_len = unpack_record(buf, offset)
+        packet_start = offset + PACKET_HEADER_SIZE
+        packet_end = packet_start + incl_len
+        if packet_end > end:
+            warn_incomplete_packet(stats)
+            break
+        offset = packet_end
+
+        timestamp = ts_sec + ts_frac / ts_divisor
+        if first_timestamp is None:
+            first_timestamp = timestamp
+
+        ip_start = network_offset(buf, packet_start, packet_end)
+        if ip_start < 0:
+            skipped['non_ip'] += 1
+            continue
+        fields = decode_ip(buf, ip_start, packet_end, packet_filter, skipped)
+        if fields is not None:
+            yield (timestamp - first_timestamp,) + fields
+    if stats is not None:
+        stats['next_offset'] = offset
+    add_skip_counts(stats, skipped)
+
+# pcapng block types and options read by decode_pcapng_buffer
+PCAPNG_INTERFACE_DESCRIPTION_BLOCK = 1
+PCAPNG_OBSOLETE_PACKET_BLOCK = 2
+PCAPNG_ENHANCED_PACKET_BLOCK = 6
+PCAPNG_OPTION_END = 0
+PCAPNG_OPTION_IF_TSRESOL = 9
+PCAPNG_PACKET_DATA_OFFSET = 28  # Packet data offset in Enhanced and Obsolete Packet Blocks
+
+def pcapng_ts_divisor(buf, endian, offset, end):
+    # Timestamp units per second from the if_tsresol option among the
+    # Interface Description Block options between offset and end
+    unpack_option = struct.Struct(endian + 'HH').unpack_from
+    while offset + 4 <= end:
+        code, length = unpack_option(buf, offset)
+        if code == PCAPNG_OPTION_END:
+            break
+        if code == PCAPNG_OPTION_IF_TSRESOL and length >= 1:
+            resolution = buf[offset + 4]
+            return float(2 ** (resolution & 0x7F) if resolution & 0x80 else 10 ** resolution)
+        offset += 4 + ((length + 3) & ~3)
+    return 1e6
+
+def pcapng_block_structs(endian):
+    # Block header, Interface Description, Enhanced Packet and Obsolete
+    # Packet Block field layouts for a section's byte order
+    return (struct.Struct(endian + 'II').unpack_from,
+            struct.Struct(endian + 'HHI').unpack_from,
+            struct.Struct(endian + 'IIIII').unpack_from,
+            struct.Struct(endian + 'HHIIII').unpack_from)
+
+def decode_pcapng_buffer(buf, endian='<', offset=0, end=None, first_timestamp=None, stats=None, packet_filter=None):
+    # Decode a pcapng capture block by block. Each Interface Description
+    # Block looks up its link-layer decoder and timestamp divisor once, and
+    # packets go through their interface's entry. Byte order is set by each
+    # Section Header Block. Simple Packet Blocks have no timestamp and are
+    # skipped.
+    if end is None:
+        end = len(buf)
+    unpack_block_type = struct.Struct('<I').unpack_from  # The section header type reads the same either way
+    unpack_block, unpack_interface, unpack_enhanced, unpack_obsolete = pcapng_block_structs(endian)
+    interfaces = []
+    unsupported_link_types = set()
+    skipped = new_skip_counts()
+
+    while offset + 12 <= end:
+        if unpack_block_type(buf, offset)[0] == PCAPNG_SECTION_HEADER_BLOCK:
+            # A new section: byte order and interfaces start over
+            capture = parse_capture_header(buf[offset:offset + 12])
+            if capture is None or capture['format'] != 'pcapng':
+                print('Warning: Invalid pcapng section header, skipping the rest of the capture.')
+                break
+            endian = capture['endian']
+            unpack_block, unpack_interface, unpack_enhanced, unpack_obsolete = pcapng_block_structs(endian)
+            interfaces = []
+
+        block_type, block_length = unpack_block(buf, offset)
+        block_start = offset
+        block_end = offset + block_length
+        if block_length < 12 or block_end > end:
+            warn_incomplete_packet(stats)
+            break
+        offset = block_end
+
+        if block_type == PCAPNG_ENHANCED_PACKET_BLOCK:
+            interface_id, ts_high, ts_low, captured_length, _ = unpack_enhanced(buf, block_start + 8)
+        elif block_type == PCAPNG_OBSOLETE_PACKET_BLOCK:
+            interface_id, _, ts_high, ts_low, captured_length, _ = unpack_obsolete(buf, block_start + 8)
+        else:
+            if block_type == PCAPNG_INTERFACE_DESCRIPTION_BLOCK:
+                link_type = unpack_interface(buf, block_start + 8)[0]
+                network_offset = LINK_LAYERS.get(link_type)
+                if network_offset is None and link_type not in unsupported_link_types:
+                    unsupported_link_types.add(link_type)
+                    print(f'Warning: Skipping packets with unsupported link-layer header type {link_type}.')
+                interfaces.append((network_offset, pcapng_ts_divisor(buf, endian, block_start + 16, block_end - 4)))
+            continue
+
+        packet_start = block_start + PCAPNG_PACKET_DATA_OFFSET
+        packet_end = packet_start + captured_length
+        if packet_end > block_end or interface_id >= len(interfaces):
+            skipped['malformed'] += 1
+            continue
+        network_offset, ts_divisor = interfaces[interface_id]
+        timestamp = ((ts_high << 32) | ts_low) / ts_divisor
+        if first_timestamp is None:
+            first_timestamp = timestamp
+
+        if network_offset is None:
+            skipped['non_ip'] += 1
+            continue
+        ip_start = network_offset(buf, packet_start, packet_end)
+        if ip_start < 0:
+            skipped['non_ip'] += 1
+            continue
+        fields = decode_ip(buf, ip_start, packet_end, packet_filter, skipped)
+        if fields is not None:
+            yield (timestamp - first_timestamp,) + fields
+    add_skip_counts(stats, skipped)
+
+def scan_record_offsets(buf, endian, offset=GLOBAL_HEADER_SIZE, end=None, stats=None):
+    # Walk the record headers, returning the offset where each complete
+    # packet record starts. stats['next_offset'] is where the walk stopped,
+    # as in decode_buffer.
+    if end is None:
+        end = len(buf)
+    unpack_incl_len = struct.Struct(endian + 'I').unpack_from
+    offsets = array('q')
+    append = offsets.append
+
+    # The last record is only checked for truncation once the walk is done
+    last_header = end - PACKET_HEADER_SIZE
+    while offset <= last_header:
+        append(offset)
+        offset += PACKET_HEADER_SIZE + unpack_incl_len(buf, offset + 8)[0]
+    if stats is not None:
+        stats['next_offset'] = offset
+    if offset > end:
+        offsets.pop()
+        warn_incomplete_packet(stats)
+
+    return offsets
+
+# Fixed Ethernet + IPv4 (no options) + TCP layout read by the NumPy engine
+FIXED_HEADERS_SIZE = ETHERNET_HEADER_SIZE + IP_HEADER_MIN_SIZE + TCP_HEADER_MIN_SIZE
+FIXED_HEADERS_DTYPE = None if np is None else np.dtype([
+    ('eth_addrs', 'V12'),
+    ('eth_type', '>u2'),
+    ('version_ihl', 'u1'),
+    ('tos', 'u1'),
+    ('total_length', '>u2'),
+    ('ip_id_frag', 'V4'),
+    ('ttl', 'u1'),
+    ('protocol', 'u1'),
+    ('ip_checksum', 'V2'),
+    ('src_addr', '>u4'),
+    ('dst_addr', '>u4'),
+    ('src_port', '>u2'),
+    ('dst_port', '>u2'),
+    ('seq_num', '>u4'),
+    ('ack_num', '>u4'),
+    ('offset_reserved', 'u1'),
+    ('flags', 'u1'),
+    ('window_size', '>u2'),
+    ('tcp_checksum_urgent', 'V4')
+])
+NUMPY_BATCH_SIZE = 1 << 16  # Packets gathered per batch
+
+def decode_buffer_numpy(buf, endian, offset=GLOBAL_HEADER_SIZE, end=None, first_timestamp=None, stats=None,
+                        ts_divisor=1e6, packet_filter=None):
+    # Vectorized decoder: gather the first 54 bytes of every packet in a
+    # batch and read all header fields at once. Packets that do not have
+    # the fixed Ethernet/IPv4/TCP layout (UDP and IPv6 among them) go
+    # through decode_ethernet instead. A packet filter is applied to the
+    # whole batch of headers.
+    return chain.from_iterable(decode_batches_numpy(buf, endian, offset, end, first_timestamp, stats, ts_divisor,
+                                                    packet_filter))
+
+def decode_batches_numpy(buf, endian, offset, end, first_timestamp, stats, ts_divisor, packet_filter):
+    record_offsets = np.frombuffer(scan_record_offsets(buf, endian, offset, end, stats), dtype=np.int64)
+    if not len(record_offsets):
+        return
+    data = np.frombuffer(buf, dtype=np.uint8)
+    record_dtype = np.dtype([('ts_sec', endian + 'u4'), ('ts_frac', endian + 'u4'),
+                             ('incl_len', endian + 'u4'), ('orig_len', endian + 'u4')])
+    # Overlapping windows of the capture, one starting at every byte, so a
+    # batch gathers whole headers by their start offsets alone
+    record_windows = np.lib.stride_tricks.sliding_window_view(data, PACKET_HEADER_SIZE)
+    header_windows = (np.lib.stride_tricks.sliding_window_view(data, FIXED_HEADERS_SIZE)
+                      if len(data) >= FIXED_HEADERS_SIZE else None)
+    skipped = new_skip_counts()
+
+    for batch_start in range(0, len(record_offsets), NUMPY_BATCH_SIZE):
+        batch_offsets = record_offsets[batch_start:batch_start + NUMPY_BATCH_SIZE]
+        records = record_windows[batch_offsets].view(record_dtype)[:, 0]
+        batch_starts = batch_offsets + PACKET_HEADER_SIZE
+        batch_lens = records['incl_len'].astype(np.int64)
+        timestamps = records['ts_sec'] + records['ts_frac'] / ts_divisor
+        if first_timestamp is None:
+            first_timestamp = timestamps[0]
+        timestamps -= first_timestamp
+
+        # Fancy-index the fixed header block of every long enough packet
+        candidates = np.flatnonzero(batch_lens >= FIXED_HEADERS_SIZE)
+        if len(candidates):
+            headers = header_windows[batch_starts[candidates]].view(FIXED_HEADERS_DTYPE)[:, 0]
+        else:
+            headers = np.zeros(0, dtype=FIXED_HEADERS_DTYPE)
+        data_offsets = (headers['offset_reserved'] >> 4).astype(np.int64) * 4
+        fits = ((headers['eth_type'] == ETHERTYPE_IPV4)
+                & (headers['version_ihl'] & 0x0F == 5)
+                & (headers['protocol'] == IP_PROTOCOL_TCP)
+                & (batch_lens[candidates] >= ETHERNET_HEADER_SIZE + IP_HEADER_MIN_SIZE + data_offsets))
+        fallback = np.ones(len(batch_starts), dtype=bool)
+        if packet_filter is not None:
+            matched = packet_filter['numpy'](headers)
+            rejected = candidates[fits & ~matched]
+            fallback[rejected] = False
+            skipped['filtered'] += len(rejected)
+            fits &= matched
+        fast_positions = candidates[fits]
+        fast = np.zeros(len(batch_starts), dtype=bool)
+        fast[fast_positions] = True
+        fallback[fast_positions] = False
+        headers = headers[fits]
+        data_offsets = data_offsets[fits]
+
+        # Options are only read from SYNs, few enough to parse one by one
+        options = np.zeros(len(headers), dtype=np.int64)
+        for index in np.flatnonzero(((headers['flags'] & TCP_SYN) != 0)
+                                    & (data_offsets > TCP_HEADER_MIN_SIZE)).tolist():
+            tcp_start = int(batch_starts[fast_positions[index]]) + ETHERNET_HEADER_SIZE + IP_HEADER_MIN_SIZE
+            options[index] = parse_tcp_options(buf, tcp_start + TCP_HEADER_MIN_SIZE, tcp_start + int(data_offsets[index]))
+
+        # Left lazy so that consumers unpacking one tuple at a time let zip
+        # reuse its result tuple instead of allocating one per packet
+        fast_segments = zip(
+            timestamps[fast].tolist(),
+            headers['src_addr'].tolist(),
+            headers['src_port'].tolist(),
+            headers['dst_addr'].tolist(),
+            headers['dst_port'].tolist(),
+            headers['seq_num'].tolist(),
+            headers['ack_num'].tolist(),
+            headers['flags'].tolist(),
+            headers['window_size'].tolist(),
+            (headers['total_length'].astype(np.int64) - IP_HEADER_MIN_SIZE - data_offsets).tolist(),
+            options.tolist()
         )
 
-        # Check if connection already exists
-        if conn_tuple in connections:
-            conn = connections[conn_tuple]
-        elif rev_conn_tuple in connections:
-            conn = connections[rev_conn_tuple]
+        # Put the scalar fallback packets back in capture order
+        emitted = 0
+        fallback_positions = np.flatnonzero(fallback)
+        for position, fast_before in zip(fallback_positions.tolist(),
+                                         np.searchsorted(fast_positions, fallback_positions).tolist()):
+            yield islice(fast_segments, fast_before - emitted)
+            emitted = fast_before
+            packet_start = int(batch_starts[position])
+            fields = decode_ethernet(buf, packet_start, packet_start + int(batch_lens[position]), packet_filter,
+                                     skipped)
+            yield () if fields is None else ((float(timestamps[position]),) + fields,)
+        yield fast_segments
+    add_skip_counts(stats, skipped)
+
+ENGINES = {
+    'python': decode_buffer,
+    'numpy': decode_buffer_numpy
+}
+
+def capture_decoder(capture, engine='python', packet_filter=None):
+    # Pick the decoder for a capture once, from its container and link-layer
+    # type, with the capture's timestamp divisor and the packet filter bound
+    # in. The engines only decode Ethernet pcap; other link layers go
+    # through decode_buffer_link and pcapng through decode_pcapng_buffer.
+    if capture['format'] == 'pcapng':
+        return partial(decode_pcapng_buffer, packet_filter=packet_filter)
+    link_type = capture['link_type']
+    if link_type == LINKTYPE_ETHERNET:
+        return partial(ENGINES[engine], ts_divisor=capture['ts_divisor'], packet_filter=packet_filter)
+    if link_type not in LINK_LAYERS:
+        print(f'Error: Unsupported link-layer header type {link_type}.')
+        sys.exit(1)
+    return partial(decode_buffer_link, ts_divisor=capture['ts_divisor'], network_offset=LINK_LAYERS[link_type],
+                   packet_filter=packet_filter)
+
+def decode_pcap_file(filename, engine='python', stats=None, packet_filter=None, first_timestamp=None):
+    # Memory-map the capture and decode headers in place. Timestamps are
+    # relative to first_timestamp, or to the capture's first packet.
+    f, capture = open_capture(filename)
+    decoder = capture_decoder(capture, engine, packet_filter)
+    with f:
+        if f.seek(0, 2) == GLOBAL_HEADER_SIZE and capture['format'] == 'pcap':
+            return  # No packet records (an empty file cannot be mapped)
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mm, 'madvise'):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        view = memoryview(mm)
+        try:
+            yield from decoder(view, capture['endian'], first_timestamp=first_timestamp, stats=stats)
+        finally:
+            try:
+                view.release()
+                mm.close()
+            except BufferError:
+                pass  # Still exported by a decoder frame being unwound; unmapped when it is freed
+
+def capture_first_timestamp(filename):
+    # Absolute timestamp of the capture's first packet record, the one the
+    # decoders make timestamps relative to, or None if it has none
+    f, capture = open_capture(filename)
+    with f:
+        if capture['format'] == 'pcap':
+            record = f.read(PACKET_HEADER_SIZE)
+            if len(record) < PACKET_HEADER_SIZE:
+                return None
+            ts_sec, ts_frac, incl_len, _ = struct.unpack(capture['endian'] + 'IIII', record)
+            if f.seek(0, 2) < GLOBAL_HEADER_SIZE + PACKET_HEADER_SIZE + incl_len:
+                return None
+            return ts_sec + ts_frac / capture['ts_divisor']
+        if f.seek(0, 2) == 0:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return pcapng_first_timestamp(mm, capture['endian'])
+
+def pcapng_first_timestamp(buf, endian):
+    # decode_pcapng_buffer's block walk, up to the first packet of a known
+    # interface
+    unpack_block, unpack_interface, unpack_enhanced, unpack_obsolete = pcapng_block_structs(endian)
+    ts_divisors = []
+    offset = 0
+    while offset + 12 <= len(buf):
+        if struct.unpack_from('<I', buf, offset)[0] == PCAPNG_SECTION_HEADER_BLOCK:
+            capture = parse_capture_header(buf[offset:offset + 12])
+            if capture is None or capture['format'] != 'pcapng':
+                return None
+            endian = capture['endian']
+            unpack_block, unpack_interface, unpack_enhanced, unpack_obsolete = pcapng_block_structs(endian)
+            ts_divisors = []
+        block_type, block_length = unpack_block(buf, offset)
+        block_start = offset
+        offset += block_length
+        if block_length < 12 or offset > len(buf):
+            return None
+        if block_type == PCAPNG_INTERFACE_DESCRIPTION_BLOCK:
+            ts_divisors.append(pcapng_ts_divisor(buf, endian, block_start + 16, offset - 4))
+            continue
+        if block_type == PCAPNG_ENHANCED_PACKET_BLOCK:
+            interface_id, ts_high, ts_low, captured_length, _ = unpack_enhanced(buf, block_start + 8)
+        elif block_type == PCAPNG_OBSOLETE_PACKET_BLOCK:
+            interface_id, _, ts_high, ts_low, captured_length, _ = unpack_obsolete(buf, block_start + 8)
+        else:
+            continue
+        if (block_start + PCAPNG_PACKET_DATA_OFFSET + captured_length <= offset
+                and interface_id < len(ts_divisors)):
+            return ((ts_high << 32) | ts_low) / ts_divisors[interface_id]
+    return None
+
+# Sidecar index (--index): the decoded segments of a capture saved next to
+# it as fixed-size little-endian records, so later runs read them back with
+# iter_unpack instead of decoding the capture again. The header holds the
+# capture's size and modification time; an index that no longer matches the
+# capture is ignored and rebuilt. IPv6 addresses do not fit a record, so
+# they are stored once each in a table after the records, and a record
+# holds INDEX_ADDRESS_BASE plus the address's position in the table.
+INDEX_SUFFIX = '.tcpidx'
+INDEX_MAGIC = b'TCPIDX\r\n'
+INDEX_VERSION = 3  # Bump whenever the segment tuple or record layout changes
+INDEX_HEADER_STRUCT = struct.Struct('<8sIIQqQQ')  # magic, version, flags, capture size, mtime (ns), segments, addresses
+INDEX_RECORD_STRUCT = struct.Struct('<dQHQHIIHHiI')  # One decoded segment
+INDEX_ADDRESS_SIZE = 16
+INDEX_ADDRESS_BASE = IPV4_ADDRESS_MAX + 1
+INDEX_TRUNCATED = 0x1  # The capture ends in an incomplete packet record
+
+def index_path(filename):
+    return filename + INDEX_SUFFIX
+
+def open_index(filename):
+    # Segments from the capture's index, or None if it has no index or the
+    # index does not describe the capture as it is now
+    try:
+        capture = os.stat(filename)
+        f = open(index_path(filename), 'rb')
+    except OSError:
+        return None
+    with f:
+        header = f.read(INDEX_HEADER_STRUCT.size)
+        if len(header) < INDEX_HEADER_STRUCT.size:
+            return None
+        magic, version, flags, capture_size, capture_mtime_ns, count, address_count = INDEX_HEADER_STRUCT.unpack(header)
+        if (magic != INDEX_MAGIC or version != INDEX_VERSION
+                or capture_size != capture.st_size or capture_mtime_ns != capture.st_mtime_ns
+                or f.seek(0, 2) != (INDEX_HEADER_STRUCT.size + count * INDEX_RECORD_STRUCT.size
+                                    + address_count * INDEX_ADDRESS_SIZE)):
+            return None
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return read_index(mm, flags, count)
+
+def read_index(mm, flags, count):
+    records_end = INDEX_HEADER_STRUCT.size + count * INDEX_RECORD_STRUCT.size
+    view = memoryview(mm)[INDEX_HEADER_STRUCT.size:records_end]
+    addresses = [IPV6_ADDRESS_TAG | int.from_bytes(mm[offset:offset + INDEX_ADDRESS_SIZE], 'big')
+                 for offset in range(records_end, len(mm), INDEX_ADDRESS_SIZE)]
+    try:
+        if addresses:
+            yield from restore_index_addresses(INDEX_RECORD_STRUCT.iter_unpack(view), addresses)
+        else:
+            yield from INDEX_RECORD_STRUCT.iter_unpack(view)
+    finally:
+        try:
+            view.release()
+            mm.close()
+        except BufferError:
+            pass  # Still exported by the record iterator; unmapped when it is freed
+    if flags & INDEX_TRUNCATED:
+        warn_incomplete_packet()
+
+def restore_index_addresses(records, addresses):
+    # Put the IPv6 addresses from the index's table back into its records
+    for record in records:
+        if record[1] > IPV4_ADDRESS_MAX:
+            record = (record[0], addresses[record[1] - INDEX_ADDRESS_BASE], record[2],
+                      addresses[record[3] - INDEX_ADDRESS_BASE]) + record[4:]
+        yield record
+
+def write_index(filename, segments, stats):
+    # Pass segments through while saving them to the capture's index. stats
+    # is the dict the segments' decoder reports truncation in. The index is
+    # only put in place once every segment was read; if it cannot be
+    # written, at any point, the capture is still analyzed.
+    path = index_path(filename)
+    temp_path = path + '.tmp'
+    try:
+        capture = os.stat(filename)
+        out = open(temp_path, 'wb')
+        out.seek(INDEX_HEADER_STRUCT.size)
+    except OSError as e:
+        print(f'Warning: Cannot write index {path}: {e}')
+        yield from segments
+        return
+
+    segments = iter(segments)
+    try:
+        write = out.write
+        pack = INDEX_RECORD_STRUCT.pack
+        addresses = {}  # IPv6 address -> its record value
+        for segment in segments:
+            yield segment
+            try:
+                if segment[1] > IPV4_ADDRESS_MAX:
+                    src_addr = addresses.setdefault(segment[1], INDEX_ADDRESS_BASE + len(addresses))
+                    dst_addr = addresses.setdefault(segment[3], INDEX_ADDRESS_BASE + len(addresses))
+                    write(pack(segment[0], src_addr, segment[2], dst_addr, *segment[4:]))
+                else:
+                    write(pack(*segment))
+            except OSError as e:
+                print(f'Warning: Cannot write index {path}: {e}')
+                discard_index(out, temp_path)
+                break
+        else:
+            try:
+                count = (out.tell() - INDEX_HEADER_STRUCT.size) // INDEX_RECORD_STRUCT.size
+                for address in addresses:
+                    write((address ^ IPV6_ADDRESS_TAG).to_bytes(INDEX_ADDRESS_SIZE, 'big'))
+                flags = INDEX_TRUNCATED if stats.get('truncated') else 0
+                out.seek(0)
+                write(INDEX_HEADER_STRUCT.pack(INDEX_MAGIC, INDEX_VERSION, flags,
+                                               capture.st_size, capture.st_mtime_ns, count, len(addresses)))
+                out.close()
+                os.replace(temp_path, path)
+            except OSError as e:
+                print(f'Warning: Cannot write index {path}: {e}')
+            return
+        # The index was dropped: pass the remaining segments through as they are
+        yield from segments
+    finally:
+        discard_index(out, temp_path)
+
+def discard_index(out, temp_path):
+    # Close and remove an index being written, if it still exists
+    try:
+        out.close()
+    except OSError:
+        pass
+    try:
+        os.remove(temp_path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f'Warning: Cannot remove {temp_path}: {e}')
+
+def indexed_segments(filename, engine='python', packet_filter=None, first_timestamp=None, stats=None):
+    # Segments from the capture's index, decoding the capture and building
+    # the index first if it is missing or stale. The index holds every
+    # segment, so a packet filter is applied to the segments read back.
+    # Indexed timestamps are relative to the capture's first packet; with
+    # first_timestamp they are moved to be relative to that instead. stats
+    # gets the decoder's counts when the index is built.
+    segments = open_index(filename)
+    if segments is None:
+        stats = {} if stats is None else stats
+        segments = write_index(filename, decode_pcap_file(filename, engine, stats), stats)
+    if packet_filter is not None:
+        segments = filter(packet_filter['segment'], segments)
+    if first_timestamp is not None:
+        shift = capture_first_timestamp(filename) - first_timestamp
+        if shift:
+            segments = ((segment[0] + shift,) + segment[1:] for segment in segments)
+    return segments
+
+def expand_capture_files(patterns):
+    # Capture file names from command-line arguments, expanding glob
+    # patterns the shell did not (a pattern matching nothing is kept as is).
+    # Index files a pattern matches are left out.
+    filenames = []
+    for pattern in patterns:
+        matches = [match for match in sorted(glob.glob(pattern)) if not match.endswith(INDEX_SUFFIX)]
+        filenames.extend(matches or [pattern])
+    return filenames
+
+def merge_capture_segments(filenames, decode=decode_pcap_file):
+    # Merge the segments of several captures (e.g. files rotated by tcpdump
+    # -C or -G) into one stream in timestamp order, with timestamps relative
+    # to the earliest first packet of any of them. decode(filename,
+    # first_timestamp=...) streams one capture's segments. This is a k-way
+    # merge through a heap with one reader per capture, but a capture is
+    # only opened once the merge reaches its first packet, and while a
+    # single capture is open its segments are passed straight through, so
+    # rotated captures that follow each other are read almost like one file.
+    starts = []
+    for filename in filenames:
+        first_timestamp = capture_first_timestamp(filename)
+        if first_timestamp is not None:
+            starts.append((first_timestamp, filename))
+    if not starts:
+        return
+    starts.sort(key=lambda start: start[0])
+    base_timestamp = starts[0][0]
+    # (relative start, order, filename); order breaks timestamp ties in
+    # favour of the capture that started first
+    pending = deque((first_timestamp - base_timestamp, order, filename)
+                    for order, (first_timestamp, filename) in enumerate(starts))
+    heap = []  # (timestamp, order, segment, segments) for each open capture
+    while heap or pending:
+        if pending and (not heap or pending[0][0] <= heap[0][0]):
+            _, order, filename = pending.popleft()
+            segments = iter(decode(filename, first_timestamp=base_timestamp))
+            segment = next(segments, None)
+            if segment is not None:
+                heappush(heap, (segment[0], order, segment, segments))
+            continue
+
+        if len(heap) == 1:
+            next_start = pending[0][0] if pending else math.inf
+            _, order, segment, segments = heap.pop()
+            yield segment
+            for segment in segments:
+                if segment[0] >= next_start:
+                    heappush(heap, (segment[0], order, segment, segments))
+                    break
+                yield segment
+            continue
+
+        _, order, segment, segments = heap[0]
+        yield segment
+        segment = next(segments, None)
+        if segment is None:
+            heappop(heap)
         else:
+            heapreplace(heap, (segment[0], order, segment, segments))
+
+def complete_records_end(buf, endian, offset=0):
+    # Offset just past the last packet record that is fully inside buf
+    unpack_incl_len = struct.Struct(endian + 'I').unpack_from
+    end = len(buf)
+    while offset + PACKET_HEADER_SIZE <= end:
+        next_offset = offset + PACKET_HEADER_SIZE + unpack_incl_len(buf, offset + 8)[0]
+        if next_offset > end:
+            break
+        offset = next_offset
+    return offset
+
+def follow_pcap_file(filename, poll_interval=FOLLOW_POLL_INTERVAL, packet_filter=None):
+    # Like tail -f: yield a list of newly decoded segments each time the
+    # capture grows, and an empty list after each idle poll. A record cut
+    # off at the end of the file is kept until the rest of it is written.
+    # Classic pcap only.
+    try:
+        f = open(filename, 'rb')
+    except FileNotFoundError:
+        print(f'Error: File {filename} not found.')
+        sys.exit(1)
+
+    with f:
+        header = b''
+        while len(header) < GLOBAL_HEADER_SIZE:
+            more = f.read(GLOBAL_HEADER_SIZE - len(header))
+            if not more:
+                yield []
+                time.sleep(poll_interval)
+            header += more
+        capture = parse_capture_header(header)
+        if capture is None:
+            print('Error: Unknown magic number. Not a valid PCAP file.')
+            sys.exit(1)
+        if capture['format'] != 'pcap':
+            print('Error: --follow only reads classic pcap captures, not pcapng.')
+            sys.exit(1)
+        endian = capture['endian']
+        decoder = capture_decoder(capture, packet_filter=packet_filter)
+
+        record_header = struct.Struct(endian + 'IIII')
+        first_timestamp = None
+        pending = b''
+        while True:
+            chunk = f.read(READ_CHUNK_SIZE)
+            if not chunk:
+                yield []
+                time.sleep(poll_interval)
+                continue
+            buf = pending + chunk if pending else chunk
+            end = complete_records_end(buf, endian)
+            if end and first_timestamp is None:
+                ts_sec, ts_frac, _, _ = record_header.unpack_from(buf, 0)
+                first_timestamp = ts_sec + ts_frac / capture['ts_divisor']
+            yield list(decoder(buf, endian, 0, end, first_timestamp))
+            pending = buf[end:]
+
+# Per-connection packets can be kept column-wise in typed arrays, one entry
+# per packet, when the caller asks for them (store_packets=True). The report
+# itself only needs the running totals kept on each connection.
+SEQ_TYPECODE = 'I' if array('I').itemsize >= 4 else 'L'
+PACKET_COLUMNS = (
+    ('timestamp', 'd'),
+    ('seq_num', SEQ_TYPECODE),
+    ('ack_num', SEQ_TYPECODE),
+    ('window_size', 'H'),
+    ('payload_size', 'i'),
+    ('direction', 'B'),
+    ('flags', 'H')  # TCP flags, or UDP_DATAGRAM
+)
+DIRECTION_FORWARD = 0
+DIRECTION_REVERSE = 1
+DIRECTION_NAMES = ('forward', 'reverse')
+
+def new_packet_store():
+    return {name: array(typecode) for name, typecode in PACKET_COLUMNS}
+
+def packet_count(conn):
+    return conn['fwd_packets'] + conn['rev_packets']
+
+def get_packet(conn, index):
+    # Rebuild a single packet of a connection as a dict
+    packet = {name: column[index] for name, column in conn['packets'].items()}
+    packet['direction'] = DIRECTION_NAMES[packet['direction']]
+    return packet
+
+def connection_packets(conn):
+    for index in range(len(conn['packets']['timestamp'])):
+        yield get_packet(conn, index)
+
+# Streaming quantile sketch: values are counted in logarithmic buckets of
+# relative width SKETCH_ACCURACY, so every quantile is known to within that
+# relative error without keeping the samples, and sketches merge by adding
+# their bucket counts
+SKETCH_ACCURACY = 0.01
+SKETCH_GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+SKETCH_LOG_GAMMA = math.log(SKETCH_GAMMA)
+
+def new_sketch():
+    return {'count': 0, 'zero': 0, 'buckets': {}}
+
+def sketch_add(sketch, value, count=1):
+    sketch['count'] += count
+    if value <= 0:
+        sketch['zero'] += count
+        return
+    index = math.ceil(math.log(value) / SKETCH_LOG_GAMMA)
+    buckets = sketch['buckets']
+    buckets[index] = buckets.get(index, 0) + count
+
+def sketch_merge(sketch, other):
+    sketch['count'] += other['count']
+    sketch['zero'] += other['zero']
+    buckets = sketch['buckets']
+    for index, count in other['buckets'].items():
+        buckets[index] = buckets.get(index, 0) + count
+
+def sketch_quantile(sketch, q):
+    if not sketch['count']:
+        return 0
+    rank = q * (sketch['count'] - 1)
+    seen = sketch['zero']
+    if rank < seen:
+        return 0
+    buckets = sketch['buckets']
+    for index in sorted(buckets):
+        seen += buckets[index]
+        if rank < seen:
+            return 2 * SKETCH_GAMMA ** index / (SKETCH_GAMMA + 1)
+    return 2 * SKETCH_GAMMA ** max(buckets) / (SKETCH_GAMMA + 1)
+
+def merge_mean_variance(count, mean, m2, other_count, other_mean, other_m2):
+    # Combine two Welford (count, mean, M2) accumulators
+    total = count + other_count
+    if not total:
+        return 0, 0.0, 0.0
+    delta = other_mean - mean
+    return (total,
+            mean + delta * other_count / total,
+            m2 + other_m2 + delta * delta * count * other_count / total)
+
+def analyze_packets(packets, **options):
+    return analyze_segments(decode_packets(packets), **options)
+
+def analyze_segments(segments, **options):
+    connections = track_connections(segments, **options)
+    finalize_connections(connections)
+    return connections
+
+def new_connection(conn_id, src_endpoint, src_addr, src_port, dst_addr, dst_port, timestamp, window_size,
+                   store_packets=False, quantiles=False, keep_handshakes=False, segment_rtt=False,
+                   seq_analysis=False, series=None, protocol=IP_PROTOCOL_TCP):
+    conn = {
+        'id': conn_id,
+        'protocol': protocol,
+        'src_endpoint': src_endpoint,
+        'src_addr': src_addr,
+        'dst_addr': dst_addr,
+        'src_port': src_port,
+        'dst_port': dst_port,
+        'start_time': timestamp,
+        'end_time': timestamp,
+        'syn_from_source': False,
+        'ack_from_source': False,
+        'syn_from_destination': False,
+        'ack_from_destination': False,
+        'syn_count': 0,
+        'fin_count': 0,
+        'rst_count': 0,
+        'complete': False,
+        # Running totals for the report
+        'fwd_packets': 0,
+        'rev_packets': 0,
+        'fwd_bytes': 0,
+        'rev_bytes': 0,
+        # Packed options of each side's SYN (see tcp_options), None until one is seen
+        'src_options': None,
+        'dst_options': None,
+        'fwd_window_shift': 0,
+        'rev_window_shift': 0,
+        'window_min': window_size,
+        'window_max': window_size,
+        'window_total': 0,
+        'window_mean': 0.0,
+        'window_m2': 0.0,
+        'syn_time': None,
+        'rtt_count': 0,
+        'rtt_total': 0.0,
+        'rtt_min': None,
+        'rtt_max': None
+    }
+    if store_packets:
+        conn['packets'] = new_packet_store()
+    if quantiles:
+        conn['rtt_sketch'] = new_sketch()
+        conn['window_sketch'] = new_sketch()
+    if keep_handshakes:
+        conn['handshakes'] = []
+        # Raw window -> packets, for forward, reverse and SYN packets; the
+        # window statistics are filled in from these by finalize_connection
+        conn['unscaled_windows'] = ({}, {}, {})
+        conn['window_min'] = math.inf
+        conn['window_max'] = -math.inf
+    if segment_rtt:
+        conn['rtt_senders'] = (new_rtt_sender(), new_rtt_sender())  # Forward, reverse
+        conn['segment_rtt_count'] = 0
+        conn['segment_rtt_total'] = 0.0
+        conn['segment_rtt_min'] = None
+        conn['segment_rtt_max'] = None
+        conn['segment_rtt_sketch'] = new_sketch()
+    if seq_analysis:
+        conn['seq_trackers'] = (new_seq_tracker(), new_seq_tracker())  # Forward, reverse
+        for event in SEQ_EVENTS:
+            conn['fwd_' + event] = 0
+            conn['rev_' + event] = 0
+    if series:
+        conn['series_start'] = max(int(timestamp / series), 0)
+        conn['series_packets'] = array('I')
+        conn['series_bytes'] = array('Q')
+    return conn
+
+def update_handshake_rtt(conn, timestamp, forward, flags):
+    # Called for SYN packets: RTT runs from a SYN sent by the source to the
+    # SYN/ACK coming back
+    if forward and conn['syn_time'] is None:
+        conn['syn_time'] = timestamp
+    elif not forward and flags & TCP_ACK and conn['syn_time'] is not None:
+        rtt = timestamp - conn['syn_time']
+        conn['syn_time'] = None
+        if rtt > 0:
+            add_rtt_sample(conn, rtt)
+
+def add_rtt_sample(conn, rtt):
+    conn['rtt_count'] += 1
+    conn['rtt_total'] += rtt
+    if conn['rtt_min'] is None or rtt < conn['rtt_min']:
+        conn['rtt_min'] = rtt
+    if conn['rtt_max'] is None or rtt > conn['rtt_max']:
+        conn['rtt_max'] = rtt
+    if 'rtt_sketch' in conn:
+        sketch_add(conn['rtt_sketch'], rtt)
+
+def set_window_shifts(conn):
+    # Window scaling is only in effect if both SYNs carried the option
+    # (RFC 7323), and then each side's windows are scaled by its own shift
+    src_options = conn['src_options']
+    dst_options = conn['dst_options']
+    if src_options is not None and dst_options is not None and src_options & dst_options & OPTION_HAS_WSCALE:
+        conn['fwd_window_shift'] = (src_options >> 16) & 0xFF
+        conn['rev_window_shift'] = (dst_options >> 16) & 0xFF
+
+def add_unscaled_windows(conn, unscaled_windows):
+    # Fill in the window statistics of a connection tracked with
+    # keep_handshakes from its raw window counts
+    window_count = 0
+    for shift, unscaled in zip((conn['fwd_window_shift'], conn['rev_window_shift'], 0), unscaled_windows):
+        for window_size, count in sorted(unscaled.items()):
+            window = window_size << shift
+            conn['window_min'] = min(conn['window_min'], window)
+            conn['window_max'] = max(conn['window_max'], window)
+            conn['window_total'] += window * count
+            window_count, conn['window_mean'], conn['window_m2'] = merge_mean_variance(
+                window_count, conn['window_mean'], conn['window_m2'], count, window, 0.0)
+            if 'window_sketch' in conn:
+                sketch_add(conn['window_sketch'], window, count)
+
+# Data segment RTT (--rtt): each direction's unacknowledged segments are
+# kept in sequence order, as parallel lists of end offset (relative to the
+# direction's first sequence number, unwrapped past 2**32), send time and
+# retransmitted mark. The lists are consumed from a head index and compacted
+# now and then, so new data is an append and each ACK a bisect. An ACK that
+# covers new segments gives one RTT sample, from the last of them; none if
+# any of them was sent more than once (Karn's rule).
+MAX_OUTSTANDING_SEGMENTS = 1 << 16  # Per direction; the oldest are dropped past this
+RTT_COMPACT_THRESHOLD = 1024  # Consumed entries kept before the lists are compacted
+
+def new_rtt_sender():
+    return {
+        'base': None,  # First sequence number seen from this sender
+        'next_seq': 0,  # Relative end of the highest data sent
+        'acked': 0,  # Relative acknowledgement number
+        'head': 0,  # Index of the oldest outstanding segment
+        'ends': [],
+        'times': [],
+        'retransmitted': []
+    }
+
+def relative_seq(sender, seq_num):
+    # Offset of a 32-bit sequence number from the sender's first one, taking
+    # the value nearest to next_seq so offsets keep growing across wraparound
+    next_seq = sender['next_seq']
+    return next_seq + (((seq_num - sender['base'] - next_seq + 0x80000000) & 0xFFFFFFFF) - 0x80000000)
+
+def rtt_segment_sent(sender, timestamp, seq_num, length):
+    if sender['base'] is None:
+        sender['base'] = seq_num
+    start = relative_seq(sender, seq_num)
+    end = start + length
+    ends = sender['ends']
+    next_seq = sender['next_seq']
+    if start >= next_seq:
+        ends.append(end)
+        sender['times'].append(timestamp)
+        sender['retransmitted'].append(False)
+        sender['next_seq'] = end
+        if len(ends) - sender['head'] > MAX_OUTSTANDING_SEGMENTS:
+            sender['head'] += 1
+        return
+    if end <= sender['acked']:
+        return  # Everything in it was already acknowledged
+
+    # Retransmission: mark the outstanding segments it overlaps
+    retransmitted = sender['retransmitted']
+    index = bisect_right(ends, start, sender['head'])
+    last = min(bisect_left(ends, end, index), len(ends) - 1)
+    for i in range(index, last + 1):
+        retransmitted[i] = True
+    if end > next_seq:
+        # Repacketized with new data beyond next_seq
+        ends.append(end)
+        sender['times'].append(timestamp)
+        retransmitted.append(True)
+        sender['next_seq'] = end
+
+def rtt_ack_received(sender, timestamp, ack_num):
+    # The RTT sample an ACK for this sender gives, or None
+    if sender['base'] is None:
+        return None
+    ack = relative_seq(sender, ack_num)
+    if ack <= sender['acked']:
+        return None
+    sender['acked'] = ack
+
+    ends = sender['ends']
+    head = sender['head']
+    covered = bisect_right(ends, ack, head)
+    if covered == head:
+        return None
+    retransmitted = sender['retransmitted']
+    rtt = None
+    if True not in retransmitted[head:covered]:
+        rtt = timestamp - sender['times'][covered - 1]
+
+    head = covered
+    if head >= RTT_COMPACT_THRESHOLD and head * 2 >= len(ends):
+        del ends[:head]
+        del sender['times'][:head]
+        del retransmitted[:head]
+        head = 0
+    sender['head'] = head
+    return rtt
+
+def update_segment_rtt(conn, timestamp, forward, seq_num, ack_num, flags, payload_size):
+    # The packet's data is sent by its own side; its ACK is for the other side's data
+    if forward:
+        sender, acked_sender = conn['rtt_senders']
+    else:
+        acked_sender, sender = conn['rtt_senders']
+    # SYN and FIN each take up one sequence number
+    length = payload_size + bool(flags & TCP_SYN) + bool(flags & TCP_FIN)
+    if length > 0:
+        rtt_segment_sent(sender, timestamp, seq_num, length)
+    if flags & TCP_ACK:
+        rtt = rtt_ack_received(acked_sender, timestamp, ack_num)
+        if rtt is not None and rtt >= 0:
+            conn['segment_rtt_count'] += 1
+            conn['segment_rtt_total'] += rtt
+            if conn['segment_rtt_min'] is None or rtt < conn['segment_rtt_min']:
+                conn['segment_rtt_min'] = rtt
+            if conn['segment_rtt_max'] is None or rtt > conn['segment_rtt_max']:
+                conn['segment_rtt_max'] = rtt
+            sketch_add(conn['segment_rtt_sketch'], rtt)
+
+# Sequence-space analysis (--seq-analysis): each direction keeps the
+# sequence ranges it has sent above what the other side acknowledged, as
+# sorted disjoint [start, end) intervals (relative to its first sequence
+# number, like the RTT engine), so memory grows with the number of holes
+# rather than packets. A segment at or past the highest sequence sent is
+# new data; below it, a segment overlapping data already sent is a
+# retransmission and one that only fills a hole is out of order.
+SEQ_EVENTS = ('retransmissions', 'out_of_order', 'dup_acks', 'zero_windows')
+
+def new_seq_tracker():
+    return {
+        'base': None,  # First sequence number seen from this side
+        'next_seq': 0,  # Relative end of the highest data sent
+        'acked': 0,  # Relative acknowledgement number from the other side
+        'starts': [],
+        'ends': [],
+        # This side's ACKs, for duplicate ACK and zero window detection
+        'last_ack': None,
+        'last_window': None,
+        'zero_window': False
+    }
+
+def seq_segment_sent(tracker, seq_num, length):
+    # Record a segment; returns the event it is, or None for new data
+    if tracker['base'] is None:
+        tracker['base'] = seq_num
+    start = relative_seq(tracker, seq_num)
+    end = start + length
+    starts = tracker['starts']
+    ends = tracker['ends']
+    if start >= tracker['next_seq']:
+        if ends and ends[-1] == start:
+            ends[-1] = end
+        else:
+            starts.append(start)
+            ends.append(end)
+        tracker['next_seq'] = end
+        return None
+    if end <= tracker['acked']:
+        return 'retransmissions'
+
+    # Below the highest sequence sent: compare with the ranges already seen
+    # (everything below acked counts as seen)
+    acked_overlap = start < tracker['acked']
+    start = max(start, tracker['acked'])
+    first = bisect_right(ends, start)  # First range ending after start
+    last = bisect_left(starts, end)  # Ranges before this one start before end
+    event = 'retransmissions' if acked_overlap or last > first else 'out_of_order'
+    # Merge the segment with the ranges it overlaps or touches
+    first = bisect_left(ends, start)
+    last = bisect_right(starts, end)
+    if first < last:
+        start = min(start, starts[first])
+        end = max(end, ends[last - 1])
+    starts[first:last] = [start]
+    ends[first:last] = [end]
+    if end > tracker['next_seq']:
+        tracker['next_seq'] = end
+    return event
+
+def seq_ack_received(tracker, ack_num):
+    # The other side acknowledged up to ack_num: forget the ranges below it.
+    # Returns the relative acknowledgement number.
+    if tracker['base'] is None:
+        tracker['base'] = ack_num  # Nothing seen from this side yet: start from what is acknowledged
+    ack = relative_seq(tracker, ack_num)
+    if ack > tracker['acked']:
+        tracker['acked'] = ack
+        if ack > tracker['next_seq']:
+            tracker['next_seq'] = ack  # Data acknowledged but not captured
+        ends = tracker['ends']
+        if ends and ends[0] <= ack:
+            below = bisect_right(ends, ack)
+            del tracker['starts'][:below]
+            del ends[:below]
+    return ack
+
+def update_seq_analysis(conn, forward, seq_num, ack_num, flags, window_size, payload_size):
+    if forward:
+        tracker, peer = conn['seq_trackers']
+        prefix = 'fwd_'
+    else:
+        peer, tracker = conn['seq_trackers']
+        prefix = 'rev_'
+
+    length = payload_size + bool(flags & TCP_SYN) + bool(flags & TCP_FIN)
+    if length > 0 and not flags & TCP_RST:
+        event = seq_segment_sent(tracker, seq_num, length)
+        if event is not None:
+            conn[prefix + event] += 1
+
+    if flags & TCP_ACK:
+        ack = seq_ack_received(peer, ack_num)
+        # A duplicate ACK repeats the previous ACK and window, carries
+        # nothing else, and the other side has data outstanding
+        if (length <= 0 and not flags & (TCP_SYN | TCP_FIN | TCP_RST) and ack_num == tracker['last_ack']
+                and window_size == tracker['last_window'] and peer['next_seq'] > ack):
+            conn[prefix + 'dup_acks'] += 1
+        tracker['last_ack'] = ack_num
+        tracker['last_window'] = window_size
+
+    # Count each time this side's advertised window drops to zero
+    if window_size == 0 and not flags & TCP_RST:
+        if not tracker['zero_window']:
+            tracker['zero_window'] = True
+            conn[prefix + 'zero_windows'] += 1
+    else:
+        tracker['zero_window'] = False
+
+# Time series (--series): each connection counts its packets and data bytes
+# per bucket of bucket_width seconds of capture time, in arrays starting at
+# the bucket of its first packet. The capture-wide series are added up from
+# the connections as they are reported (see series_report_sink), so they
+# come out the same from merged shards and from evicted connections.
+
+def update_connection_series(conn, timestamp, payload_size, bucket_width):
+    index = int(timestamp / bucket_width) - conn['series_start']
+    packets = conn['series_packets']
+    if index >= len(packets):
+        grow_buckets(packets, index + 1)
+        grow_buckets(conn['series_bytes'], index + 1)
+    elif index < 0:
+        index = 0  # Timestamp out of order, from before the first packet
+    packets[index] += 1
+    conn['series_bytes'][index] += payload_size
+
+def grow_buckets(buckets, length):
+    # Extend buckets with zeros to length entries
+    if len(buckets) < length:
+        buckets.frombytes(bytes((length - len(buckets)) * buckets.itemsize))
+
+def add_buckets(buckets, start, other, other_start):
+    # Add the counts in other, whose first bucket is other_start, to buckets,
+    # whose first bucket is start, growing buckets as needed. Returns the
+    # first bucket of the result.
+    if other_start < start:
+        buckets[0:0] = array(buckets.typecode, bytes((start - other_start) * buckets.itemsize))
+        start = other_start
+    offset = other_start - start
+    grow_buckets(buckets, offset + len(other))
+    for index, count in enumerate(other, offset):
+        if count:
+            buckets[index] += count
+    return start
+
+def new_capture_series(bucket_width):
+    return {
+        'bucket_width': bucket_width,
+        'packets': array('Q'),
+        'data_bytes': array('Q'),
+        'new_connections': array('Q'),  # Connections whose first packet is in the bucket
+        'active_connections': array('Q')  # Connections with a packet in the bucket
+    }
+
+def add_to_capture_series(capture_series, conn):
+    start = conn['series_start']
+    packets = conn['series_packets']
+    add_buckets(capture_series['packets'], 0, packets, start)
+    add_buckets(capture_series['data_bytes'], 0, conn['series_bytes'], start)
+    new_connections = capture_series['new_connections']
+    grow_buckets(new_connections, start + 1)
+    new_connections[start] += 1
+    active_connections = capture_series['active_connections']
+    grow_buckets(active_connections, start + len(packets))
+    for index, count in enumerate(packets, start):
+        if count:
+            active_connections[index] += 1
+
+# Bounded connection table: connections are finalized, handed to the
+# eviction policy's on_evict and dropped once they have been idle for
+# close_grace seconds after a FIN or RST, or idle_timeout seconds otherwise
+# (capture time). Past max_connections live flows the least recently
+# active one is evicted early.
+DEFAULT_CLOSE_GRACE = 30.0
+EVICTION_CHECK_INTERVAL = 1.0  # Most capture seconds between idle sweeps
+
+def new_eviction_policy(on_evict, idle_timeout=None, close_grace=DEFAULT_CLOSE_GRACE, max_connections=None):
+    if idle_timeout is None:
+        idle_timeout = math.inf
+    close_grace = min(close_grace, idle_timeout)
+    return {
+        'on_evict': on_evict,
+        'idle_timeout': idle_timeout,
+        'close_grace': close_grace,
+        'check_interval': min(EVICTION_CHECK_INTERVAL, close_grace),
+        'max_connections': math.inf if max_connections is None else max_connections,
+        'closing': OrderedDict(),  # Connections that saw a FIN or RST, least recently active first
+        'next_check': -math.inf,
+        'created': 0,
+        'evicted_closed': 0,
+        'evicted_idle': 0,
+        'evicted_early': 0
+    }
+
+def evict_connection(connections, key, eviction, reason):
+    conn = connections.pop(key)
+    eviction['closing'].pop(key, None)
+    eviction['evicted_' + reason] += 1
+    finalize_connection(conn)
+    eviction['on_evict'](conn)
+
+def evict_idle_connections(connections, eviction, now):
+    eviction['next_check'] = now + eviction['check_interval']
+    # Both tables are in order of last activity, so stop at the first
+    # connection that has not been idle long enough
+    closing = eviction['closing']
+    while closing:
+        key, conn = next(iter(closing.items()))
+        if now - conn['end_time'] < eviction['close_grace']:
+            break
+        evict_connection(connections, key, eviction, 'closed')
+    while connections:
+        key, conn = next(iter(connections.items()))
+        if now - conn['end_time'] < eviction['idle_timeout']:
+            break
+        evict_connection(connections, key, eviction, 'idle')
+
+def flush_connections(connections, eviction):
+    # End of capture: hand the connections still open to on_evict in order
+    for key, conn in sorted(connections.items(), key=lambda x: x[1]['id']):
+        finalize_connection(conn)
+        eviction['on_evict'](conn)
+    connections.clear()
+    eviction['closing'].clear()
+
+def track_connections(segments, connections=None, store_packets=False, quantiles=False, keep_handshakes=False,
+                      eviction=None, segment_rtt=False, seq_analysis=False, series=None):
+    # Group segments into connections (TCP connections and UDP flows, in
+    # one table), updating each connection's running totals as packets
+    # arrive. Passing connections continues tracking into
+    # an existing table. keep_handshakes records SYN packets and raw window
+    # counts so that connections tracked over separate shards can be merged
+    # exactly.
+    # eviction (see new_eviction_policy) bounds the table. segment_rtt
+    # measures RTT from every data segment (see update_segment_rtt),
+    # seq_analysis counts retransmissions and the like (see
+    # update_seq_analysis), and series is the bucket width in seconds for
+    # per-connection time series (see update_connection_series).
+    if eviction is not None:
+        if connections is None:
+            connections = OrderedDict()
+        connection_count = eviction['created']
+        closing = eviction['closing']
+    else:
+        if connections is None:
+            connections = {}
+        connection_count = len(connections)
+    endpoint_bits = FLOW_ENDPOINT_BITS
+
+    for (timestamp, src_addr, src_port, dst_addr, dst_port, seq_num, ack_num, flags, window_size, payload_size,
+         options) in segments:
+        # Identify connection by its canonical flow key (see flow_key)
+        src_endpoint = (src_addr << 16) | src_port
+        dst_endpoint = (dst_addr << 16) | dst_port
+        if src_endpoint < dst_endpoint:
+            key = (src_endpoint << endpoint_bits) | dst_endpoint
+        else:
+            key = (dst_endpoint << endpoint_bits) | src_endpoint
+        if flags & UDP_DATAGRAM:
+            key |= FLOW_KEY_UDP
+
+        conn = connections.get(key)
+        if conn is None:
             connection_count += 1
-            conn = {
-                'id': connection_count,
-                'packets': [],
-                'src_ip': ip_header['src_ip'],
-                'dst_ip': ip_header['dst_ip'],
-                'src_port': tcp_header['src_port'],
-                'dst_port': tcp_header['dst_port'],
-                'start_time': timestamp,
-                'end_time': timestamp,
-                'syn_from_source': False,
-                'ack_from_source': False,
-                'syn_count': 0,
-                'fin_count': 0,
-                'rst_count': 0,
-                'complete': False
-            }
-            connections[conn_tuple] = conn
+            conn = new_connection(connection_count, src_endpoint, src_addr, src_port, dst_addr, dst_port,
+                                  timestamp, window_size, store_packets, quantiles, keep_handshakes, segment_rtt,
+                                  seq_analysis, series,
+                                  IP_PROTOCOL_UDP if flags & UDP_DATAGRAM else IP_PROTOCOL_TCP)
+            connections[key] = conn
+            if eviction is not None and len(connections) > eviction['max_connections']:
+                evict_connection(connections, next(iter(connections)), eviction, 'early')
+        elif eviction is not None:
+            connections.move_to_end(key)
+            if key in closing:
+                closing.move_to_end(key)
 
         # Update connection end time
         if timestamp > conn['end_time']:
             conn['end_time'] = timestamp
 
-        # Determine packet direction
-        direction = 'forward' if (ip_header['src_ip'], tcp_header['src_port']) == (conn['src_ip'], conn['src_port']) else 'reverse'
+        # Determine packet direction and update packet and byte counts
+        forward = src_endpoint == conn['src_endpoint']
+        if forward:
+            conn['fwd_packets'] += 1
+            conn['fwd_bytes'] += payload_size
+            window_shift = conn['fwd_window_shift']
+        else:
+            conn['rev_packets'] += 1
+            conn['rev_bytes'] += payload_size
+            window_shift = conn['rev_window_shift']
 
-        # Update connection flags
-        flags = tcp_header['flags']
-        if flags['SYN']:
+        # Update connection flags (none of these are set on UDP datagrams)
+        if flags & TCP_SYN:
             conn['syn_count'] += 1
-            if direction == 'forward':
-                conn['syn_from_source'] = True
-        if flags['FIN']:
+            conn['syn_from_source' if forward else 'syn_from_destination'] = True
+            update_handshake_rtt(conn, timestamp, forward, flags)
+            # Each side's first SYN options are the ones kept
+            side = 'src_options' if forward else 'dst_options'
+            if conn[side] is None:
+                conn[side] = options
+                if options & OPTION_HAS_WSCALE:
+                    set_window_shifts(conn)
+            if keep_handshakes:
+                conn['handshakes'].append((timestamp, forward, flags))
+            window_shift = 0  # The window in a SYN is never scaled
+        if flags & TCP_FIN:
             conn['fin_count'] += 1
-        if flags['RST']:
+        if flags & TCP_RST:
             conn['rst_count'] += 1
-        if flags['ACK']:
-            if direction == 'forward':
-                conn['ack_from_source'] = True
-
-        # Add packet to connection
-        conn['packets'].append({
-            'timestamp': timestamp,
-            'ip_header': ip_header,
-            'tcp_header': tcp_header,
-            'payload_size': ip_header['total_length'] - ip_header['header_length'] - tcp_header['data_offset'],
-            'direction': direction
-        })
+        if flags & TCP_ACK:
+            conn['ack_from_source' if forward else 'ack_from_destination'] = True
+        if eviction is not None and flags & (TCP_FIN | TCP_RST) and key not in closing:
+            closing[key] = conn
 
-    # Determine connection completeness
+        # Update window size statistics (Welford running mean and variance)
+        # with the effective window, scaled by the sender's shift. A shard
+        # may not have seen the handshake, so it only counts raw windows.
+        # UDP flows only count packets and bytes.
+        if flags & UDP_DATAGRAM:
+            pass
+        elif keep_handshakes:
+            unscaled = conn['unscaled_windows'][2 if flags & TCP_SYN else not forward]
+            unscaled[window_size] = unscaled.get(window_size, 0) + 1
+        else:
+            window = window_size << window_shift
+            if window < conn['window_min']:
+                conn['window_min'] = window
+            elif window > conn['window_max']:
+                conn['window_max'] = window
+            conn['window_total'] += window
+            delta = window - conn['window_mean']
+            conn['window_mean'] += delta / (conn['fwd_packets'] + conn['rev_packets'])
+            conn['window_m2'] += delta * (window - conn['window_mean'])
+            if quantiles:
+                sketch_add(conn['window_sketch'], window)
+
+        if segment_rtt and not flags & UDP_DATAGRAM:
+            update_segment_rtt(conn, timestamp, forward, seq_num, ack_num, flags, payload_size)
+        if seq_analysis and not flags & UDP_DATAGRAM:
+            update_seq_analysis(conn, forward, seq_num, ack_num, flags, window_size, payload_size)
+        if series:
+            update_connection_series(conn, timestamp, payload_size, series)
+
+        if store_packets:
+            columns = conn['packets']
+            columns['timestamp'].append(timestamp)
+            columns['seq_num'].append(seq_num)
+            columns['ack_num'].append(ack_num)
+            columns['window_size'].append(window_size)
+            columns['payload_size'].append(payload_size)
+            columns['direction'].append(DIRECTION_FORWARD if forward else DIRECTION_REVERSE)
+            columns['flags'].append(flags)
+
+        if eviction is not None:
+            eviction['created'] = connection_count
+            if timestamp >= eviction['next_check']:
+                evict_idle_connections(connections, eviction, timestamp)
+
+    return connections
+
+# Swaps DIRECTION_FORWARD and DIRECTION_REVERSE in a direction column
+DIRECTION_FLIP_TABLE = bytes.maketrans(bytes([DIRECTION_FORWARD, DIRECTION_REVERSE]),
+                                       bytes([DIRECTION_REVERSE, DIRECTION_FORWARD]))
+
+def merge_connections(connections, shard_connections):
+    # Fold the connections tracked over a later part of the capture into
+    # connections. Connections new to the capture are numbered in order of
+    # their first packet, and a connection first seen in the other
+    # direction has its source/destination view flipped to match. Shards
+    # must be tracked with keep_handshakes=True.
+    for key, shard_conn in sorted(shard_connections.items(), key=lambda x: x[1]['id']):
+        conn = connections.get(key)
+        if conn is None:
+            shard_conn['id'] = len(connections) + 1
+            connections[key] = shard_conn
+            continue
+        flipped = shard_conn['src_endpoint'] != conn['src_endpoint']
+
+        if shard_conn['end_time'] > conn['end_time']:
+            conn['end_time'] = shard_conn['end_time']
+        conn['syn_count'] += shard_conn['syn_count']
+        conn['fin_count'] += shard_conn['fin_count']
+        conn['rst_count'] += shard_conn['rst_count']
+        if flipped:
+            conn['syn_from_source'] |= shard_conn['syn_from_destination']
+            conn['ack_from_source'] |= shard_conn['ack_from_destination']
+            conn['syn_from_destination'] |= shard_conn['syn_from_source']
+            conn['ack_from_destination'] |= shard_conn['ack_from_source']
+            conn['fwd_packets'], conn['rev_packets'] = (conn['fwd_packets'] + shard_conn['rev_packets'],
+                                                        conn['rev_packets'] + shard_conn['fwd_packets'])
+            conn['fwd_bytes'], conn['rev_bytes'] = (conn['fwd_bytes'] + shard_conn['rev_bytes'],
+                                                    conn['rev_bytes'] + shard_conn['fwd_bytes'])
+        else:
+            conn['syn_from_source'] |= shard_conn['syn_from_source']
+            conn['ack_from_source'] |= shard_conn['ack_from_source']
+            conn['syn_from_destination'] |= shard_conn['syn_from_destination']
+            conn['ack_from_destination'] |= shard_conn['ack_from_destination']
+            conn['fwd_packets'], conn['rev_packets'] = (conn['fwd_packets'] + shard_conn['fwd_packets'],
+                                                        conn['rev_packets'] + shard_conn['rev_packets'])
+            conn['fwd_bytes'], conn['rev_bytes'] = (conn['fwd_bytes'] + shard_conn['fwd_bytes'],
+                                                    conn['rev_bytes'] + shard_conn['rev_bytes'])
+
+        # SYN options: the first seen on each side wins, as in a single pass
+        if flipped:
+            src_options, dst_options = shard_conn['dst_options'], shard_conn['src_options']
+        else:
+            src_options, dst_options = shard_conn['src_options'], shard_conn['dst_options']
+        if conn['src_options'] is None:
+            conn['src_options'] = src_options
+        if conn['dst_options'] is None:
+            conn['dst_options'] = dst_options
+        set_window_shifts(conn)
+
+        # Window statistics are only computed once the connection's window
+        # scale is settled, so pool the raw windows for now
+        shard_unscaled_windows = shard_conn['unscaled_windows']
+        if flipped:
+            shard_unscaled_windows = (shard_unscaled_windows[1], shard_unscaled_windows[0], shard_unscaled_windows[2])
+        for unscaled, shard_unscaled in zip(conn['unscaled_windows'], shard_unscaled_windows):
+            for window_size, count in shard_unscaled.items():
+                unscaled[window_size] = unscaled.get(window_size, 0) + count
+
+        # The shard's handshake RTTs assumed no SYN was pending when it
+        # started, so replay its SYN packets on top of this connection instead
+        for timestamp, forward, flags in shard_conn['handshakes']:
+            update_handshake_rtt(conn, timestamp, forward != flipped, flags)
+
+        if 'series_start' in conn:
+            series_start = add_buckets(conn['series_packets'], conn['series_start'],
+                                       shard_conn['series_packets'], shard_conn['series_start'])
+            add_buckets(conn['series_bytes'], conn['series_start'], shard_conn['series_bytes'],
+                        shard_conn['series_start'])
+            conn['series_start'] = series_start
+
+        if 'packets' in conn:
+            for name, column in conn['packets'].items():
+                shard_column = shard_conn['packets'][name]
+                if name == 'direction' and flipped:
+                    shard_column = array('B', shard_column.tobytes().translate(DIRECTION_FLIP_TABLE))
+                column.extend(shard_column)
+
+    return connections
+
+def finalize_connections(connections):
     for conn in connections.values():
-        conn['complete'] = is_connection_complete(conn)
-        conn['established_before_capture'] = is_established_before_capture(conn)
+        finalize_connection(conn)
+
+def finalize_connection(conn):
+    # Determine connection completeness
+    conn['complete'] = is_connection_complete(conn)
+    conn['established_before_capture'] = is_established_before_capture(conn)
+    conn.pop('handshakes', None)
+    unscaled_windows = conn.pop('unscaled_windows', None)
+    if unscaled_windows is not None:
+        add_unscaled_windows(conn, unscaled_windows)
+    conn.pop('rtt_senders', None)
+    conn.pop('seq_trackers', None)
 
+SHARDS_PER_WORKER = 4  # More shards than workers keeps the pool busy when shards run unevenly
+RESYNC_RECORDS = 8  # Record headers in a row that place a shard boundary
+RESYNC_MAX_PACKET = 262144  # Largest original packet length a record header is taken to have
+
+def is_record_chain(buf, unpack_record, offset, end, ts_divisor):
+    # Whether RESYNC_RECORDS plausible packet record headers follow one
+    # another from offset, or fewer that end exactly at end
+    for _ in range(RESYNC_RECORDS):
+        if offset == end:
+            return True
+        if offset + PACKET_HEADER_SIZE > end:
+            return False
+        _, ts_frac, incl_len, orig_len = unpack_record(buf, offset)
+        if not 0 < incl_len <= orig_len <= RESYNC_MAX_PACKET or ts_frac >= ts_divisor:
+            return False
+        offset += PACKET_HEADER_SIZE + incl_len
+    return offset <= end
+
+def find_record_start(buf, unpack_record, offset, limit, end, ts_divisor):
+    # The first offset from offset up to limit where a run of record
+    # headers starts (see is_record_chain), or None
+    while offset < limit:
+        if is_record_chain(buf, unpack_record, offset, end, ts_divisor):
+            return offset
+        offset += 1
+    return None
+
+def analyze_shard(filename, engine, capture, start, end, first_timestamp, filter_expression, options):
+    # Worker process: decode one run of packet records and group them by
+    # connection, returning the connections, where the record walk stopped
+    # and whether it ended in an incomplete record, which is left to the
+    # parent to report. The filter is compiled here since its predicates
+    # cannot be pickled.
+    packet_filter = compile_packet_filter(filter_expression) if filter_expression is not None else None
+    stats = {'quiet': True}
+    with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        segments = capture_decoder(capture, engine, packet_filter)(mm, capture['endian'], start, end,
+                                                                   first_timestamp, stats)
+        connections = track_connections(segments, keep_handshakes=True, **options)
+    return connections, stats['next_offset'], stats.get('truncated', False)
+
+def analyze_pcap_file_parallel(filename, workers, engine='python', packet_filter=None, **options):
+    # Split the capture into equal byte ranges, each moved up to the next
+    # packet record (see find_record_start), track connections for each
+    # shard in a process pool and merge the shards back in order. Every
+    # shard's record walk has to stop exactly where the next shard starts,
+    # which proves each boundary is a record start; should one not, the
+    # capture is analyzed in this process, as pcapng captures are.
+    f, capture = open_capture(filename)
+    if capture['format'] != 'pcap':
+        f.close()
+        return analyze_segments(decode_pcap_file(filename, engine, packet_filter=packet_filter), **options)
+    with f:
+        size = f.seek(0, 2)
+        if size < GLOBAL_HEADER_SIZE + PACKET_HEADER_SIZE:
+            return {}
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            unpack_record = struct.Struct(capture['endian'] + 'IIII').unpack_from
+            ts_sec, ts_frac, _, _ = unpack_record(mm, GLOBAL_HEADER_SIZE)
+            first_timestamp = ts_sec + ts_frac / capture['ts_divisor']
+            targets = [GLOBAL_HEADER_SIZE + i * (size - GLOBAL_HEADER_SIZE) // (workers * SHARDS_PER_WORKER)
+                       for i in range(workers * SHARDS_PER_WORKER)] + [size]
+            boundaries = [GLOBAL_HEADER_SIZE]
+            for target, limit in zip(targets[1:], targets[2:]):
+                boundary = find_record_start(mm, unpack_record, max(target, boundaries[-1] + 1), limit, size,
+                                             capture['ts_divisor'])
+                if boundary is not None:
+                    boundaries.append(boundary)
+    boundaries.append(size)
+    shard_count = len(boundaries) - 1
+
+    connections = {}
+    aligned = True
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        shards = pool.map(
+            analyze_shard,
+            [filename] * shard_count,
+            [engine] * shard_count,
+            [capture] * shard_count,
+            boundaries[:-1],
+            boundaries[1:],
+            [first_timestamp] * shard_count,
+            [packet_filter['expression'] if packet_filter is not None else None] * shard_count,
+            [options] * shard_count
+        )
+        for index, (shard_connections, next_offset, truncated) in enumerate(shards):
+            # The last shard may end in a truncated record
+            if index < shard_count - 1 and next_offset != boundaries[index + 1]:
+                aligned = False
+                break
+            merge_connections(connections, shard_connections)
+    if not aligned:
+        return analyze_segments(decode_pcap_file(filename, engine, packet_filter=packet_filter), **options)
+    if truncated:
+        warn_incomplete_packet()
+
+    finalize_connections(connections)
+    return connections
+
+def follow_capture(filename, interval, poll_interval=FOLLOW_POLL_INTERVAL, eviction=None, packet_filter=None,
+                   **options):
+    # --follow: keep tracking connections as the capture grows, printing a
+    # one-line summary every interval seconds and the full report on Ctrl-C.
+    # options go to track_connections.
+    connections = OrderedDict() if eviction is not None else {}
+    next_summary = time.monotonic() + interval
+    try:
+        for segments in follow_pcap_file(filename, poll_interval, packet_filter):
+            if segments:
+                track_connections(segments, connections, eviction=eviction, **options)
+            now = time.monotonic()
+            if now >= next_summary:
+                print_follow_summary(connections, eviction)
+                next_summary = now + interval
+    except KeyboardInterrupt:
+        pass
+    if eviction is None:
+        finalize_connections(connections)
     return connections
 
+def print_follow_summary(connections, eviction=None):
+    packets = data_bytes = complete = reset = udp = last_time = 0
+    for conn in connections.values():
+        packets += packet_count(conn)
+        data_bytes += conn['fwd_bytes'] + conn['rev_bytes']
+        if conn['protocol'] == IP_PROTOCOL_UDP:
+            udp += 1
+        elif is_connection_complete(conn):
+            complete += 1
+        if conn['rst_count'] > 0:
+            reset += 1
+        if conn['end_time'] > last_time:
+            last_time = conn['end_time']
+    print(f'[{time.strftime("%H:%M:%S")}] capture time {last_time:.6f} s, packets: {packets}, '
+          f'data bytes: {data_bytes}, connections: {len(connections)} '
+          f'(complete {complete}, reset {reset}, open {len(connections) - complete - udp}'
+          + (f', UDP flows {udp}' if udp else '') + ')'
+          + (f', evicted: {eviction_count(eviction)}' if eviction is not None else ''), flush=True)
+
+def eviction_count(eviction):
+    return eviction['evicted_closed'] + eviction['evicted_idle'] + eviction['evicted_early']
+
 def is_connection_complete(conn):
     # A connection is complete if it has at least one FIN flag
     return conn['fin_count'] > 0
@@ -236,134 +2615,240 @@ def is_established_before_capture(conn):
     # Connection is established before capture if no SYN from source but ACK from source
     return not conn['syn_from_source'] and conn['ack_from_source']
 
-def print_connection_details(connections):
-    print('\nA) Total number of connections:', len(connections))
-    print('________________________________________________\n')
-    print("B) Connection's details\n")
+def print_connection_details(connections, quantiles=False, segment_rtt=False, seq_analysis=False):
+    write_report(connections, new_report_sink('text', None, quantiles, segment_rtt, seq_analysis))
 
-    complete_connections = []
-    reset_connections = 0
-    open_connections = 0
-    established_before_capture = 0
+def print_evicted_report_totals(summary, eviction):
+    # Sections A, C and D after the connections were printed as they were
+    # evicted (with --idle-timeout / --max-connections)
+    print('________________________________________________\n')
+    print('A) Total number of connections:', summary['connections'])
+    print(f'Connections evicted after FIN/RST: {eviction["evicted_closed"]}')
+    print(f'Connections evicted when idle: {eviction["evicted_idle"]}')
+    print(f'Connections evicted early (connection table full): {eviction["evicted_early"]}')
+    print_general_statistics(summary)
+    print_complete_statistics(summary)
 
-    for conn_id, conn in sorted(connections.items(), key=lambda x: x[1]['id']):
-        print(f'Connection {conn["id"]}:')
-        print(f'Source Address: {conn["src_ip"]}')
-        print(f'Destination Address: {conn["dst_ip"]}')
-        print(f'Source Port: {conn["src_port"]}')
-        print(f'Destination Port: {conn["dst_port"]}')
+def print_connection(conn):
+    print(f'Connection {conn["id"]}:')
+    print(f'Source Address: {format_address(conn["src_addr"])}')
+    print(f'Destination Address: {format_address(conn["dst_addr"])}')
+    print(f'Source Port: {conn["src_port"]}')
+    print(f'Destination Port: {conn["dst_port"]}')
 
+    # UDP flows have no status and are always reported in full
+    udp = conn['protocol'] == IP_PROTOCOL_UDP
+    if udp:
+        print('Protocol: UDP')
+    else:
         status = f'S{conn["syn_count"]}F{conn["fin_count"]}'
         if conn['rst_count'] > 0:
             status += '/R'
-            reset_connections += 1
         print(f'Status: {status}')
 
-        if conn['complete']:
-            complete_connections.append(conn)
-            duration = conn['end_time'] - conn['start_time']
-            print(f'Start time: {conn["start_time"]:.6f} seconds')
-            print(f'End Time: {conn["end_time"]:.6f} seconds')
-            print(f'Duration: {duration:.6f} seconds')
-
-            # Calculate packet and byte counts
-            fwd_packets = sum(1 for pkt in conn['packets'] if pkt['direction'] == 'forward')
-            rev_packets = sum(1 for pkt in conn['packets'] if pkt['direction'] == 'reverse')
-            total_packets = fwd_packets + rev_packets
-
-            fwd_bytes = sum(pkt['payload_size'] for pkt in conn['packets'] if pkt['direction'] == 'forward')
-            rev_bytes = sum(pkt['payload_size'] for pkt in conn['packets'] if pkt['direction'] == 'reverse')
-            total_bytes = fwd_bytes + rev_bytes
-
-            print(f'Number of packets sent from Source to Destination: {fwd_packets}')
-            print(f'Number of packets sent from Destination to Source: {rev_packets}')
-            print(f'Total number of packets: {total_packets}')
-            print(f'Number of data bytes sent from Source to Destination: {fwd_bytes}')
-            print(f'Number of data bytes sent from Destination to Source: {rev_bytes}')
-            print(f'Total number of data bytes: {total_bytes}')
-        else:
-            open_connections += 1
+    if conn['complete'] or udp:
+        duration = conn['end_time'] - conn['start_time']
+        print(f'Start time: {conn["start_time"]:.6f} seconds')
+        print(f'End Time: {conn["end_time"]:.6f} seconds')
+        print(f'Duration: {duration:.6f} seconds')
+
+        # Packet and byte counts
+        fwd_packets = conn['fwd_packets']
+        rev_packets = conn['rev_packets']
+        total_packets = fwd_packets + rev_packets
+        fwd_bytes = conn['fwd_bytes']
+        rev_bytes = conn['rev_bytes']
+        total_bytes = fwd_bytes + rev_bytes
+
+        print(f'Number of packets sent from Source to Destination: {fwd_packets}')
+        print(f'Number of packets sent from Destination to Source: {rev_packets}')
+        print(f'Total number of packets: {total_packets}')
+        print(f'Number of data bytes sent from Source to Destination: {fwd_bytes}')
+        print(f'Number of data bytes sent from Destination to Source: {rev_bytes}')
+        print(f'Total number of data bytes: {total_bytes}')
+
+    if 'fwd_retransmissions' in conn and not udp:
+        print(f'Retransmitted segments (from source/destination): '
+              f'{conn["fwd_retransmissions"]} / {conn["rev_retransmissions"]}')
+        print(f'Out-of-order segments (from source/destination): '
+              f'{conn["fwd_out_of_order"]} / {conn["rev_out_of_order"]}')
+        print(f'Duplicate ACKs (from source/destination): {conn["fwd_dup_acks"]} / {conn["rev_dup_acks"]}')
+        print(f'Zero window events (from source/destination): {conn["fwd_zero_windows"]} / {conn["rev_zero_windows"]}')
+
+    if 'segment_rtt_count' in conn and not udp:
+        print(f'Number of RTT samples from data segments: {conn["segment_rtt_count"]}')
+        if conn['segment_rtt_count']:
+            print(f'Minimum/mean/maximum RTT: {conn["segment_rtt_min"]:.6f} / '
+                  f'{conn["segment_rtt_total"] / conn["segment_rtt_count"]:.6f} / {conn["segment_rtt_max"]:.6f}')
+            print('RTT percentiles (p50/p95/p99): ' + format_percentiles(
+                conn['segment_rtt_sketch'], conn['segment_rtt_min'], conn['segment_rtt_max'], 6))
+
+    print('END')
+    print('++++++++++++++++++++++++++++++++')
+
+def format_percentiles(sketch, minimum, maximum, decimals):
+    # p50/p95/p99 of a sketch, clamped to the exact minimum and maximum
+    return ' / '.join(f'{min(max(sketch_quantile(sketch, q), minimum), maximum):.{decimals}f}'
+                      for q in (0.5, 0.95, 0.99))
+
+def new_report_summary(quantiles=False, segment_rtt=False, seq_analysis=False):
+    # Running totals behind sections C and D, so connections can be
+    # reported and dropped one at a time
+    return {
+        'quantiles': quantiles,
+        'segment_rtt': segment_rtt,
+        'seq_analysis': seq_analysis,
+        'connections': 0,
+        'udp_flows': 0,
+        'udp_packets': 0,
+        'udp_bytes': 0,
+        'complete': 0,
+        'reset': 0,
+        'open': 0,
+        'established_before_capture': 0,
+        'duration_total': 0,
+        'duration_min': None,
+        'duration_max': None,
+        'packets_total': 0,
+        'packets_min': None,
+        'packets_max': None,
+        'rtt_count': 0,
+        'rtt_total': 0,
+        'rtt_min': None,
+        'rtt_max': None,
+        'window_count': 0,
+        'window_total': 0,
+        'window_mean': 0.0,
+        'window_m2': 0.0,
+        'window_min': None,
+        'window_max': None,
+        'rtt_sketch': new_sketch(),
+        'window_sketch': new_sketch(),
+        'segment_rtt_count': 0,
+        'segment_rtt_total': 0.0,
+        'segment_rtt_min': None,
+        'segment_rtt_max': None,
+        'segment_rtt_sketch': new_sketch(),
+        'retransmissions': 0,
+        'out_of_order': 0,
+        'dup_acks': 0,
+        'zero_windows': 0,
+        'retransmitting_connections': 0
+    }
+
+def add_to_report_summary(summary, conn):
+    summary['connections'] += 1
+    if conn['protocol'] == IP_PROTOCOL_UDP:
+        summary['udp_flows'] += 1
+        summary['udp_packets'] += packet_count(conn)
+        summary['udp_bytes'] += conn['fwd_bytes'] + conn['rev_bytes']
+        return
+    if conn['rst_count'] > 0:
+        summary['reset'] += 1
+    if conn['established_before_capture']:
+        summary['established_before_capture'] += 1
+    if summary['seq_analysis']:
+        for event in SEQ_EVENTS:
+            summary[event] += conn['fwd_' + event] + conn['rev_' + event]
+        if conn['fwd_retransmissions'] or conn['rev_retransmissions']:
+            summary['retransmitting_connections'] += 1
+    if not conn['complete']:
+        summary['open'] += 1
+        return
+
+    summary['complete'] += 1
+    duration = conn['end_time'] - conn['start_time']
+    summary['duration_total'] += duration
+    summary['duration_min'] = duration if summary['duration_min'] is None else min(summary['duration_min'], duration)
+    summary['duration_max'] = duration if summary['duration_max'] is None else max(summary['duration_max'], duration)
+
+    conn_packets = packet_count(conn)
+    summary['packets_total'] += conn_packets
+    summary['packets_min'] = conn_packets if summary['packets_min'] is None else min(summary['packets_min'], conn_packets)
+    summary['packets_max'] = conn_packets if summary['packets_max'] is None else max(summary['packets_max'], conn_packets)
 
-        if conn['established_before_capture']:
-            established_before_capture += 1
+    # Window sizes
+    if conn_packets:
+        summary['window_count'], summary['window_mean'], summary['window_m2'] = merge_mean_variance(
+            summary['window_count'], summary['window_mean'], summary['window_m2'],
+            conn_packets, conn['window_mean'], conn['window_m2'])
+        summary['window_total'] += conn['window_total']
+        summary['window_min'] = (conn['window_min'] if summary['window_min'] is None
+                                 else min(summary['window_min'], conn['window_min']))
+        summary['window_max'] = (conn['window_max'] if summary['window_max'] is None
+                                 else max(summary['window_max'], conn['window_max']))
 
-        print('END')
-        print('++++++++++++++++++++++++++++++++')
+    # RTT
+    if conn['rtt_count']:
+        summary['rtt_count'] += conn['rtt_count']
+        summary['rtt_total'] += conn['rtt_total']
+        summary['rtt_min'] = conn['rtt_min'] if summary['rtt_min'] is None else min(summary['rtt_min'], conn['rtt_min'])
+        summary['rtt_max'] = conn['rtt_max'] if summary['rtt_max'] is None else max(summary['rtt_max'], conn['rtt_max'])
 
-    # Print general statistics
+    if summary['quantiles']:
+        sketch_merge(summary['rtt_sketch'], conn['rtt_sketch'])
+        sketch_merge(summary['window_sketch'], conn['window_sketch'])
+
+    # Data segment RTT
+    if summary['segment_rtt'] and conn['segment_rtt_count']:
+        summary['segment_rtt_count'] += conn['segment_rtt_count']
+        summary['segment_rtt_total'] += conn['segment_rtt_total']
+        summary['segment_rtt_min'] = (conn['segment_rtt_min'] if summary['segment_rtt_min'] is None
+                                      else min(summary['segment_rtt_min'], conn['segment_rtt_min']))
+        summary['segment_rtt_max'] = (conn['segment_rtt_max'] if summary['segment_rtt_max'] is None
+                                      else max(summary['segment_rtt_max'], conn['segment_rtt_max']))
+        sketch_merge(summary['segment_rtt_sketch'], conn['segment_rtt_sketch'])
+
+def print_general_statistics(summary):
     print('________________________________________________\n')
     print('C) General\n')
-    print(f'Total number of complete TCP connections: {len(complete_connections)}')
-    print(f'Number of reset TCP connections: {reset_connections}')
-    print(f'Number of TCP connections that were still open when the trace capture ended: {open_connections}')
-    print(f'The number of TCP connections established before the capture started: {established_before_capture}')
+    print(f'Total number of complete TCP connections: {summary["complete"]}')
+    print(f'Number of reset TCP connections: {summary["reset"]}')
+    print(f'Number of TCP connections that were still open when the trace capture ended: {summary["open"]}')
+    print(f'The number of TCP connections established before the capture started: {summary["established_before_capture"]}')
+    if summary['seq_analysis']:
+        print(f'Number of retransmitted segments: {summary["retransmissions"]} '
+              f'(in {summary["retransmitting_connections"]} connections)')
+        print(f'Number of out-of-order segments: {summary["out_of_order"]}')
+        print(f'Number of duplicate ACKs: {summary["dup_acks"]}')
+        print(f'Number of zero window events: {summary["zero_windows"]}')
+    if summary['udp_flows']:
+        print(f'Number of UDP flows: {summary["udp_flows"]} '
+              f'({summary["udp_packets"]} packets, {summary["udp_bytes"]} data bytes)')
     print('________________________________________________')
 
-    # Analyze complete connections for statistics
-    analyze_complete_connections(complete_connections)
-
-def analyze_complete_connections(complete_connections):
-    durations = []
-    rtts = []
-    packets_per_connection = []
-    window_sizes = []
-
+def analyze_complete_connections(complete_connections, quantiles=False, segment_rtt=False, seq_analysis=False):
+    summary = new_report_summary(quantiles, segment_rtt, seq_analysis)
     for conn in complete_connections:
-        duration = conn['end_time'] - conn['start_time']
-        durations.append(duration)
-        packets_per_connection.append(len(conn['packets']))
-
-        # Collect window sizes
-        for pkt in conn['packets']:
-            window_sizes.append(pkt['tcp_header']['window_size'])
-
-        # Calculate RTT
-        s = None
-        send_times = {}
-        for pkt in conn['packets']:
-            tcp_header = pkt['tcp_header']
-            direction = pkt['direction']
-            flags = tcp_header['flags']
-            timestamp = pkt['timestamp']
-            seq_num = tcp_header['seq_num']
-            ack_num = tcp_header['ack_num']
-
-            if flags['SYN'] and direction == 'forward' and s is None:
-                s = seq_num
-                send_times[s] = timestamp
-            elif flags['SYN'] and flags['ACK'] and direction == 'reverse' and s is not None:
-                rtt = timestamp - send_times[s]
-                if rtt > 0:
-                    rtts.append(rtt)
-                del send_times[s]
-                s = None
-
-    # Calculate statistics
-    if durations:
-        min_duration = min(durations)
-        mean_duration = sum(durations) / len(durations)
-        max_duration = max(durations)
+        add_to_report_summary(summary, conn)
+    print_complete_statistics(summary)
+
+def print_complete_statistics(summary):
+    # Section D, from the running totals of the complete connections
+    complete = summary['complete']
+    if complete:
+        min_duration = summary['duration_min']
+        mean_duration = summary['duration_total'] / complete
+        max_duration = summary['duration_max']
+        min_packets = summary['packets_min']
+        mean_packets = summary['packets_total'] / complete
+        max_packets = summary['packets_max']
     else:
         min_duration = mean_duration = max_duration = 0
+        min_packets = mean_packets = max_packets = 0
 
-    if rtts:
-        min_rtt = min(rtts)
-        mean_rtt = sum(rtts) / len(rtts)
-        max_rtt = max(rtts)
+    if summary['rtt_count']:
+        min_rtt = summary['rtt_min']
+        mean_rtt = summary['rtt_total'] / summary['rtt_count']
+        max_rtt = summary['rtt_max']
     else:
         min_rtt = mean_rtt = max_rtt = 0
 
-    if packets_per_connection:
-        min_packets = min(packets_per_connection)
-        mean_packets = sum(packets_per_connection) / len(packets_per_connection)
-        max_packets = max(packets_per_connection)
-    else:
-        min_packets = mean_packets = max_packets = 0
-
-    if window_sizes:
-        min_window = min(window_sizes)
-        mean_window = sum(window_sizes) / len(window_sizes)
-        max_window = max(window_sizes)
+    window_count = summary['window_count']
+    if window_count:
+        min_window = summary['window_min']
+        mean_window = summary['window_total'] / window_count
+        max_window = summary['window_max']
     else:
         min_window = mean_window = max_window = 0
 
@@ -380,18 +2865,668 @@ def analyze_complete_connections(complete_connections):
     print(f'Minimum receive window size including both send/received: {int(min_window)} bytes')
     print(f'Mean receive window size including both send/received: {mean_window:.6f} bytes')
     print(f'Maximum receive window size including both send/received: {int(max_window)} bytes')
+    if summary['quantiles']:
+        window_stddev = math.sqrt(summary['window_m2'] / window_count) if window_count else 0
+        print(f'Standard deviation of receive window size: {window_stddev:.6f} bytes\n')
+        print('RTT percentiles (p50/p95/p99): ' + format_percentiles(summary['rtt_sketch'], min_rtt, max_rtt, 6))
+        print('Receive window size percentiles (p50/p95/p99): '
+              + format_percentiles(summary['window_sketch'], min_window, max_window, 0) + ' bytes')
+    if summary['segment_rtt']:
+        samples = summary['segment_rtt_count']
+        print(f'\nNumber of RTT samples from data segments: {samples}')
+        if samples:
+            print(f'Minimum data segment RTT value: {summary["segment_rtt_min"]:.6f}')
+            print(f'Mean data segment RTT value: {summary["segment_rtt_total"] / samples:.6f}')
+            print(f'Maximum data segment RTT value: {summary["segment_rtt_max"]:.6f}')
+            print('Data segment RTT percentiles (p50/p95/p99): ' + format_percentiles(
+                summary['segment_rtt_sketch'], summary['segment_rtt_min'], summary['segment_rtt_max'], 6))
     print('________________________________________________\n')
 
+# Report sinks take finalized connections one at a time, so a report can be
+# written while connections are still being evicted (see new_eviction_policy).
+# A sink is a dict of functions: begin(connection_count) once, where the
+# count is None if connections are reported as they are evicted; write(conn)
+# per connection; and close(eviction=None) at the end.
+REPORT_BATCH_SIZE = 4096  # Connections buffered between writes by the machine-readable sinks
+REPORT_BUFFER_SIZE = 1 << 20  # Bytes buffered by report files
+
+# Columns of the machine-readable reports, one row per connection, with
+# their types; the --rtt and --seq-analysis columns are only there when
+# those measurements are
+REPORT_FIELDS = (
+    ('id', 'int'),
+    ('src_addr', 'str'),
+    ('src_port', 'int'),
+    ('dst_addr', 'str'),
+    ('dst_port', 'int'),
+    ('protocol', 'str'),
+    ('status', 'str'),
+    ('syn_count', 'int'),
+    ('fin_count', 'int'),
+    ('rst_count', 'int'),
+    ('complete', 'bool'),
+    ('established_before_capture', 'bool'),
+    ('start_time', 'float'),
+    ('end_time', 'float'),
+    ('duration', 'float'),
+    ('fwd_packets', 'int'),
+    ('rev_packets', 'int'),
+    ('fwd_bytes', 'int'),
+    ('rev_bytes', 'int'),
+    ('window_min', 'int'),
+    ('window_mean', 'float'),
+    ('window_max', 'int'),
+    ('rtt_count', 'int'),
+    ('rtt_min', 'float'),
+    ('rtt_mean', 'float'),
+    ('rtt_max', 'float'),
+    ('src_mss', 'int'),
+    ('dst_mss', 'int'),
+    ('src_window_scale', 'int'),
+    ('dst_window_scale', 'int')
+)
+SEGMENT_RTT_REPORT_FIELDS = (
+    ('segment_rtt_count', 'int'),
+    ('segment_rtt_min', 'float'),
+    ('segment_rtt_mean', 'float'),
+    ('segment_rtt_max', 'float'),
+    ('segment_rtt_p50', 'float'),
+    ('segment_rtt_p95', 'float'),
+    ('segment_rtt_p99', 'float')
+)
+SEQ_REPORT_FIELDS = tuple((direction + '_' + event, 'int') for event in SEQ_EVENTS for direction in ('fwd', 'rev'))
+
+def report_fields(segment_rtt=False, seq_analysis=False):
+    return (REPORT_FIELDS + (SEGMENT_RTT_REPORT_FIELDS if segment_rtt else ())
+            + (SEQ_REPORT_FIELDS if seq_analysis else ()))
+
+PROTOCOL_NAMES = {IP_PROTOCOL_TCP: 'tcp', IP_PROTOCOL_UDP: 'udp'}
+
+def report_record(conn):
+    # One connection as a flat dict of REPORT_FIELDS (and the optional
+    # fields it has measurements for); None where there is no value
+    udp = conn['protocol'] == IP_PROTOCOL_UDP
+    status = f'S{conn["syn_count"]}F{conn["fin_count"]}'
+    if conn['rst_count'] > 0:
+        status += '/R'
+    window_count = 0 if udp else packet_count(conn)  # UDP datagrams have no window
+    src_options = conn['src_options'] or 0
+    dst_options = conn['dst_options'] or 0
+    record = {
+        'id': conn['id'],
+        'src_addr': format_address(conn['src_addr']),
+        'src_port': conn['src_port'],
+        'dst_addr': format_address(conn['dst_addr']),
+        'dst_port': conn['dst_port'],
+        'protocol': PROTOCOL_NAMES[conn['protocol']],
+        'status': None if udp else status,
+        'syn_count': conn['syn_count'],
+        'fin_count': conn['fin_count'],
+        'rst_count': conn['rst_count'],
+        'complete': conn['complete'],
+        'established_before_capture': conn['established_before_capture'],
+        'start_time': conn['start_time'],
+        'end_time': conn['end_time'],
+        'duration': conn['end_time'] - conn['start_time'],
+        'fwd_packets': conn['fwd_packets'],
+        'rev_packets': conn['rev_packets'],
+        'fwd_bytes': conn['fwd_bytes'],
+        'rev_bytes': conn['rev_bytes'],
+        'window_min': conn['window_min'] if window_count else None,
+        'window_mean': conn['window_total'] / window_count if window_count else None,
+        'window_max': conn['window_max'] if window_count else None,
+        'rtt_count': conn['rtt_count'],
+        'rtt_min': conn['rtt_min'],
+        'rtt_mean': conn['rtt_total'] / conn['rtt_count'] if conn['rtt_count'] else None,
+        'rtt_max': conn['rtt_max'],
+        'src_mss': src_options & 0xFFFF if src_options & OPTION_HAS_MSS else None,
+        'dst_mss': dst_options & 0xFFFF if dst_options & OPTION_HAS_MSS else None,
+        'src_window_scale': (src_options >> 16) & 0xFF if src_options & OPTION_HAS_WSCALE else None,
+        'dst_window_scale': (dst_options >> 16) & 0xFF if dst_options & OPTION_HAS_WSCALE else None
+    }
+    if 'segment_rtt_count' in conn:
+        samples = conn['segment_rtt_count']
+        record['segment_rtt_count'] = samples
+        record['segment_rtt_min'] = conn['segment_rtt_min']
+        record['segment_rtt_mean'] = conn['segment_rtt_total'] / samples if samples else None
+        record['segment_rtt_max'] = conn['segment_rtt_max']
+        for q, name in ((0.5, 'segment_rtt_p50'), (0.95, 'segment_rtt_p95'), (0.99, 'segment_rtt_p99')):
+            record[name] = (min(max(sketch_quantile(conn['segment_rtt_sketch'], q), conn['segment_rtt_min']),
+                                conn['segment_rtt_max']) if samples else None)
+    if 'fwd_retransmissions' in conn:
+        for name, _ in SEQ_REPORT_FIELDS:
+            record[name] = conn[name]
+    return record
+
+def new_report_sink(report_format, output=None, quantiles=False, segment_rtt=False, seq_analysis=False):
+    # output is a file name for the machine-readable formats (standard
+    # output if None); the text report always goes to standard output
+    return REPORT_FORMATS[report_format](output, quantiles, segment_rtt, seq_analysis)
+
+def write_report(connections, sink):
+    # Report a finished table of connections in order
+    sink['begin'](len(connections))
+    for conn in sorted(connections.values(), key=lambda conn: conn['id']):
+        sink['write'](conn)
+    sink['close']()
+
+def text_report_sink(output, quantiles, segment_rtt, seq_analysis):
+    # The printed report: sections A and B, then C and D from running totals
+    summary = new_report_summary(quantiles, segment_rtt, seq_analysis)
+
+    def begin(connection_count):
+        if connection_count is not None:
+            print('\nA) Total number of connections:', connection_count)
+            print('________________________________________________\n')
+            print("B) Connection's details\n")
+        else:
+            print("\nB) Connection's details\n")
+
+    def write(conn):
+        print_connection(conn)
+        add_to_report_summary(summary, conn)
+
+    def close(eviction=None):
+        if eviction is not None:
+            print_evicted_report_totals(summary, eviction)
+        else:
+            print_general_statistics(summary)
+            print_complete_statistics(summary)
+
+    return {'begin': begin, 'write': write, 'close': close}
+
+def open_report_output(output):
+    if output is None:
+        return sys.stdout
+    try:
+        return open(output, 'w', newline='', buffering=REPORT_BUFFER_SIZE)
+    except OSError as e:
+        print(f'Error: Cannot write report to {output}: {e}')
+        sys.exit(1)
+
+def close_report_output(out):
+    if out is sys.stdout:
+        out.flush()
+    else:
+        out.close()
+
+def jsonl_report_sink(output, quantiles, segment_rtt, seq_analysis):
+    # One JSON object per connection and line
+    out = open_report_output(output)
+    encode = json.JSONEncoder(separators=(',', ':')).encode
+    lines = []
+
+    def flush():
+        if lines:
+            lines.append('')
+            out.write('\n'.join(lines))
+            lines.clear()
+
+    def write(conn):
+        lines.append(encode(report_record(conn)))
+        if len(lines) >= REPORT_BATCH_SIZE:
+            flush()
+
+    def close(eviction=None):
+        flush()
+        close_report_output(out)
+
+    return {'begin': lambda connection_count: None, 'write': write, 'close': close}
+
+def csv_report_sink(output, quantiles, segment_rtt, seq_analysis):
+    # A header row, then one row per connection; missing values are empty
+    out = open_report_output(output)
+    names = [name for name, _ in report_fields(segment_rtt, seq_analysis)]
+    writer = csv.writer(out)
+    rows = []
+
+    def begin(connection_count):
+        writer.writerow(names)
+
+    def write(conn):
+        record = report_record(conn)
+        rows.append([record[name] for name in names])
+        if len(rows) >= REPORT_BATCH_SIZE:
+            writer.writerows(rows)
+            rows.clear()
+
+    def close(eviction=None):
+        writer.writerows(rows)
+        rows.clear()
+        close_report_output(out)
+
+    return {'begin': begin, 'write': write, 'close': close}
+
+def import_pyarrow():
+    # PyArrow is optional, and only imported when an Arrow or Parquet report
+    # is asked for since it is slow to load
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        print('Error: Arrow and Parquet reports require PyArrow to be installed.')
+        sys.exit(1)
+    return pyarrow
+
+def columnar_report_sink(output, segment_rtt, seq_analysis, new_writer):
+    # Arrow and Parquet: connections are gathered into columns and written
+    # a record batch at a time. new_writer(pyarrow, output, schema) opens
+    # the file.
+    pa = import_pyarrow()
+    arrow_types = {'int': pa.int64(), 'float': pa.float64(), 'str': pa.string(), 'bool': pa.bool_()}
+    fields = report_fields(segment_rtt, seq_analysis)
+    schema = pa.schema([(name, arrow_types[field_type]) for name, field_type in fields])
+    try:
+        writer = new_writer(pa, output, schema)
+    except OSError as e:
+        print(f'Error: Cannot write report to {output}: {e}')
+        sys.exit(1)
+    columns = {name: [] for name, _ in fields}
+
+    def flush():
+        if columns['id']:
+            writer.write_batch(pa.record_batch([columns[name] for name, _ in fields], schema=schema))
+            for column in columns.values():
+                column.clear()
+
+    def write(conn):
+        record = report_record(conn)
+        for name, column in columns.items():
+            column.append(record[name])
+        if len(columns['id']) >= REPORT_BATCH_SIZE:
+            flush()
+
+    def close(eviction=None):
+        flush()
+        writer.close()
+
+    return {'begin': lambda connection_count: None, 'write': write, 'close': close}
+
+def parquet_report_sink(output, quantiles, segment_rtt, seq_analysis):
+    return columnar_report_sink(output, segment_rtt, seq_analysis,
+                                lambda pa, path, schema: pa.parquet.ParquetWriter(path, schema))
+
+def arrow_report_sink(output, quantiles, segment_rtt, seq_analysis):
+    # Arrow IPC file format (Feather v2)
+    return columnar_report_sink(output, segment_rtt, seq_analysis,
+                                lambda pa, path, schema: pa.ipc.new_file(path, schema))
+
+REPORT_FORMATS = {
+    'text': text_report_sink,
+    'jsonl': jsonl_report_sink,
+    'csv': csv_report_sink,
+    'parquet': parquet_report_sink,
+    'arrow': arrow_report_sink
+}
+
+# CSV columns of the --series exports; time is the start of the bucket in
+# seconds from the start of the capture
+CAPTURE_SERIES_FIELDS = ('time', 'packets', 'data_bytes', 'packets_per_sec', 'data_bytes_per_sec',
+                         'new_connections', 'new_connections_per_sec', 'active_connections')
+CONNECTION_SERIES_FIELDS = ('id', 'time', 'packets', 'data_bytes', 'packets_per_sec', 'data_bytes_per_sec')
+
+def series_report_sink(sink, bucket_width, output=None, connection_output=None):
+    # Wrap a report sink to also add up the capture-wide series from the
+    # connections reported, written to output when the report is closed,
+    # and to write each connection's series to connection_output as it is
+    # reported (one row per bucket of its lifetime, by connection id)
+    capture_series = new_capture_series(bucket_width)
+    out = open_report_output(output) if output is not None else None
+    connection_out = open_report_output(connection_output) if connection_output is not None else None
+    if connection_out is not None:
+        connection_writer = csv.writer(connection_out)
+        connection_writer.writerow(CONNECTION_SERIES_FIELDS)
+
+    def write(conn):
+        add_to_capture_series(capture_series, conn)
+        if connection_out is not None:
+            conn_id = conn['id']
+            start = conn['series_start']
+            connection_writer.writerows(
+                (conn_id, round(index * bucket_width, 6), packets, data_bytes,
+                 packets / bucket_width, data_bytes / bucket_width)
+                for index, (packets, data_bytes) in enumerate(zip(conn['series_packets'], conn['series_bytes']),
+                                                              start)
+            )
+        sink['write'](conn)
+
+    def close(eviction=None):
+        sink['close'](eviction)
+        if connection_out is not None:
+            close_report_output(connection_out)
+        if out is not None:
+            write_capture_series(out, capture_series)
+            close_report_output(out)
+
+    return {'begin': sink['begin'], 'write': write, 'close': close}
+
+def write_capture_series(out, capture_series):
+    bucket_width = capture_series['bucket_width']
+    columns = [capture_series[name]
+               for name in ('packets', 'data_bytes', 'new_connections', 'active_connections')]
+    bucket_count = max(len(column) for column in columns)
+    for column in columns:
+        grow_buckets(column, bucket_count)
+    writer = csv.writer(out)
+    writer.writerow(CAPTURE_SERIES_FIELDS)
+    writer.writerows(
+        (round(index * bucket_width, 6), packets, data_bytes, packets / bucket_width, data_bytes / bucket_width,
+         new_connections, new_connections / bucket_width, active_connections)
+        for index, (packets, data_bytes, new_connections, active_connections) in enumerate(zip(*columns))
+    )
+
+# --profile: wall-clock and CPU time per pipeline stage, the decoders'
+# packet counters and optionally samples of the Python stack, written as a
+# JSON summary at the end of the run. Stages are timed around batches of
+# segments rather than single packets, so profiling costs little, and
+# nothing when it is off.
+PROFILE_BATCH_SIZE = 4096
+PROFILE_SAMPLE_INTERVAL = 0.005  # CPU seconds between stack samples
+PROFILE_TOP_FUNCTIONS = 25
+
+def new_profile():
+    return {
+        'start': (time.perf_counter(), time.process_time(),
+                  resource.getrusage(resource.RUSAGE_SELF) if resource is not None else None),
+        'stages': {},
+        'counters': {'decoded': 0},  # The decoders add their skip counts (and 'truncated') here
+        'connections': 0,
+        'sampler': None
+    }
+
+def add_stage_time(profile, stage, wall_seconds, cpu_seconds):
+    times = profile['stages'].setdefault(stage, {'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+    times['wall_seconds'] += wall_seconds
+    times['cpu_seconds'] += cpu_seconds
+
+@contextlib.contextmanager
+def profile_stage(profile, stage):
+    # Time the body as a stage, if there is a profile
+    if profile is None:
+        yield
+        return
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        add_stage_time(profile, stage, time.perf_counter() - wall, time.process_time() - cpu)
+
+def profiled_segments(segments, profile):
+    # Pass segments through a batch at a time, timing how long the decoder
+    # took to produce each batch ('decode', which includes reading the
+    # memory-mapped capture) and how long the consumer spent on it ('track')
+    segments = iter(segments)
+    counters = profile['counters']
+    decode_wall = decode_cpu = track_wall = track_cpu = 0.0
+    wall, cpu = time.perf_counter(), time.process_time()
+    while True:
+        batch = list(islice(segments, PROFILE_BATCH_SIZE))
+        now_wall, now_cpu = time.perf_counter(), time.process_time()
+        decode_wall += now_wall - wall
+        decode_cpu += now_cpu - cpu
+        if not batch:
+            break
+        counters['decoded'] += len(batch)
+        yield from batch
+        wall, cpu = time.perf_counter(), time.process_time()
+        track_wall += wall - now_wall
+        track_cpu += cpu - now_cpu
+    add_stage_time(profile, 'decode', decode_wall, decode_cpu)
+    add_stage_time(profile, 'track', track_wall, track_cpu)
+
+def start_sampler(profile, interval=PROFILE_SAMPLE_INTERVAL):
+    # Sample the Python stack every interval seconds of CPU time (SIGPROF),
+    # counting each distinct stack
+    stacks = {}
+    names = {}
+
+    def sample(signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            name = names.get(code)
+            if name is None:
+                name = names[code] = f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+            stack.append(name)
+            frame = frame.f_back
+        key = ';'.join(reversed(stack))
+        stacks[key] = stacks.get(key, 0) + 1
+
+    profile['sampler'] = {
+        'interval': interval,
+        'stacks': stacks,
+        'previous_handler': signal.signal(signal.SIGPROF, sample)
+    }
+    signal.setitimer(signal.ITIMER_PROF, interval, interval)
+
+def stop_sampler(profile):
+    sampler = profile['sampler']
+    if sampler is not None:
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, sampler['previous_handler'])
+
+def sampler_summary(sampler):
+    # The functions seen most often at the top of the stack (self) and
+    # anywhere on it (total), plus every stack in collapsed form (callers
+    # first, separated by ';'), as flame graph tools read them
+    self_samples = {}
+    total_samples = {}
+    for stack, count in sampler['stacks'].items():
+        functions = stack.split(';')
+        self_samples[functions[-1]] = self_samples.get(functions[-1], 0) + count
+        for function in set(functions):
+            total_samples[function] = total_samples.get(function, 0) + count
+    top = sorted(self_samples, key=self_samples.get, reverse=True)[:PROFILE_TOP_FUNCTIONS]
+    return {
+        'interval_seconds': sampler['interval'],
+        'samples': sum(sampler['stacks'].values()),
+        'functions': [{'function': function, 'self': self_samples[function], 'total': total_samples[function]}
+                      for function in top],
+        'stacks': sampler['stacks']
+    }
+
+def profile_summary(profile, filenames):
+    start_wall, start_cpu, start_usage = profile['start']
+    wall_seconds = time.perf_counter() - start_wall
+    counters = profile['counters']
+    skipped = {reason: counters.get(reason, 0) for reason in SKIP_REASONS}
+    packets = counters['decoded'] + sum(skipped.values())
+    capture_bytes = sum(os.path.getsize(filename) for filename in filenames)
+    summary = {
+        'capture_files': filenames,
+        'capture_mb': capture_bytes / 1e6,
+        'wall_seconds': wall_seconds,
+        'cpu_seconds': time.process_time() - start_cpu,
+        'stages': profile['stages'],
+        'counters': dict(packets=packets, decoded=counters['decoded'], **skipped),
+        'truncated': counters.get('truncated', False),
+        'connections': profile['connections'],
+        'packets_per_sec': packets / wall_seconds if wall_seconds else 0,
+        'mb_per_sec': capture_bytes / wall_seconds / 1e6 if wall_seconds else 0
+    }
+    if start_usage is not None:
+        # Major page faults and blocks read show how much of the decode stage
+        # waited on the disk rather than on the CPU
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        summary['major_page_faults'] = usage.ru_majflt - start_usage.ru_majflt
+        summary['blocks_read'] = usage.ru_inblock - start_usage.ru_inblock
+        summary['peak_rss_mb'] = usage.ru_maxrss / 1024
+    if profile['sampler'] is not None:
+        summary['sampling'] = sampler_summary(profile['sampler'])
+    return summary
+
+def write_profile(output, summary):
+    # The summary as JSON, to standard error if output is '-'
+    if output == '-':
+        json.dump(summary, sys.stderr, indent=2)
+        sys.stderr.write('\n')
+        return
+    with open(output, 'w') as f:
+        json.dump(summary, f, indent=2)
+        f.write('\n')
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Report on the TCP connections in a pcap capture.')
+    parser.add_argument('capture_files', nargs='+', metavar='capture_file',
+                        help='pcap or pcapng capture; several captures (or a quoted glob pattern, e.g. '
+                             '"trace-*.pcap") are analyzed as one, merged by timestamp')
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='python',
+                        help='packet decoder: python (default) or numpy (vectorized, needs NumPy; '
+                             'Ethernet pcap captures only, others use python)')
+    parser.add_argument('--workers', type=int, default=1, metavar='N',
+                        help='analyze the capture in N processes (default 1)')
+    parser.add_argument('--follow', action='store_true',
+                        help='keep reading the capture as it grows (like tail -f); Ctrl-C prints the report')
+    parser.add_argument('--interval', type=float, default=10.0, metavar='SECONDS',
+                        help='seconds between summaries in --follow mode (default 10)')
+    parser.add_argument('--idle-timeout', type=float, metavar='SECONDS',
+                        help='report and drop connections idle this long (capture time); '
+                             'connections are then printed as they are dropped')
+    parser.add_argument('--close-grace', type=float, default=DEFAULT_CLOSE_GRACE, metavar='SECONDS',
+                        help='with --idle-timeout or --max-connections, drop connections this long after '
+                             f'their last packet once a FIN or RST was seen (default {DEFAULT_CLOSE_GRACE:g})')
+    parser.add_argument('--max-connections', type=int, metavar='N',
+                        help='keep at most N live connections, dropping the least recently active')
+    parser.add_argument('--quantiles', action='store_true',
+                        help='also report RTT and window size percentiles (streaming sketches, ~1%% error)')
+    parser.add_argument('--rtt', action='store_true',
+                        help='also measure RTT from every data segment to the ACK covering it '
+                             "(Karn's rule), per connection")
+    parser.add_argument('--seq-analysis', action='store_true',
+                        help='also count retransmissions, out-of-order segments, duplicate ACKs and '
+                             'zero window events per connection')
+    parser.add_argument('--filter', metavar='EXPRESSION',
+                        help='only analyze packets matching a BPF-like EXPRESSION, e.g. '
+                             '"net 10.0.0.0/8 and (port 80 or port 443)": [src|dst] host, net, port, portrange, '
+                             'ip, ip6, tcp, udp, tcp-syn and the other TCP flags, and/or/not, parentheses')
+    parser.add_argument('--report-format', choices=list(REPORT_FORMATS), default='text',
+                        help='report as text (default), one JSON object per connection (jsonl), CSV, '
+                             'or Parquet / Arrow tables (need PyArrow and --output); with --idle-timeout or '
+                             '--max-connections connections are written as they are dropped')
+    parser.add_argument('--output', metavar='FILE',
+                        help='write the jsonl, csv, parquet or arrow report to FILE instead of standard output')
+    parser.add_argument('--series', type=float, metavar='SECONDS',
+                        help='count packets, data bytes, new and active connections per SECONDS of capture time, '
+                             'for the whole capture (--series-output) and each connection (--connection-series)')
+    parser.add_argument('--series-output', metavar='FILE',
+                        help='with --series, write the capture-wide series to FILE as CSV')
+    parser.add_argument('--connection-series', metavar='FILE',
+                        help="with --series, write each connection's series to FILE as CSV, by connection id")
+    parser.add_argument('--profile', nargs='?', const='-', metavar='FILE',
+                        help='time each stage (decode, track, finalize, report), count packets decoded and '
+                             'skipped (filtered, malformed, non-IP, neither TCP nor UDP) and write the summary as JSON '
+                             'to FILE, or to standard error')
+    parser.add_argument('--profile-sample', action='store_true',
+                        help=f'with --profile, also sample the Python stack every '
+                             f'{PROFILE_SAMPLE_INTERVAL * 1000:g} ms of CPU time and report the hottest functions')
+    parser.add_argument('--index', action='store_true',
+                        help=f'save the decoded packets to CAPTURE{INDEX_SUFFIX} and read them from there on '
+                             'later runs, until the capture changes')
+    args = parser.parse_args(argv)
+    args.capture_files = expand_capture_files(args.capture_files)
+    if len(args.capture_files) > 1 and (args.follow or args.workers > 1):
+        parser.error('--follow and --workers read a single capture file')
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.follow and (args.workers > 1 or args.engine != 'python'):
+        parser.error('--follow reads the capture with the python engine in a single process')
+    if (args.rtt or args.seq_analysis) and args.workers > 1:
+        parser.error('--rtt and --seq-analysis need a single process')
+    if args.index and (args.follow or args.workers > 1):
+        parser.error('--index is written and read by a single process, without --follow')
+    if args.series is not None and args.series <= 0:
+        parser.error('--series must be positive')
+    if (args.series is None) != (args.series_output is None and args.connection_series is None):
+        parser.error('--series needs --series-output and/or --connection-series, and they need --series')
+    if args.profile is not None and (args.follow or args.workers > 1):
+        parser.error('--profile times a single process, without --follow')
+    if args.profile_sample and (args.profile is None or not hasattr(signal, 'setitimer')):
+        parser.error('--profile-sample needs --profile and a system with setitimer')
+    if args.output is not None and args.report_format == 'text':
+        parser.error('--output is for the jsonl, csv, parquet and arrow reports')
+    if args.output is None and args.report_format in ('parquet', 'arrow'):
+        parser.error(f'--report-format {args.report_format} needs --output')
+    try:
+        args.packet_filter = compile_packet_filter(args.filter) if args.filter is not None else None
+    except ValueError as e:
+        parser.error(f'--filter: {e}')
+    if args.interval <= 0:
+        parser.error('--interval must be positive')
+    args.bounded = args.idle_timeout is not None or args.max_connections is not None
+    if args.bounded and args.workers > 1:
+        parser.error('--idle-timeout and --max-connections need a single process')
+    if args.max_connections is not None and args.max_connections < 1:
+        parser.error('--max-connections must be at least 1')
+    if args.close_grace < 0 or (args.idle_timeout is not None and args.idle_timeout < 0):
+        parser.error('--idle-timeout and --close-grace must not be negative')
+    return args
+
 def main():
-    if len(sys.argv) != 2:
-        print('Usage: python tcp_analyzer.py <capture_file>')
+    args = parse_args()
+    if args.engine == 'numpy' and np is None:
+        print('Error: --engine numpy requires NumPy to be installed.')
         sys.exit(1)
 
-    capture_file = sys.argv[1]
-    endian, data = read_pcap_file(capture_file)
-    packets = parse_packets(endian, data)
-    connections = analyze_packets(packets)
-    print_connection_details(connections)
+    # Per-connection measurements, passed on to track_connections
+    options = {'quantiles': args.quantiles, 'segment_rtt': args.rtt, 'seq_analysis': args.seq_analysis,
+               'series': args.series}
+
+    profile = new_profile() if args.profile is not None else None
+    if args.profile_sample:
+        start_sampler(profile)
+
+    sink = new_report_sink(args.report_format, args.output, args.quantiles, args.rtt, args.seq_analysis)
+    if args.series is not None:
+        sink = series_report_sink(sink, args.series, args.series_output, args.connection_series)
+    # Records written to standard output must stay parseable, so warnings and
+    # --follow summaries go to standard error instead
+    with (contextlib.redirect_stdout(sys.stderr) if args.report_format != 'text' and args.output is None
+          else contextlib.nullcontext()):
+        run_report(args, options, sink, profile)
+
+    if profile is not None:
+        stop_sampler(profile)
+        write_profile(args.profile, profile_summary(profile, args.capture_files))
+
+def run_report(args, options, sink, profile=None):
+    eviction = None
+    if args.bounded:
+        eviction = new_eviction_policy(sink['write'], args.idle_timeout, args.close_grace, args.max_connections)
+        sink['begin'](None)
+
+    if args.follow:
+        connections = follow_capture(args.capture_files[0], args.interval, eviction=eviction,
+                                     packet_filter=args.packet_filter, **options)
+    elif args.workers > 1:
+        connections = analyze_pcap_file_parallel(args.capture_files[0], args.workers, args.engine,
+                                                 args.packet_filter, **options)
+    else:
+        stats = profile['counters'] if profile is not None else None
+        if args.index:
+            decode = partial(indexed_segments, engine=args.engine, packet_filter=args.packet_filter, stats=stats)
+        else:
+            decode = partial(decode_pcap_file, engine=args.engine, packet_filter=args.packet_filter, stats=stats)
+        if len(args.capture_files) == 1:
+            segments = decode(args.capture_files[0])
+        else:
+            segments = merge_capture_segments(args.capture_files, decode)
+        if profile is not None:
+            segments = profiled_segments(segments, profile)
+        if eviction is not None:
+            connections = track_connections(segments, eviction=eviction, **options)
+        else:
+            connections = track_connections(segments, **options)
+            with profile_stage(profile, 'finalize'):
+                finalize_connections(connections)
+
+    if profile is not None:
+        profile['connections'] = eviction['created'] if eviction is not None else len(connections)
+    with profile_stage(profile, 'report'):
+        if eviction is not None:
+            flush_connections(connections, eviction)
+            sink['close'](eviction)
+        else:
+            write_report(connections, sink)
 
 if __name__ == '__main__':
     main()
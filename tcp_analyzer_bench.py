@@ -0,0 +1,669 @@
+from datetime import datetime, timezone
+from heapq import heappop, heappush
+import argparse
+import contextlib
+import importlib.util
+import json
+import os
+import platform
+import random
+import resource
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+import tcp_analyzer
+
+# Synthetic packet layout: Ethernet + IPv4 + TCP + payload, with the usual
+# Linux options (MSS, SACK permitted, timestamps, window scale) on the SYNs
+SYNTHETIC_PAYLOAD_SIZE = 64
+PACKETS_PER_FLOW = 20
+
+PCAP_GLOBAL_HEADER = struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1)
+PCAP_GLOBAL_HEADER_STRUCT = struct.Struct('<IHHiIII')
+RECORD_HEADER = struct.Struct('<IIII')
+PCAPNG_BLOCK_HEADER = struct.Struct('<II')
+PCAPNG_SECTION_HEADER = struct.Struct('<IIIHHq')
+PCAPNG_INTERFACE_DESCRIPTION = struct.Struct('<IIHHI')
+PCAPNG_ENHANCED_PACKET = struct.Struct('<IIIIIII')
+
+# Synthetic capture layouts for --formats: container, link-layer framing and
+# timestamp resolution
+LAYOUTS = ('ethernet', 'ethernet-ns', 'vlan', 'sll', 'pcapng')
+ETHERNET_HEADER = struct.Struct('!6s6sH')
+IP_HEADER = struct.Struct('!BBHHHBBH4s4s')
+TCP_HEADER = struct.Struct('!HHLLBBHHH')
+UDP_HEADER = struct.Struct('!HHHH')
+
+FIN, SYN, RST, PSH, ACK = 0x01, 0x02, 0x04, 0x08, 0x10
+SYN_OPTIONS = (struct.pack('!BBH', 2, 4, 1460) + bytes([4, 2]) + struct.pack('!BBII', 8, 10, 1, 0)
+               + bytes([1, 3, 3, 7]))
+
+def build_packet(src_ip, dst_ip, src_port, dst_port, seq, ack, flags, payload_size, options=b'', window=65535):
+    tcp_header_size = tcp_analyzer.TCP_HEADER_MIN_SIZE + len(options)
+    total_length = tcp_analyzer.IP_HEADER_MIN_SIZE + tcp_header_size + payload_size
+    eth = ETHERNET_HEADER.pack(b'\x00\x11\x22\x33\x44\x55', b'\x66\x77\x88\x99\xaa\xbb', 0x0800)
+    ip = IP_HEADER.pack(0x45, 0, total_length, 0, 0, 64, 6, 0, src_ip, dst_ip)
+    tcp = TCP_HEADER.pack(src_port, dst_port, seq & 0xFFFFFFFF, ack & 0xFFFFFFFF, (tcp_header_size // 4) << 4,
+                          flags, window, 0, 0)
+    return eth + ip + tcp + options + b'\x00' * payload_size
+
+def build_udp_packet(src_ip, dst_ip, src_port, dst_port, payload_size):
+    total_length = tcp_analyzer.IP_HEADER_MIN_SIZE + tcp_analyzer.UDP_HEADER_SIZE + payload_size
+    eth = ETHERNET_HEADER.pack(b'\x00\x11\x22\x33\x44\x55', b'\x66\x77\x88\x99\xaa\xbb', 0x0800)
+    ip = IP_HEADER.pack(0x45, 0, total_length, 0, 0, 64, 17, 0, src_ip, dst_ip)
+    udp = UDP_HEADER.pack(src_port, dst_port, tcp_analyzer.UDP_HEADER_SIZE + payload_size, 0)
+    return eth + ip + udp + b'\x00' * payload_size
+
+def flow_packets(flow_index, packet_count, payload_size=SYNTHETIC_PAYLOAD_SIZE):
+    # One client/server conversation: handshake, alternating data, teardown
+    client = struct.pack('!I', 0x0a000000 + (flow_index % 0xFFFFFF) + 1)
+    server = struct.pack('!I', 0xc0a80001 + (flow_index // 50000))
+    client_port = 1024 + flow_index % 60000
+    server_port = 80
+    c_seq, s_seq = 1000, 5000
+
+    yield True, build_packet(client, server, client_port, server_port, c_seq, 0, SYN, 0, SYN_OPTIONS)
+    yield False, build_packet(server, client, server_port, client_port, s_seq, c_seq + 1, SYN | ACK, 0, SYN_OPTIONS)
+    c_seq += 1
+    s_seq += 1
+    yield True, build_packet(client, server, client_port, server_port, c_seq, s_seq, ACK, 0)
+
+    for i in range(max(packet_count - 7, 0)):
+        if i % 2 == 0:
+            yield True, build_packet(client, server, client_port, server_port, c_seq, s_seq, PSH | ACK, payload_size)
+            c_seq += payload_size
+        else:
+            yield False, build_packet(server, client, server_port, client_port, s_seq, c_seq, PSH | ACK, payload_size)
+            s_seq += payload_size
+
+    yield True, build_packet(client, server, client_port, server_port, c_seq, s_seq, FIN | ACK, 0)
+    yield False, build_packet(server, client, server_port, client_port, s_seq, c_seq + 1, ACK, 0)
+    yield False, build_packet(server, client, server_port, client_port, s_seq, c_seq + 1, FIN | ACK, 0)
+    yield True, build_packet(client, server, client_port, server_port, c_seq + 1, s_seq + 1, ACK, 0)
+
+def frame_packet(packet, layout):
+    # Re-frame an Ethernet packet for a layout's link layer
+    if layout == 'vlan':
+        return packet[:12] + struct.pack('!HH', 0x8100, 100) + packet[12:]
+    if layout == 'sll':
+        return struct.pack('!HHH8sH', 0, 1, 6, packet[6:12], 0x0800) + packet[14:]
+    return packet
+
+def write_capture_header(f, layout):
+    if layout == 'pcapng':
+        f.write(PCAPNG_SECTION_HEADER.pack(tcp_analyzer.PCAPNG_SECTION_HEADER_BLOCK, 28,
+                                           tcp_analyzer.PCAPNG_BYTE_ORDER_MAGIC, 1, 0, -1))
+        f.write(struct.pack('<I', 28))
+        # Interface with nanosecond timestamps (if_tsresol = 9)
+        f.write(PCAPNG_INTERFACE_DESCRIPTION.pack(tcp_analyzer.PCAPNG_INTERFACE_DESCRIPTION_BLOCK, 32,
+                                                  tcp_analyzer.LINKTYPE_ETHERNET, 0, 65535))
+        f.write(struct.pack('<HHBxxxHHI', tcp_analyzer.PCAPNG_OPTION_IF_TSRESOL, 1, 9, 0, 0, 32))
+        return
+    magic = tcp_analyzer.PCAP_MAGIC_NSEC if layout == 'ethernet-ns' else tcp_analyzer.PCAP_MAGIC_USEC
+    link_type = tcp_analyzer.LINKTYPE_LINUX_SLL if layout == 'sll' else tcp_analyzer.LINKTYPE_ETHERNET
+    f.write(PCAP_GLOBAL_HEADER_STRUCT.pack(magic, 2, 4, 0, 0, 65535, link_type))
+
+def write_record(f, layout, timestamp_usec, packet):
+    if layout == 'pcapng':
+        padding = -len(packet) % 4
+        block_length = PCAPNG_ENHANCED_PACKET.size + len(packet) + padding + 4
+        timestamp_nsec = timestamp_usec * 1000
+        f.write(PCAPNG_ENHANCED_PACKET.pack(tcp_analyzer.PCAPNG_ENHANCED_PACKET_BLOCK, block_length, 0,
+                                            timestamp_nsec >> 32, timestamp_nsec & 0xFFFFFFFF,
+                                            len(packet), len(packet)))
+        f.write(packet + b'\x00' * padding + struct.pack('<I', block_length))
+        return
+    ts_frac = timestamp_usec % 1000000
+    if layout == 'ethernet-ns':
+        ts_frac *= 1000
+    f.write(RECORD_HEADER.pack(timestamp_usec // 1000000, ts_frac, len(packet), len(packet)))
+    f.write(packet)
+
+def write_synthetic_pcap(filename, packet_count, packets_per_flow=PACKETS_PER_FLOW, layout='ethernet'):
+    written = 0
+    timestamp_usec = 0
+    with open(filename, 'wb') as f:
+        write_capture_header(f, layout)
+        flow_index = 0
+        while written < packet_count:
+            for _, packet in flow_packets(flow_index, min(packets_per_flow, packet_count - written)):
+                timestamp_usec += 10
+                write_record(f, layout, timestamp_usec, frame_packet(packet, layout))
+                written += 1
+                if written == packet_count:
+                    break
+            flow_index += 1
+    return written
+
+# Realistic traffic (--realistic): flows overlap in time, each with its own
+# round-trip time and request/response exchanges of mixed segment sizes,
+# and some flows reset, retransmit segments or were already open when the
+# capture started
+REALISTIC_PROFILE = {
+    'packets_per_flow': 40,   # Mean; flow lengths are exponentially distributed
+    'concurrency': 1000,      # Flows open at once
+    'reset_rate': 0.05,       # Flows torn down by a RST instead of FINs
+    'retransmit_rate': 0.01,  # Data segments sent again after a retransmission timeout
+    'midstream_rate': 0.02,   # Flows whose handshake is not in the capture
+    'udp_rate': 0.05,         # Flows that are UDP request/response exchanges instead of TCP
+    'seed': 1
+}
+SERVER_PORTS = (443, 80, 8080, 22)
+UDP_SERVER_PORTS = (53, 443)
+MSS = 1460
+MIN_RTO = 0.2
+CAPTURE_START_USEC = 1700000000 * 1000000
+
+def realistic_flow_packets(flow_index, packet_count, rng, profile):
+    # One flow of about packet_count packets as (seconds since the flow
+    # started, packet) pairs in time order, seen from the client's side
+    client = struct.pack('!I', 0x0a000000 + (flow_index % 0xFFFFFF) + 1)
+    server = struct.pack('!I', 0xc0a80001 + rng.randrange(64))
+    client_port = 1024 + flow_index % 60000
+    if rng.random() < profile['udp_rate']:
+        return realistic_udp_flow_packets(client, server, client_port, packet_count, rng)
+    server_port = rng.choice(SERVER_PORTS)
+    rtt = rng.uniform(0.0005, 0.1)
+    window = rng.choice((29200, 64240, 65535))
+    c_seq, s_seq = rng.getrandbits(32), rng.getrandbits(32)
+
+    def packet(from_client, flags, payload_size=0, options=b''):
+        if from_client:
+            return build_packet(client, server, client_port, server_port, c_seq, s_seq, flags, payload_size,
+                                options, window)
+        return build_packet(server, client, server_port, client_port, s_seq, c_seq, flags, payload_size,
+                            options, window)
+
+    events = []
+    now = 0.0
+    if rng.random() >= profile['midstream_rate']:
+        events.append((now, packet(True, SYN, options=SYN_OPTIONS)))
+        c_seq += 1
+        now += rtt
+        events.append((now, packet(False, SYN | ACK, options=SYN_OPTIONS)))
+        s_seq += 1
+        now += 0.00005
+        events.append((now, packet(True, ACK)))
+
+    while len(events) < packet_count - 4:
+        # A request, then a response of full-size segments and a partial
+        # one, with the client ACKing every second segment
+        now += rng.uniform(0.0001, 0.01)
+        size = rng.randint(80, 800)
+        events.append((now, packet(True, PSH | ACK, size)))
+        c_seq += size
+        now += rtt
+        segment_count = rng.randint(1, 8)
+        for i in range(segment_count):
+            last = i == segment_count - 1
+            size = rng.randint(100, MSS) if last else MSS
+            flags = PSH | ACK if last else ACK
+            events.append((now, packet(False, flags, size)))
+            if rng.random() < profile['retransmit_rate']:
+                events.append((now + max(MIN_RTO, 3 * rtt), packet(False, flags, size)))
+            s_seq += size
+            now += 0.00002
+            if i % 2 or last:
+                events.append((now, packet(True, ACK)))
+
+    now += rng.uniform(0.0001, 0.01)
+    if rng.random() < profile['reset_rate']:
+        events.append((now, packet(rng.random() < 0.5, RST | ACK)))
+    else:
+        events.append((now, packet(True, FIN | ACK)))
+        c_seq += 1
+        now += rtt
+        events.append((now, packet(False, ACK)))
+        events.append((now + 0.00002, packet(False, FIN | ACK)))
+        s_seq += 1
+        events.append((now + rtt, packet(True, ACK)))
+    events.sort(key=lambda event: event[0])
+    return events
+
+def realistic_udp_flow_packets(client, server, client_port, packet_count, rng):
+    # A UDP flow (DNS or QUIC, say) of requests each answered a round trip
+    # later, in the same form as realistic_flow_packets
+    server_port = rng.choice(UDP_SERVER_PORTS)
+    rtt = rng.uniform(0.0005, 0.1)
+    events = []
+    now = 0.0
+    for i in range(packet_count // 2):
+        now += rng.uniform(0.0001, 0.01)
+        events.append((now, build_udp_packet(client, server, client_port, server_port, rng.randint(40, 1200))))
+        now += rtt
+        events.append((now, build_udp_packet(server, client, server_port, client_port, rng.randint(40, 1200))))
+    return events
+
+def write_realistic_pcap(filename, packet_count, profile=REALISTIC_PROFILE, layout='ethernet'):
+    # Flows start at a steady rate, chosen from the mean flow duration so far
+    # so that about profile['concurrency'] are open at once; their packets
+    # are interleaved by time through a heap
+    rng = random.Random(profile['seed'])
+    heap = []
+    generated = written = flow_index = 0
+    flow_start = total_duration = 0.0
+    with open(filename, 'wb') as f:
+        write_capture_header(f, layout)
+        while generated < packet_count:
+            flow_length = max(8, round(rng.expovariate(1 / profile['packets_per_flow'])))
+            events = realistic_flow_packets(flow_index, flow_length, rng, profile)
+            for offset, packet in events:
+                heappush(heap, (flow_start + offset, generated, packet))
+                generated += 1
+            flow_index += 1
+            total_duration += events[-1][0]
+            flow_start += total_duration / flow_index / profile['concurrency']
+            # Later flows start after flow_start, so everything before it is final
+            while heap and heap[0][0] < flow_start and written < packet_count:
+                timestamp, _, packet = heappop(heap)
+                write_record(f, layout, CAPTURE_START_USEC + round(timestamp * 1e6), frame_packet(packet, layout))
+                written += 1
+        while heap and written < packet_count:
+            timestamp, _, packet = heappop(heap)
+            write_record(f, layout, CAPTURE_START_USEC + round(timestamp * 1e6), frame_packet(packet, layout))
+            written += 1
+    return written
+
+def write_capture(filename, packet_count, profile=None, layout='ethernet'):
+    # The simple synthetic traffic, or realistic traffic for a profile
+    if profile is None:
+        return write_synthetic_pcap(filename, packet_count, layout=layout)
+    return write_realistic_pcap(filename, packet_count, profile, layout)
+
+def one_percent_filter(packet_count, packets_per_flow=PACKETS_PER_FLOW):
+    # A --filter expression matching the flows on the lowest 1% of the client
+    # ports flow_packets uses, so about 1% of the packets
+    flows = min(-(-packet_count // packets_per_flow), 60000)
+    return f'portrange 1024-{1024 + max(flows // 100, 1) - 1}'
+
+# Benchmark modes, each run in a fresh interpreter so peak RSS is per mode.
+# The filter-* modes take a --filter expression.
+def run_mode(mode, filename, filter_expression=None):
+    packet_filter = tcp_analyzer.compile_packet_filter(filter_expression) if filter_expression else None
+    start = time.perf_counter()
+    packets = 0
+    stages = {}
+    if mode == 'whole-file':
+        endian, data, ts_divisor = tcp_analyzer.read_pcap_file(filename)
+        packets = len(tcp_analyzer.parse_packets(endian, data, ts_divisor))
+    elif mode == 'stream':
+        for _ in tcp_analyzer.stream_pcap_file(filename):
+            packets += 1
+    elif mode == 'scalar-decode':
+        for _ in tcp_analyzer.decode_packets(tcp_analyzer.stream_pcap_file(filename)):
+            packets += 1
+    elif mode == 'mmap-decode':
+        for _ in tcp_analyzer.decode_pcap_file(filename):
+            packets += 1
+    elif mode == 'numpy-decode':
+        for _ in tcp_analyzer.decode_pcap_file(filename, 'numpy'):
+            packets += 1
+    elif mode == 'post-filter-decode':
+        # Decode everything, then drop what the filter rejects
+        for _ in filter(packet_filter['segment'], tcp_analyzer.decode_pcap_file(filename)):
+            packets += 1
+    elif mode in ('filter-decode', 'numpy-filter-decode'):
+        engine = 'numpy' if mode == 'numpy-filter-decode' else 'python'
+        for _ in tcp_analyzer.decode_pcap_file(filename, engine, packet_filter=packet_filter):
+            packets += 1
+    elif mode in ('index-write', 'index-read'):
+        # index-write decodes the capture and saves its index, index-read
+        # (run after it) loads the segments back from that index
+        segments = tcp_analyzer.indexed_segments(filename)
+        for _ in segments:
+            packets += 1
+    elif mode.startswith('workers-'):
+        connections = tcp_analyzer.analyze_pcap_file_parallel(filename, int(mode.split('-')[1]))
+        packets = sum(tcp_analyzer.packet_count(conn) for conn in connections.values())
+    elif mode in ('analyze', 'numpy-analyze', 'rtt-analyze', 'seq-analyze'):
+        engine = 'numpy' if mode == 'numpy-analyze' else 'python'
+        connections = tcp_analyzer.analyze_segments(tcp_analyzer.decode_pcap_file(filename, engine),
+                                                    segment_rtt=mode == 'rtt-analyze',
+                                                    seq_analysis=mode == 'seq-analyze')
+        packets = sum(tcp_analyzer.packet_count(conn) for conn in connections.values())
+    elif mode == 'stored-analyze':
+        # analyze keeping every packet of every connection, each of whose
+        # columns must then hold one entry per packet counted
+        connections = tcp_analyzer.analyze_segments(tcp_analyzer.decode_pcap_file(filename), store_packets=True)
+        for conn in connections.values():
+            packets += tcp_analyzer.packet_count(conn)
+            for name, column in conn['packets'].items():
+                if len(column) != tcp_analyzer.packet_count(conn):
+                    sys.exit(f'stored-analyze: {len(column)} {name} values kept for '
+                             f'{tcp_analyzer.packet_count(conn)} packets')
+    elif mode == 'stages':
+        # The pipeline one stage at a time, each run to completion before the
+        # next: reading the capture, decoding it, tracking connections and
+        # writing the text report
+        stage_start = start
+        with open(filename, 'rb') as f:
+            while f.read(tcp_analyzer.READ_CHUNK_SIZE):
+                pass
+        stages['read'], stage_start = time.perf_counter() - stage_start, time.perf_counter()
+        segments = list(tcp_analyzer.decode_pcap_file(filename))
+        stages['decode'], stage_start = time.perf_counter() - stage_start, time.perf_counter()
+        connections = tcp_analyzer.analyze_segments(segments)
+        stages['aggregate'], stage_start = time.perf_counter() - stage_start, time.perf_counter()
+        with open(os.devnull, 'w') as out, contextlib.redirect_stdout(out):
+            tcp_analyzer.write_report(connections, tcp_analyzer.new_report_sink('text'))
+        stages['report'] = time.perf_counter() - stage_start
+        packets = len(segments)
+    elif mode == 'filter-analyze':
+        connections = tcp_analyzer.analyze_segments(tcp_analyzer.decode_pcap_file(filename,
+                                                                                   packet_filter=packet_filter))
+        packets = sum(tcp_analyzer.packet_count(conn) for conn in connections.values())
+    elapsed = time.perf_counter() - start
+    result = {
+        'mode': mode,
+        'packets': packets,
+        'seconds': elapsed,
+        'packets_per_sec': packets / elapsed if elapsed else 0,
+        'mb_per_sec': os.path.getsize(filename) / elapsed / 1e6 if elapsed else 0,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    }
+    if stages:
+        result['stage_seconds'] = stages
+    return result
+
+def run_in_subprocess(mode, filename, filter_expression=None):
+    output = subprocess.run(
+        [sys.executable, __file__, '--run', mode, filename] + ([filter_expression] if filter_expression else []),
+        check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+def run_comparison(filename):
+    modes = ['whole-file', 'stream', 'scalar-decode', 'mmap-decode', 'analyze', 'rtt-analyze', 'seq-analyze',
+             'stored-analyze']
+    if tcp_analyzer.np is not None:
+        modes += ['numpy-decode', 'numpy-analyze']
+    modes += ['index-write', 'index-read']
+    results = {}
+    for mode in modes:
+        result = results[mode] = run_in_subprocess(mode, filename)
+        print_result(mode, result)
+    speedup = results['mmap-decode']['packets_per_sec'] / results['scalar-decode']['packets_per_sec']
+    print(f'  mmap decode speedup over scalar decode: {speedup:.1f}x')
+    if 'numpy-decode' in results:
+        speedup = results['numpy-decode']['packets_per_sec'] / results['mmap-decode']['packets_per_sec']
+        print(f'  numpy decode speedup over mmap decode: {speedup:.1f}x')
+    overhead = results['rtt-analyze']['seconds'] / results['analyze']['seconds']
+    print(f'  analyze time with data segment RTT: {overhead:.2f}x')
+    overhead = results['seq-analyze']['seconds'] / results['analyze']['seconds']
+    print(f'  analyze time with sequence analysis: {overhead:.2f}x')
+    overhead = results['stored-analyze']['seconds'] / results['analyze']['seconds']
+    print(f'  analyze time keeping every packet: {overhead:.2f}x')
+    speedup = results['index-read']['packets_per_sec'] / results['mmap-decode']['packets_per_sec']
+    print(f'  index read speedup over mmap decode: {speedup:.1f}x')
+    result = results['stages'] = run_in_subprocess('stages', filename)
+    print_result('stages', result)
+    print('  ' + ''.join(f'{stage:>10} {seconds:6.2f} s' for stage, seconds in result['stage_seconds'].items()))
+    return results
+
+def run_scaling(filename, worker_counts):
+    baseline = run_in_subprocess('analyze', filename)
+    print_result('1 process', baseline)
+    results = {'analyze': baseline}
+    for workers in worker_counts:
+        result = results[f'workers-{workers}'] = run_in_subprocess(f'workers-{workers}', filename)
+        print_result(f'{workers} workers', result)
+        print(f'  {"":<14} speedup over 1 process: {baseline["seconds"] / result["seconds"]:.2f}x')
+    return results
+
+def run_filter(filename, size):
+    # A selective --filter against the same work without one. pkt/s counts
+    # the packets that pass the filter.
+    filter_expression = one_percent_filter(size)
+    print(f'  --filter "{filter_expression}"')
+    modes = [('mmap-decode', None), ('post-filter-decode', filter_expression), ('filter-decode', filter_expression)]
+    if tcp_analyzer.np is not None:
+        modes += [('numpy-decode', None), ('numpy-filter-decode', filter_expression)]
+    modes += [('analyze', None), ('filter-analyze', filter_expression)]
+    results = {}
+    for mode, expression in modes:
+        result = results[mode] = run_in_subprocess(mode, filename, expression)
+        print_result(mode, result)
+    matched = results['filter-decode']['packets'] / results['mmap-decode']['packets']
+    print(f'  packets matched: {matched:.2%}')
+    for mode, baseline in (('post-filter-decode', 'mmap-decode'), ('filter-decode', 'mmap-decode'),
+                           ('numpy-filter-decode', 'numpy-decode'), ('numpy-filter-decode', 'filter-decode'),
+                           ('filter-analyze', 'analyze')):
+        if mode in results:
+            speedup = results[baseline]['seconds'] / results[mode]['seconds']
+            print(f'  {mode} speedup over {baseline}: {speedup:.1f}x')
+    return results
+
+def run_formats(size, tmpdir, profile=None):
+    # The same traffic in every layout, through the mmap decoder
+    baseline = None
+    results = {}
+    for layout in LAYOUTS:
+        filename = os.path.join(tmpdir, f'synthetic_{size}_{layout}.pcap')
+        write_capture(filename, size, profile, layout)
+        result = results[layout] = run_in_subprocess('mmap-decode', filename)
+        print_result(layout, result)
+        if baseline is None:
+            baseline = result
+        else:
+            print(f'  {"":<14} relative to ethernet: {baseline["seconds"] / result["seconds"]:.2f}x')
+        os.remove(filename)
+    return results
+
+def run_reports(filename, tmpdir):
+    # Write the same analyzed connections in every report format
+    connections = tcp_analyzer.analyze_segments(tcp_analyzer.decode_pcap_file(filename))
+    results = {}
+    for report_format in tcp_analyzer.REPORT_FORMATS:
+        if report_format in ('parquet', 'arrow') and importlib.util.find_spec('pyarrow') is None:
+            continue
+        output = os.path.join(tmpdir, 'report.' + report_format)
+        start = time.perf_counter()
+        if report_format == 'text':
+            with open(output, 'w') as f, contextlib.redirect_stdout(f):
+                tcp_analyzer.write_report(connections, tcp_analyzer.new_report_sink('text'))
+        else:
+            tcp_analyzer.write_report(connections, tcp_analyzer.new_report_sink(report_format, output))
+        elapsed = time.perf_counter() - start
+        results[report_format] = {
+            'seconds': elapsed,
+            'connections_per_sec': len(connections) / elapsed,
+            'output_mb': os.path.getsize(output) / 1e6
+        }
+        print(f'  {report_format:<14} {elapsed:8.2f} s  {len(connections) / elapsed:12.0f} conn/s  '
+              f'{os.path.getsize(output) / 1e6:8.1f} MB')
+    return results
+
+def concurrent_flow_segments(flow_count, packets_per_flow):
+    # Decoded segments for flow_count flows that are all open at once: every
+    # flow sends one packet per round, alternating direction
+    segments = []
+    server = 0xc0a80001
+    for round_index in range(packets_per_flow):
+        timestamp = round_index * 0.001
+        for flow_index in range(flow_count):
+            client = 0x0a000000 + flow_index // 50000
+            client_port = 1024 + flow_index % 50000
+            if round_index % 2 == 0:
+                segments.append((timestamp, client, client_port, server, 443, round_index, 0, ACK, 65535, 100, 0))
+            else:
+                segments.append((timestamp, server, 443, client, client_port, round_index, 0, ACK, 65535, 100, 0))
+    return segments
+
+def run_flow_table(flow_count, packets_per_flow=10):
+    # Connection-table hot path only: the old per-packet dotted-quad strings
+    # and two tuple probes against one canonical integer key probe
+    segments = concurrent_flow_segments(flow_count, packets_per_flow)
+    print(f'{flow_count} concurrent flows, {len(segments)} packets')
+    results = {}
+
+    start = time.perf_counter()
+    table = {}
+    for _, src_addr, src_port, dst_addr, dst_port, *_ in segments:
+        src_ip = '.'.join(map(str, src_addr.to_bytes(4, 'big')))
+        dst_ip = '.'.join(map(str, dst_addr.to_bytes(4, 'big')))
+        conn_tuple = (src_ip, src_port, dst_ip, dst_port)
+        rev_conn_tuple = (dst_ip, dst_port, src_ip, src_port)
+        if conn_tuple in table:
+            conn = table[conn_tuple]
+        elif rev_conn_tuple in table:
+            conn = table[rev_conn_tuple]
+        else:
+            conn = table[conn_tuple] = [0]
+        conn[0] += 1
+    results['string tuples'] = report_lookup('string tuples', len(segments), time.perf_counter() - start)
+
+    start = time.perf_counter()
+    table = {}
+    endpoint_bits = tcp_analyzer.FLOW_ENDPOINT_BITS
+    for _, src_addr, src_port, dst_addr, dst_port, *_ in segments:
+        src_endpoint = (src_addr << 16) | src_port
+        dst_endpoint = (dst_addr << 16) | dst_port
+        if src_endpoint < dst_endpoint:
+            key = (src_endpoint << endpoint_bits) | dst_endpoint
+        else:
+            key = (dst_endpoint << endpoint_bits) | src_endpoint
+        conn = table.get(key)
+        if conn is None:
+            conn = table[key] = [0]
+        conn[0] += 1
+    results['integer key'] = report_lookup('integer key', len(segments), time.perf_counter() - start)
+
+    start = time.perf_counter()
+    tcp_analyzer.track_connections(segments)
+    results['track_connections'] = report_lookup('track_connections', len(segments),
+                                                 time.perf_counter() - start)
+    return results
+
+def report_lookup(label, packets, elapsed):
+    print(f'  {label:<18} {elapsed:8.2f} s  {packets / elapsed:12.0f} pkt/s')
+    return {'seconds': elapsed, 'packets_per_sec': packets / elapsed}
+
+def print_result(label, result):
+    print(f'  {label:<19} {result["seconds"]:8.2f} s  {result["packets_per_sec"]:12.0f} pkt/s  '
+          f'{result["mb_per_sec"]:8.1f} MB/s  peak RSS {result["peak_rss_mb"]:8.1f} MB')
+
+def git_commit():
+    # The commit being benchmarked, or None outside a git checkout
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def write_json_results(filename, benchmarks):
+    # Save a run's results together with what they were measured on, so
+    # runs can be compared over time
+    document = {
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': f'{platform.python_implementation()} {platform.python_version()}',
+        'numpy': tcp_analyzer.np.__version__ if tcp_analyzer.np is not None else None,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'arguments': sys.argv[1:],
+        'benchmarks': benchmarks
+    }
+    with open(filename, 'w') as f:
+        json.dump(document, f, indent=2)
+        f.write('\n')
+
+def main():
+    if len(sys.argv) in (4, 5) and sys.argv[1] == '--run':
+        print(json.dumps(run_mode(*sys.argv[2:])))
+        return
+
+    parser = argparse.ArgumentParser(description='Benchmark tcp_analyzer.py on synthetic captures.')
+    parser.add_argument('sizes', nargs='*', type=int, default=[1000000, 10000000],
+                        help='packets per synthetic capture (default: 1000000 10000000)')
+    parser.add_argument('--scaling', action='store_true',
+                        help='compare --workers 1/2/4/8/16 instead of the decoders')
+    parser.add_argument('--workers', type=int, nargs='+', default=[2, 4, 8, 16], metavar='N',
+                        help='worker counts for --scaling')
+    parser.add_argument('--formats', action='store_true',
+                        help='compare the decoder across capture formats and link layers '
+                             '(' + ', '.join(LAYOUTS) + ')')
+    parser.add_argument('--reports', action='store_true',
+                        help='compare the report formats (' + ', '.join(tcp_analyzer.REPORT_FORMATS) + ')')
+    parser.add_argument('--filter', action='store_true',
+                        help='compare decoding and analysis with a --filter matching 1%% of the packets '
+                             'against the same work without one')
+    parser.add_argument('--flow-table', type=int, metavar='FLOWS',
+                        help='only benchmark the connection table with FLOWS concurrent flows')
+    parser.add_argument('--realistic', action='store_true',
+                        help='benchmark on realistic traffic (overlapping flows of varying length and RTT, '
+                             'resets, retransmissions) instead of uniform flows')
+    parser.add_argument('--packets-per-flow', type=int, default=REALISTIC_PROFILE['packets_per_flow'],
+                        metavar='N', help='mean packets per realistic flow (default %(default)s)')
+    parser.add_argument('--concurrency', type=int, default=REALISTIC_PROFILE['concurrency'], metavar='N',
+                        help='realistic flows open at once (default %(default)s)')
+    parser.add_argument('--reset-rate', type=float, default=REALISTIC_PROFILE['reset_rate'], metavar='P',
+                        help='share of realistic flows ending in a RST (default %(default)s)')
+    parser.add_argument('--retransmit-rate', type=float, default=REALISTIC_PROFILE['retransmit_rate'],
+                        metavar='P', help='share of realistic data segments retransmitted (default %(default)s)')
+    parser.add_argument('--midstream-rate', type=float, default=REALISTIC_PROFILE['midstream_rate'],
+                        metavar='P', help='share of realistic flows without a handshake (default %(default)s)')
+    parser.add_argument('--udp-rate', type=float, default=REALISTIC_PROFILE['udp_rate'], metavar='P',
+                        help='share of realistic flows that are UDP (default %(default)s)')
+    parser.add_argument('--seed', type=int, default=REALISTIC_PROFILE['seed'],
+                        help='random seed for realistic traffic (default %(default)s)')
+    parser.add_argument('--generate', metavar='FILE',
+                        help='only write a capture of the first size to FILE, e.g. as a test capture')
+    parser.add_argument('--json', metavar='FILE',
+                        help='also write the results, with the commit and platform they were measured on, '
+                             'to FILE as JSON')
+    args = parser.parse_args()
+
+    profile = None
+    if args.realistic:
+        profile = {
+            'packets_per_flow': args.packets_per_flow,
+            'concurrency': args.concurrency,
+            'reset_rate': args.reset_rate,
+            'retransmit_rate': args.retransmit_rate,
+            'midstream_rate': args.midstream_rate,
+            'udp_rate': args.udp_rate,
+            'seed': args.seed
+        }
+    traffic = 'realistic' if profile is not None else 'synthetic'
+
+    if args.generate:
+        written = write_capture(args.generate, args.sizes[0], profile)
+        print(f'{args.generate}: {written} packets of {traffic} traffic '
+              f'({os.path.getsize(args.generate) / 1e6:.1f} MB)')
+        return
+
+    benchmarks = []
+    if args.flow_table:
+        results = run_flow_table(args.flow_table)
+        benchmarks.append({'benchmark': 'flow-table', 'flows': args.flow_table, 'results': results})
+    else:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for size in args.sizes:
+                benchmark = {'packets': size, 'traffic': traffic, 'profile': profile}
+                if args.formats:
+                    print(f'{size} packets')
+                    benchmarks.append(dict(benchmark, benchmark='formats',
+                                           results=run_formats(size, tmpdir, profile)))
+                    continue
+                filename = os.path.join(tmpdir, f'{traffic}_{size}.pcap')
+                write_capture(filename, size, profile)
+                benchmark['capture_mb'] = os.path.getsize(filename) / 1e6
+                print(f'{size} packets ({benchmark["capture_mb"]:.1f} MB)')
+                if args.scaling:
+                    benchmark.update(benchmark='scaling', results=run_scaling(filename, args.workers))
+                elif args.reports:
+                    benchmark.update(benchmark='reports', results=run_reports(filename, tmpdir))
+                elif args.filter:
+                    benchmark.update(benchmark='filter', results=run_filter(filename, size))
+                else:
+                    benchmark.update(benchmark='comparison', results=run_comparison(filename))
+                benchmarks.append(benchmark)
+
+    if args.json:
+        write_json_results(args.json, benchmarks)
+
+if __name__ == '__main__':
+    main()